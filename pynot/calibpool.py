@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""
+In-memory pool of calibration frames.
+
+The master calibrations (MBIAS, NORM_SFLAT, etc.) are used for every science and arc frame.
+The pool keeps the image data in memory, such that each calibration file is only read once
+per run. The frames are identified by the absolute path, the extension, the modification time
+and the size of the file, so a calibration that is updated on disk is read again.
+The least recently used frames are removed when the memory budget is exceeded.
+
+The arrays handed out by the pool are read-only. Use `np.array(data)` to get a writable copy.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+from astropy.io import fits
+from collections import OrderedDict
+import os
+import threading
+
+from pynot.fitsio import native_byteorder, read_image_data
+
+
+# Default memory budget in MB:
+default_memory_limit = 512
+
+
+class CalibrationPool(object):
+    """
+    Least-recently-used pool of calibration images with a memory budget `memory_limit` in MB.
+    """
+    def __init__(self, memory_limit=default_memory_limit):
+        self.memory_limit = memory_limit
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, fname, ext=None):
+        """
+        Return the read-only image data of extension `ext` of the FITS file `fname`.
+        By default, the first extension with image data is used as in `fits.getdata`.
+        """
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+        key = (path, ext)
+        file_id = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self.frames:
+                cached_id, data = self.frames[key]
+                if cached_id == file_id:
+                    self.frames.move_to_end(key)
+                    self.hits += 1
+                    return data
+                self._remove(key)
+
+        if ext is None:
+            # Not memory-mapped, the file may be replaced while the frame is in the pool:
+            data, _ = read_image_data(path, memmap=False)
+        else:
+            data = native_byteorder(fits.getdata(path, ext))
+        data.setflags(write=False)
+        with self._lock:
+            self.misses += 1
+            if data.nbytes <= self.memory_limit * 1024**2:
+                self.frames[key] = (file_id, data)
+                self.nbytes += data.nbytes
+                self._evict()
+        return data
+
+    def set_memory_limit(self, memory_limit):
+        with self._lock:
+            self.memory_limit = memory_limit
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self.frames.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        _, data = self.frames.pop(key)
+        self.nbytes -= data.nbytes
+
+    def _evict(self):
+        while self.frames and self.nbytes > self.memory_limit * 1024**2:
+            key = next(iter(self.frames))
+            self._remove(key)
+
+    def __contains__(self, fname):
+        path = os.path.abspath(fname)
+        return any(key[0] == path for key in self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "<CalibrationPool: %i frames, %.1f / %.0f MB, %i reads, %i reused>" % (len(self), self.nbytes / 1024**2,
+                                                                                 self.memory_limit, self.misses, self.hits)
+
+
+# The pool of the running process:
+calib_pool = CalibrationPool()
+
+
+def get_calibration(fname, ext=None):
+    """Image data of the calibration file `fname` from the pool of the running process (read-only)"""
+    return calib_pool.get(fname, ext)
+
+
+def set_pool_limit(memory_limit):
+    """Set the memory budget in MB of the calibration pool. A budget of 0 disables the pool."""
+    calib_pool.set_memory_limit(memory_limit)
+
@@ -6,6 +6,7 @@ __author__ = 'Jens-Kristian Krogager'
 __email__ = "krogager@iap.fr"
 __credits__ = ["Jens-Kristian Krogager"]
 
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 import numpy as np
 from astropy.io import fits
@@ -16,20 +17,26 @@ import os
 from os.path import exists, basename
 
 from pynot.data import organizer as organizer
+from pynot.fitsio import read_image_data
 from pynot.logging import Report
 from pynot import instrument
-from pynot.functions import mad, my_formatter, get_version_number
+from pynot.functions import mad, my_formatter, get_version_number, chebyshev_fit_rows
 from pynot.scired import trim_overscan, correct_raw_file
 from pynot import reports
+from pynot import stacking
+from pynot.calibpool import get_calibration
 
 __version__ = get_version_number()
 
 
-def combine_bias_frames(bias_frames, output='', kappa=15, method='mean', overwrite=True, mode='spec', report_fname=''):
+def combine_bias_frames(bias_frames, output='', kappa=15, method='mean', overwrite=True, mode='spec', report_fname='',
+                        memory_limit=stacking.default_memory_limit, scratch_dir=None, incremental=False, accum_dir=''):
     """Combine individual bias frames to create a 'master bias' frame.
     The combination is performed using robust sigma-clipping and
     median combination. Bad pixels are subsequently replaced by the
     median value of the final combined image.
+    The frames are stacked in a memory-mapped scratch file and combined
+    in tiles of rows within the given memory budget.
 
     Parameters
     ==========
@@ -52,6 +59,19 @@ def combine_bias_frames(bias_frames, output='', kappa=15, method='mean', overwri
     report_fname : string  [default='']
         Filename of pdf diagnostic report
 
+    memory_limit : float  [default=1024]
+        Memory budget in MB for the combination of the image tiles
+
+    scratch_dir : string  [default=None]
+        Directory of the temporary scratch file. By default, the system temporary directory is used.
+
+    incremental : boolean  [default=False]
+        Update the persistent bias accumulator with the new frames and create
+        the master bias from all accumulated frames. See `combine_bias_incremental`.
+
+    accum_dir : string  [default='']
+        Directory of the bias accumulator. By default, the directory of `output` is used.
+
     Returns
     =======
     output : string
@@ -61,58 +81,294 @@ def combine_bias_frames(bias_frames, output='', kappa=15, method='mean', overwri
         The log of the function steps and errors
     """
     msg = list()
+    if len(bias_frames) == 0:
+        msg.append(" [ERROR]  - No bias frames to combine!")
+        msg.append("")
+        return '', "\n".join(msg)
+
+    if incremental:
+        return combine_bias_incremental(bias_frames, output=output, kappa=kappa, method=method, overwrite=overwrite,
+                                        report_fname=report_fname, accum_dir=accum_dir,
+                                        memory_limit=memory_limit, scratch_dir=scratch_dir)
+
+
+    with stacking.ScratchCube(len(bias_frames), scratch_dir=scratch_dir) as bias:
+        for frame in bias_frames:
+            msg.append("          - Loaded bias frame: %s" % frame)
+            raw_img, _ = read_image_data(frame)
+            bias_hdr = instrument.get_header(frame)
+            trim_bias, bias_hdr = trim_overscan(raw_img, bias_hdr)
+            msg.append("          - Trimming overscan of bias images")
+            bias.append(trim_bias)
+
+        median_img0 = stacking.tiled_median(bias, memory_limit=memory_limit)
+        sig = mad(median_img0)*1.4826
+        master_bias, mask = stacking.clipped_combine(bias, median_img0, kappa*sig, method='mean',
+                                                     memory_limit=memory_limit)
+        if method.lower() == 'median':
+            # The median combination has always used the unclipped frames, since `np.ma.median`
+            # ignores the masks of a list of masked arrays. Keep this to reproduce earlier master frames:
+            master_bias = median_img0
+        msg.append("          - Masking outlying pixels: kappa = %.2f" % kappa)
+        msg.append("          - Total number of masked pixels: %i" % np.sum(mask > 0))
 
-    bias = list()
-    for frame in bias_frames:
-        msg.append("          - Loaded bias frame: %s" % frame)
-        raw_img = fits.getdata(frame)
-        bias_hdr = instrument.get_header(frame)
-        trim_bias, bias_hdr = trim_overscan(raw_img, bias_hdr)
-        msg.append("          - Trimming overscan of bias images")
-        if len(bias) > 1:
-            assert trim_bias.shape == bias[0].shape, "Images must have same shape!"
-        bias.append(trim_bias)
-
-    mask = np.zeros_like(bias[0], dtype=int)
-    median_img0 = np.median(bias, 0)
-    sig = mad(median_img0)*1.4826
-    masked_bias = list()
-    for img in bias:
-        this_mask = np.abs(img - median_img0) > kappa*sig
-        masked_bias.append(np.ma.masked_where(this_mask, img))
-        mask += 1*this_mask
-    msg.append("          - Masking outlying pixels: kappa = %.2f" % kappa)
-    msg.append("          - Total number of masked pixels: %i" % np.sum(mask > 0))
-
-    if method.lower() == 'median':
-        master_bias = np.ma.median(masked_bias, 0).data
-        Ncomb = len(bias) - mask
-        master_bias[Ncomb == 0] = np.median(master_bias[Ncomb != 0])
-    else:
-        master_bias = np.ma.mean(masked_bias, 0).data
         Ncomb = len(bias) - mask
-        master_bias[Ncomb == 0] = np.mean(master_bias[Ncomb != 0])
-    msg.append("          - Combination method: %s" % method)
-    msg.append("          - Combined %i files" % len(bias))
-    msg.append("          - Image Stats:")
-    msg.append("          - Median = %.1f,  Std.Dev = %.1f" % (np.median(master_bias), 1.48*mad(master_bias)))
+        if method.lower() == 'median':
+            master_bias[Ncomb == 0] = np.median(master_bias[Ncomb != 0])
+        else:
+            master_bias[Ncomb == 0] = np.mean(master_bias[Ncomb != 0])
+        msg.append("          - Combination method: %s" % method)
+        msg.append("          - Combined %i files" % len(bias))
+        msg.append("          - Image Stats:")
+        msg.append("          - Median = %.1f,  Std.Dev = %.1f" % (np.median(master_bias), 1.48*mad(master_bias)))
+
+        hdr = bias_hdr
+        hdr['NCOMBINE'] = len(bias_frames)
+        if method.lower() == 'median':
+            hdr.add_comment('Median combined Master Bias')
+        else:
+            hdr.add_comment('Mean combined Master Bias')
+        hdr.add_comment('PyNOT version %s' % __version__)
+        if not output:
+            output = 'MASTER_BIAS.fits'
+
+        fits.writeto(output, master_bias, header=hdr, overwrite=overwrite)
+        msg.append(" [OUTPUT] - Saving combined Bias Image: %s" % output)
+
+        if report_fname:
+            reports.check_bias(bias, bias_frames, output, report_fname=report_fname)
+            msg.append(" [OUTPUT] - Saving Bias Report: %s" % report_fname)
+    msg.append("")
+    output_msg = "\n".join(msg)
+
+    return output, output_msg
+
+
+class BiasAccumulator(object):
+    """
+    Persistent running statistics of bias frames for a given CCD setup and image shape.
+
+    For every pixel, the accumulator holds the running mean, the sum of squared deviations (M2)
+    and the number of accepted frames, updated by Welford's algorithm. The identifiers of the
+    frames already included (filename and DATE-OBS, see `get_frame_id`) are stored as well,
+    so that a frame is only counted once.
+    The accumulator is saved as a FITS file with the extensions: MEAN, M2, NCOMB and FILES.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.mean = None
+        self.M2 = None
+        self.count = None
+        self.files = list()
+        self.header = None
+        if exists(fname):
+            self.load()
+
+    def load(self):
+        with fits.open(self.fname) as hdu:
+            self.header = hdu['MEAN'].header
+            self.mean = hdu['MEAN'].data.astype(np.float64)
+            self.M2 = hdu['M2'].data.astype(np.float64)
+            self.count = hdu['NCOMB'].data.astype(int)
+            self.files = [fname.strip() for fname in hdu['FILES'].data['FILENAME']]
+
+    def __contains__(self, frame_id):
+        return frame_id in self.files
+
+    @property
+    def shape(self):
+        if self.mean is None:
+            return None
+        return self.mean.shape
+
+    @property
+    def variance(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = self.M2 / (self.count - 1)
+        var[self.count < 2] = np.nan
+        return var
+
+    def add(self, frame_id, img, reject):
+        """Update the running statistics with the pixels of `img` that are not rejected"""
+        if self.mean is None:
+            self.mean = np.zeros(img.shape)
+            self.M2 = np.zeros(img.shape)
+            self.count = np.zeros(img.shape, dtype=int)
+        elif img.shape != self.shape:
+            raise ValueError("Image shape %r does not match the bias accumulator: %r" % (img.shape, self.shape))
+
+        use = ~reject
+        img = np.asarray(img, dtype=np.float64)
+        self.count[use] += 1
+        delta = img[use] - self.mean[use]
+        self.mean[use] += delta / self.count[use]
+        self.M2[use] += delta * (img[use] - self.mean[use])
+        self.files.append(frame_id)
+
+    def save(self, hdr):
+        hdr = hdr.copy()
+        hdr['EXTNAME'] = 'MEAN'
+        hdr['CCDSETUP'] = (instrument.get_binning_from_hdr(hdr), 'Binning and readout of the accumulator')
+        hdr['NFILES'] = (len(self.files), 'Number of bias frames in the accumulator')
+        hdr['AUTHOR'] = 'PyNOT version %s' % __version__
+        self.header = hdr
+        mean_ext = fits.PrimaryHDU(self.mean, header=hdr)
+        m2_ext = fits.ImageHDU(self.M2, name='M2')
+        count_ext = fits.ImageHDU(self.count.astype(np.int32), name='NCOMB')
+        col = fits.Column(name='FILENAME', array=np.array(self.files, dtype=str), format='%iA' % max(map(len, self.files)))
+        files_ext = fits.BinTableHDU.from_columns([col], name='FILES')
+        fits.HDUList([mean_ext, m2_ext, count_ext, files_ext]).writeto(self.fname, overwrite=True)
+
+
+def get_frame_id(fname, hdr):
+    """Identifier of a bias frame in the accumulator: the filename and the time of observation"""
+    return "%s %s" % (basename(fname), instrument.get_date(hdr))
+
+
+def get_accumulator_fname(hdr, shape, accum_dir=''):
+    """Filename of the bias accumulator for the CCD setup (binning and readout) and image shape"""
+    ccd_setup = instrument.get_binning_from_hdr(hdr)
+    return os.path.join(accum_dir, 'BIAS_ACCUM_%s_%ix%i.fits' % (ccd_setup, shape[1], shape[0]))
+
+
+def combine_bias_incremental(bias_frames, output='', kappa=15, method='mean', overwrite=True, report_fname='',
+                             accum_dir='', memory_limit=stacking.default_memory_limit, scratch_dir=None):
+    """Update the persistent bias accumulator with new bias frames and create a 'master bias'
+    from all the frames in the accumulator. Only frames that are not already included
+    in the accumulator are read, so the cost scales with the number of new frames.
+
+    Pixels of the new frames deviating by more than `kappa` times the standard deviation
+    from the accumulated mean image are rejected. The standard deviation of each pixel is
+    calculated from the running statistics once two or more frames have been accepted, otherwise
+    the robust standard deviation of the reference image is used. If the accumulator is empty,
+    the median of the new frames is used as reference instead. The master bias is the running mean,
+    and pixels without any accepted frames are replaced by the mean of the master bias.
+    A median combination is not possible from the running statistics: `method='median'` is
+    ignored and a warning is added to the log.
+
+    Parameters
+    ==========
+
+    bias_frames : list of strings, or other iterable
+        List containing file names for the individual bias frames
+
+    output : string [default='']
+        Output file name for the final combined image.
+
+    kappa : integer [default=15]
+        Number of sigmas above which to reject pixels.
+
+    method : string [default='mean']
+        Method used for image combination. Only 'mean' is supported.
+
+    overwrite : boolean [default=False]
+        Overwrite existing output file if True.
+
+    report_fname : string  [default='']
+        Filename of pdf diagnostic report
+
+    accum_dir : string  [default='']
+        Directory of the bias accumulator. By default, the directory of `output` is used.
+        The accumulator filename is constructed from the CCD setup and image shape.
+
+    memory_limit : float  [default=1024]
+        Memory budget in MB for the median image of the first frames
+
+    scratch_dir : string  [default=None]
+        Directory of the temporary scratch file. By default, the system temporary directory is used.
+
+    Returns
+    =======
+    output : string
+        Filename of combined bias image
+
+    output_msg: string
+        The log of the function steps and errors
+    """
+    msg = list()
+    if len(bias_frames) == 0:
+        msg.append(" [ERROR]  - No bias frames to combine!")
+        msg.append("")
+        return '', "\n".join(msg)
 
-    hdr = bias_hdr
-    hdr['NCOMBINE'] = len(bias_frames)
-    if method.lower() == 'median':
-        hdr.add_comment('Median combined Master Bias')
-    else:
-        hdr.add_comment('Mean combined Master Bias')
-    hdr.add_comment('PyNOT version %s' % __version__)
     if not output:
         output = 'MASTER_BIAS.fits'
+    if not accum_dir:
+        accum_dir = os.path.dirname(output)
+    if method.lower() == 'median':
+        msg.append("[WARNING] - Median combination is not supported for incremental bias, using the running mean")
+
+    accumulator = None
+    new_frames = list()
+    new_ids = list()
+    # Trimmed header of the last new frame:
+    new_hdr = None
+    with stacking.ScratchCube(len(bias_frames), scratch_dir=scratch_dir) as bias:
+        for frame in bias_frames:
+            raw_hdr = instrument.get_header(frame)
+            frame_id = get_frame_id(frame, raw_hdr)
+            if (accumulator is not None and frame_id in accumulator) or frame_id in new_ids:
+                msg.append("          - Bias frame already in accumulator: %s" % frame)
+                continue
+            raw_img, _ = read_image_data(frame)
+            trim_bias, bias_hdr = trim_overscan(raw_img, raw_hdr)
+            if accumulator is None:
+                accum_fname = get_accumulator_fname(bias_hdr, trim_bias.shape, accum_dir)
+                accumulator = BiasAccumulator(accum_fname)
+                msg.append("          - Bias accumulator: %s" % accum_fname)
+                msg.append("          - Number of frames in accumulator: %i" % len(accumulator.files))
+            if frame_id in accumulator:
+                msg.append("          - Bias frame already in accumulator: %s" % frame)
+                continue
+            msg.append("          - Loaded bias frame: %s" % frame)
+            msg.append("          - Trimming overscan of bias images")
+            bias.append(trim_bias)
+            new_frames.append(frame)
+            new_ids.append(frame_id)
+            new_hdr = bias_hdr
+
+        if len(new_frames) > 0:
+            if accumulator.mean is None:
+                reference = stacking.tiled_median(bias, memory_limit=memory_limit)
+                sig = np.full(reference.shape, np.nan)
+            else:
+                reference = accumulator.mean.copy()
+                sig = np.sqrt(accumulator.variance)
+            # Use the robust standard deviation for pixels with fewer than two accepted frames:
+            sig[np.isnan(sig)] = mad(reference)*1.4826
+            N_rejected = 0
+            for frame_id, img in zip(new_ids, bias):
+                reject = np.abs(img - reference) > kappa*sig
+                N_rejected += np.sum(reject)
+                accumulator.add(frame_id, img, reject)
+            msg.append("          - Masking outlying pixels: kappa = %.2f" % kappa)
+            msg.append("          - Total number of masked pixels: %i" % N_rejected)
+            accumulator.save(new_hdr)
+            msg.append(" [OUTPUT] - Updated bias accumulator with %i new files: %s" % (len(new_frames), accum_fname))
+        else:
+            msg.append("          - No new bias frames to add to the accumulator")
 
-    fits.writeto(output, master_bias, header=hdr, overwrite=overwrite)
-    msg.append(" [OUTPUT] - Saving combined Bias Image: %s" % output)
-
-    if report_fname:
-        reports.check_bias(bias, bias_frames, output, report_fname=report_fname)
-        msg.append(" [OUTPUT] - Saving Bias Report: %s" % report_fname)
+        master_bias = accumulator.mean.copy()
+        Ncomb = accumulator.count
+        master_bias[Ncomb == 0] = np.mean(master_bias[Ncomb != 0])
+        msg.append("          - Combination method: running mean")
+        msg.append("          - Combined %i files" % len(accumulator.files))
+        msg.append("          - Image Stats:")
+        msg.append("          - Median = %.1f,  Std.Dev = %.1f" % (np.median(master_bias), 1.48*mad(master_bias)))
+
+        hdr = accumulator.header.copy()
+        hdr.remove('EXTNAME', ignore_missing=True)
+        hdr.remove('CCDSETUP', ignore_missing=True)
+        hdr.remove('NFILES', ignore_missing=True)
+        hdr['NCOMBINE'] = len(accumulator.files)
+        hdr.add_comment('Incrementally combined Master Bias (running mean)')
+        hdr.add_comment('PyNOT version %s' % __version__)
+        fits.writeto(output, master_bias, header=hdr, overwrite=overwrite)
+        msg.append(" [OUTPUT] - Saving combined Bias Image: %s" % output)
+
+        if report_fname and len(new_frames) > 0:
+            reports.check_bias(bias, new_frames, output, report_fname=report_fname)
+            msg.append(" [OUTPUT] - Saving Bias Report: %s" % report_fname)
     msg.append("")
     output_msg = "\n".join(msg)
 
@@ -121,7 +377,7 @@ def combine_bias_frames(bias_frames, output='', kappa=15, method='mean', overwri
 
 def combine_flat_frames(raw_frames, output, mbias='', mode='spec', dispaxis=None,
                         kappa=5, verbose=False, overwrite=True, method='mean', report_fname='',
-                        **kwargs):
+                        memory_limit=stacking.default_memory_limit, scratch_dir=None, **kwargs):
     """Combine individual spectral flat frames to create a 'master flat' frame.
     The individual frames are normalized to the mode of the 1D collapsed spectral
     shape. Individual frames are clipped using a kappa-sigma-clipping on the mode
@@ -130,6 +386,8 @@ def combine_flat_frames(raw_frames, output, mbias='', mode='spec', dispaxis=None
     be turned off. The variations from one slit to another is very small.
     The normalized 2D frames are then median combined and the final image is
     multiplied by the median normalization to restore the ADU values of the image.
+    The frames are stacked in a memory-mapped scratch file and combined
+    in tiles of rows within the given memory budget.
 
     Parameters
     ==========
@@ -163,6 +421,12 @@ def combine_flat_frames(raw_frames, output, mbias='', mode='spec', dispaxis=None
     report_fname : string  [default='']
         Filename of pdf diagnostic report
 
+    memory_limit : float  [default=1024]
+        Memory budget in MB for the combination of the image tiles
+
+    scratch_dir : string  [default=None]
+        Directory of the temporary scratch file. By default, the system temporary directory is used.
+
     Returns
     =======
     output : string
@@ -173,7 +437,7 @@ def combine_flat_frames(raw_frames, output, mbias='', mode='spec', dispaxis=None
     """
     msg = list()
     if mbias and exists(mbias):
-        bias = fits.getdata(mbias)
+        bias = get_calibration(mbias)
         # bias_hdr = instrument.get_header(mbias)
 
     else:
@@ -193,61 +457,57 @@ def combine_flat_frames(raw_frames, output, mbias='', mode='spec', dispaxis=None
     elif dispaxis not in [1, 2]:
         raise ValueError("dispaxis must be either 1 or 2, not: %r" % dispaxis)
 
-    flats = list()
-    flat_peaks = list()
-    for fname in raw_frames:
-        hdr = instrument.get_header(fname)
-        flat = fits.getdata(fname)
-        flat, hdr = trim_overscan(flat, hdr)
-        msg.append("          - Trimming overscan of Flat images")
-
-        if mode == 'spec':
-            flat = flat - bias
-            peak_val = np.max(np.mean(flat, dispaxis-1))
-            flats.append(flat/peak_val)
-            flat_peaks.append(peak_val)
-            msg.append("          - Loaded Spectral Flat file: %s   mode=%.1f" % (fname, peak_val))
-
-        else:
-            flat = flat - bias
-            pad = np.max(flat.shape) // 4
-            peak_val = np.median(flat[pad:-pad, pad:-pad])
-            flats.append(flat/peak_val)
-            flat_peaks.append(peak_val)
-            msg.append("          - Loaded Imaging Flat file: %s   median=%.1f" % (fname, peak_val))
-
-    mask = np.zeros_like(flats[0], dtype=int)
-    median_img0 = np.median(flats, 0)
-    sig = mad(median_img0)*1.4826
-    masked_flats = list()
-    for img in flats:
-        this_mask = np.abs(img - median_img0) > kappa*sig
-        masked_flats.append(np.ma.masked_where(this_mask, img))
-        mask += 1*this_mask
+    with stacking.ScratchCube(len(raw_frames), scratch_dir=scratch_dir) as flats:
+        flat_peaks = list()
+        for fname in raw_frames:
+            hdr = instrument.get_header(fname)
+            flat, _ = read_image_data(fname)
+            flat, hdr = trim_overscan(flat, hdr)
+            msg.append("          - Trimming overscan of Flat images")
+
+            if mode == 'spec':
+                flat = flat - bias
+                peak_val = np.max(np.mean(flat, dispaxis-1))
+                flats.append(flat/peak_val)
+                flat_peaks.append(peak_val)
+                msg.append("          - Loaded Spectral Flat file: %s   mode=%.1f" % (fname, peak_val))
+
+            else:
+                flat = flat - bias
+                pad = np.max(flat.shape) // 4
+                peak_val = np.median(flat[pad:-pad, pad:-pad])
+                flats.append(flat/peak_val)
+                flat_peaks.append(peak_val)
+                msg.append("          - Loaded Imaging Flat file: %s   median=%.1f" % (fname, peak_val))
+
+        median_img0 = stacking.tiled_median(flats, memory_limit=memory_limit)
+        sig = mad(median_img0)*1.4826
+        # Take the mean of the sigma-clipped images.
+        flat_combine, mask = stacking.clipped_combine(flats, median_img0, kappa*sig, method='mean',
+                                                      memory_limit=memory_limit)
+        if method.lower() == 'median':
+            # As for the bias, the median combination is performed on the unclipped frames:
+            flat_combine = median_img0
+        N_flats = len(flats)
     msg.append("          - Standard deviation of raw median image: %.1f ADUs" % sig)
     msg.append("          - Masking outlying pixels using a threshold of kappa=%.1f" % kappa)
     msg.append("          - Total number of masked pixels: %i" % np.sum(mask > 0))
     msg.append("          - Median value of combined flat: %i" % np.sum(mask > 0))
 
-    # Take the mean of the sigma-clipped images.
-    if method.lower() == 'median':
-        flat_combine = np.ma.median(masked_flats, 0).data
-    else:
-        flat_combine = np.ma.mean(masked_flats, 0).data
     if mode == 'spec':
         # Scale the image back to the original ADU scale
         flat_combine = flat_combine * np.nanmedian(flat_peaks)
 
     # Identify gaps in the image where no pixels contribute:
-    Ncomb = len(flats) - mask
+    Ncomb = N_flats - mask
     flat_combine[Ncomb == 0] = np.median(flat_combine[Ncomb != 0])
-    if len(flats) == 1:
-        msg.append("          - Combined %i file" % len(flats))
+    if N_flats == 1:
+        msg.append("          - Combined %i file" % N_flats)
     else:
-        msg.append("          - Combined %i files" % len(flats))
+        msg.append("          - Combined %i files" % N_flats)
 
     # hdr = instrument.get_header(raw_frames[0])
-    hdr['NCOMBINE'] = len(flats)
+    hdr['NCOMBINE'] = N_flats
     if method.lower() == 'median':
         hdr.add_comment('Median combined Flat')
     else:
@@ -293,8 +553,62 @@ def detect_flat_edges(img, dispaxis=2, savgol_window=21, threshold=10, width=10)
 
 
 
+def fit_flat_rows(rows, x, order=24, savgol_window=51):
+    """
+    Fit the spatial profile of every row of the (median filtered) flat field.
+    Each row is smoothed by a Savitzky--Golay filter and outlying pixels are masked
+    before fitting a Chebyshev polynomial to the filtered rows. The edges of the
+    fitted rows are replaced by the filtered data, which are more robust.
+    All rows are processed at once.
+
+    Parameters
+    ==========
+    rows : np.array (M, N)
+        Spatial rows of the flat field, cut to the illuminated part of the slit
+
+    x : np.array (N)
+        Pixel array of the spatial axis
+
+    order : integer  [default=24]
+        Order for Chebyshev polynomial to fit to the spatial profile
+
+    savgol_window : integer  [default=51]
+        Window width in pixels for Savitzky--Golay filter of spatial profile
+
+    Returns
+    =======
+    model : np.array (M, N)
+        The fitted spatial profile of every row
+    """
+    pad = savgol_window // 2 + 1
+    filtered_rows = signal.savgol_filter(rows, savgol_window, 2, axis=1)
+    residuals = rows - filtered_rows
+    sig = 1.5*mad(residuals, axis=1)
+    mask = np.abs(residuals) < 2*sig[:, np.newaxis]
+    # Exclude filter edges, half filter width, of the unmasked pixels in each row:
+    rank = np.cumsum(mask, 1) - 1
+    N_unmasked = np.sum(mask, 1)[:, np.newaxis]
+    mask &= (rank >= pad) & (rank < N_unmasked - pad)
+
+    coeffs, vander = chebyshev_fit_rows(x, filtered_rows, mask, order, domain=[x.min(), x.max()])
+    model = coeffs @ vander.T
+    # Rows without enough pixels for the fit use the filtered data:
+    bad_rows = ~np.all(np.isfinite(coeffs), 1)
+    model[bad_rows] = filtered_rows[bad_rows]
+    # Remove edge effects in fitting, the filtered data are more robust:
+    # This stiched approach introduces a tiny discontinuity, but usually << 1%, so not important!
+    model[:, :pad] = filtered_rows[:, :pad]
+    model[:, -pad:] = filtered_rows[:, -pad:]
+    return model
+
+
+def _fit_flat_chunk(args):
+    return fit_flat_rows(*args)
+
+
 def normalize_spectral_flat(fname, output='', fig_dir='', dispaxis=None, order=24, savgol_window=51,
-                            med_window=5, edge_threshold=10, edge_window=21, edge_width=10, plot=True, overwrite=True, **kwargs):
+                            med_window=5, edge_threshold=10, edge_window=21, edge_width=10, plot=True, overwrite=True,
+                            workers=1, **kwargs):
     """
     Normalize spectral flat field for long-slit observations. Parameters are optimized
     for NOT/ALFOSC spectra with horizontal slits, i.e., vertical spectra [axis=2],
@@ -345,6 +659,10 @@ def normalize_spectral_flat(fname, output='', fig_dir='', dispaxis=None, order=2
     overwrite : boolean [default=False]
         Overwrite existing output file if True.
 
+    workers : integer  [default=1]
+        Number of processes used to fit the rows. The rows are split
+        into chunks which are fitted in parallel if `workers` > 1.
+
     Returns
     =======
     output : string
@@ -355,7 +673,7 @@ def normalize_spectral_flat(fname, output='', fig_dir='', dispaxis=None, order=2
 
     """
     msg = list()
-    flat = fits.getdata(fname)
+    flat, _ = read_image_data(fname)
     hdr = instrument.get_header(fname)
     grism = instrument.get_grism(hdr)
     slit_name = instrument.get_slit(hdr)
@@ -401,24 +719,14 @@ def normalize_spectral_flat(fname, output='', fig_dir='', dispaxis=None, order=2
     msg.append("          - Fitting each spatial row/column using Chebyshev polynomials combined with Savitzky--Golay filtering")
     msg.append("          - Polynomial order: %i" % order)
     msg.append("          - Savitzky--Golay filter width: %i" % savgol_window)
-    pad = savgol_window // 2 + 1
     x_fit = x[x1:x2]
-    for num, row in enumerate(smoothed_flat):
-        filtered_row = signal.savgol_filter(row[x1:x2], savgol_window, 2)
-        sig = 1.5*mad(row[x1:x2] - filtered_row)
-        # mask = (row[x1:x2] - filtered_row) > -sig
-        mask = np.abs(row[x1:x2] - filtered_row) < 2*sig
-        # Exclude filter edges, half filter width:
-        x_mask = x_fit[mask][pad:-pad]
-        row_mask = filtered_row[mask][pad:-pad]
-        fit_row = np.polynomial.Chebyshev.fit(x_mask, row_mask, order, domain=[x_fit.min(), x_fit.max()])
-        model1d = fit_row(x_fit)
-        # Remove edge effects in fitting, the filtered data are more robust:
-        # This stiched approach introduces a tiny discontinuity, but usually << 1%, so not important!
-        model1d[:pad] = filtered_row[:pad]
-        model1d[-pad:] = filtered_row[-pad:]
-        # Insert back into model image:
-        model[num][x1:x2] = model1d
+    rows = smoothed_flat[:, x1:x2]
+    if workers > 1:
+        chunks = [(chunk, x_fit, order, savgol_window) for chunk in np.array_split(rows, workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            model[:, x1:x2] = np.concatenate(list(executor.map(_fit_flat_chunk, chunks)))
+    else:
+        model[:, x1:x2] = fit_flat_rows(rows, x_fit, order=order, savgol_window=savgol_window)
 
     if dispaxis == 1:
         # Flip image the model back to original orientation:
@@ -464,6 +772,7 @@ def normalize_spectral_flat(fname, output='', fig_dir='', dispaxis=None, order=2
         ax1_1d = fig1D.add_subplot(211)
         ax2_1d = fig1D.add_subplot(212)
 
+        pad = savgol_window // 2 + 1
         flat1D = np.nanmedian(flat, 2-dispaxis)
         f1d = signal.savgol_filter(flat1D[x1:x2], savgol_window, 2)
         sig1d = 1.5*mad(flat1D[x1:x2] - f1d)
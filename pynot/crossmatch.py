@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+"""
+Cross-matching of source catalogs on the sky.
+
+The positions are converted to unit vectors on the sphere and stored in a KD-tree
+(`scipy.spatial.cKDTree`), such that all sources are matched at once instead of
+calculating the distance to every reference source for each source.
+The functions return index arrays into the input catalogs rather than new tables.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def radec_to_xyz(ra, dec):
+    """Convert right ascension and declination in degrees to unit vectors of shape (N, 3)"""
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)])
+
+
+def chord_to_arcsec(chord):
+    """Convert the distance between unit vectors to angular separation in arcsec"""
+    return np.degrees(2*np.arcsin(np.clip(chord/2, 0., 1.))) * 3600
+
+
+def arcsec_to_chord(radius):
+    """Convert angular separation in arcsec to the distance between unit vectors"""
+    return 2*np.sin(np.radians(radius / 3600.)/2)
+
+
+class CatalogTree(object):
+    """
+    KD-tree of the positions of a reference catalog.
+
+    Parameters
+    ==========
+    ra, dec : array_like
+        Right ascension and declination of the reference sources in degrees
+    """
+    def __init__(self, ra, dec):
+        self.tree = cKDTree(radec_to_xyz(ra, dec))
+
+    def __len__(self):
+        return self.tree.n
+
+    def query_nearest(self, ra, dec, match_radius=None):
+        """
+        Find the nearest reference source of each position.
+
+        Parameters
+        ==========
+        ra, dec : array_like
+            Right ascension and declination of the sources in degrees
+
+        match_radius : float  [default=None]
+            Maximum separation in arcsec. If given, only sources with a reference source
+            within `match_radius` are returned.
+
+        Returns
+        =======
+        index : np.array(int)
+            Index of the sources which have a match
+
+        ref_index : np.array(int)
+            Index of the nearest reference source of each source in `index`
+
+        dist : np.array(float)
+            Angular separation in arcsec between the source and the reference source
+        """
+        xyz = radec_to_xyz(ra, dec)
+        index = np.arange(len(xyz))
+        if len(xyz) == 0 or len(self) == 0:
+            return index[:0], index[:0], np.zeros(0)
+
+        if match_radius is None:
+            chord, ref_index = self.tree.query(xyz)
+        else:
+            chord, ref_index = self.tree.query(xyz, distance_upper_bound=arcsec_to_chord(match_radius))
+            # Sources without a match are returned with infinite distance:
+            matched = np.isfinite(chord)
+            index = index[matched]
+            chord = chord[matched]
+            ref_index = ref_index[matched]
+        return index, ref_index, chord_to_arcsec(chord)
+
+    def query_radius(self, ra, dec, radius):
+        """
+        Find all reference sources within `radius` (arcsec) of each position.
+
+        Returns
+        =======
+        ref_indices : list(list(int))
+            Indices of the reference sources within `radius` for each position
+        """
+        xyz = radec_to_xyz(ra, dec)
+        if len(xyz) == 0:
+            return []
+        return self.tree.query_ball_point(xyz, arcsec_to_chord(radius))
+
+    def has_match(self, ra, dec, radius):
+        """Boolean array which is True for the positions with a reference source within `radius` (arcsec)"""
+        matched = np.zeros(len(np.atleast_1d(ra)), dtype=bool)
+        index, _, _ = self.query_nearest(ra, dec, match_radius=radius)
+        matched[index] = True
+        return matched
+
+
+def match_nearest(ra, dec, ref_ra, ref_dec, match_radius=None):
+    """
+    Match each source to the nearest source in the reference catalog.
+
+    Parameters
+    ==========
+    ra, dec : array_like
+        Right ascension and declination of the sources in degrees
+
+    ref_ra, ref_dec : array_like
+        Right ascension and declination of the reference sources in degrees
+
+    match_radius : float  [default=None]
+        Maximum separation in arcsec. By default, all sources are matched.
+
+    Returns
+    =======
+    index : np.array(int)
+        Index of the matched sources
+
+    ref_index : np.array(int)
+        Index of the matched reference source of each source in `index`
+
+    dist : np.array(float)
+        Angular separation in arcsec of the matched pairs
+    """
+    tree = CatalogTree(ref_ra, ref_dec)
+    return tree.query_nearest(ra, dec, match_radius=match_radius)
+
+
+def find_unmatched(ra, dec, ref_ra, ref_dec, radius):
+    """Boolean array which is True for the sources without a reference source within `radius` (arcsec)"""
+    tree = CatalogTree(ref_ra, ref_dec)
+    return ~tree.has_match(ra, dec, radius)
@@ -0,0 +1,229 @@
+# -*- coding: UTF-8 -*-
+"""
+Association of the science frames with their calibrations.
+
+The header metadata of the calibration files of each filetype are collected in arrays
+(`CalibrationTable`) such that all science frames are matched against them at once
+instead of reading and comparing the headers for every science frame.
+The resulting `CalibrationPlan` holds the calibrations of each science frame and is saved
+as a table next to the file classification table, see `get_plan_fname`.
+"""
+
+from astropy.io import fits
+from astropy.time import Time
+import numpy as np
+import os
+
+# Calibrations and the criteria used to match them to each filetype of science frame.
+# The criteria are the same as for `RawImage.match_files`.
+association_rules = {
+    'SPEC_OBJECT': [('MBIAS', dict(date=False)),
+                    ('NORM_SFLAT', dict(date=False, grism=True, slit=True, filter=True)),
+                    ('ARC_CORR', dict(date=False, grism=True, slit=True, get_closest_time=True)),
+                    ('RESPONSE', dict(date=False, binning=False, shape=False, grism=True, get_closest_time=True)),
+                    ],
+    'SPEC_FLUX-STD': [('MBIAS', dict(date=False)),
+                      ('NORM_SFLAT', dict(date=False, grism=True, slit=True, filter=True)),
+                      ('ARC_CORR', dict(date=False, grism=True, slit=False, filter=True, get_closest_time=True)),
+                      ],
+}
+
+
+def get_plan_fname(pfc_fname):
+    """Filename of the calibration plan belonging to the file classification table `pfc_fname`"""
+    base, _ = os.path.splitext(pfc_fname)
+    return base + '.plan'
+
+
+class CalibrationTable(object):
+    """
+    Header metadata of a list of calibration files as arrays.
+
+    Parameters
+    ==========
+    files : list(str)
+        Filenames of the calibration files
+
+    mjd : array_like
+        Modified Julian date of each file (NaN if unknown)
+
+    binning, grism, slit, filter : array_like
+        CCD setup, grism, slit and filter of each file (None if unknown)
+
+    shape : list(tuple)
+        Image shape (before overscan subtraction) of each file (None if unknown)
+    """
+    def __init__(self, files, mjd, binning, shape, grism, slit, filter):
+        self.files = np.array(files, dtype=object)
+        self.mjd = np.array(mjd, dtype=float)
+        self.binning = np.array(binning, dtype=object)
+        self.grism = np.array(grism, dtype=object)
+        self.slit = np.array(slit, dtype=object)
+        self.filter = np.array(filter, dtype=object)
+        self.ny = np.array([s[0] if s else -1 for s in shape], dtype=int)
+        self.nx = np.array([s[1] if s else -1 for s in shape], dtype=int)
+
+    @classmethod
+    def from_index(cls, files, index):
+        """Create the table from the records of the metadata `index` (see `MetadataIndex`)"""
+        records = index.get_records(files)
+        columns = {key: list() for key in ['mjd', 'binning', 'shape', 'grism', 'slit', 'filter']}
+        for fname in files:
+            for key in columns:
+                columns[key].append(records[fname][key])
+        columns['mjd'] = [np.nan if mjd is None else mjd for mjd in columns['mjd']]
+        return cls(files, **columns)
+
+    @classmethod
+    def from_response_files(cls, files):
+        """
+        Create the table for response functions. These are PyNOT products,
+        the grism and date are taken from the keywords 'GRISM' and 'DATE-OBS'.
+        """
+        grism = list()
+        mjd = list()
+        for fname in files:
+            hdr = fits.getheader(fname)
+            grism.append(hdr['GRISM'])
+            mjd.append(Time(hdr['DATE-OBS']).mjd)
+        N = len(files)
+        return cls(files, mjd, [None]*N, [None]*N, grism, [None]*N, [None]*N)
+
+    def __len__(self):
+        return len(self.files)
+
+    def match(self, img, date=True, binning=True, shape=True, grism=False, slit=False, filter=False,
+              get_closest_time=False):
+        """
+        Return list of filenames that match the raw image `img` given the criteria.
+        The criteria are the same as for `RawImage.match_files`.
+        """
+        matches = np.ones(len(self), dtype=bool)
+        if date:
+            # Match files from same night, midnight ± 9hr
+            dt = img.mjd - self.mjd
+            matches &= (-0.4 < dt) & (dt < +0.4)
+        if binning:
+            matches &= self.binning == img.binning
+        if shape:
+            matches &= (self.ny == img.shape[0]) & (self.nx == img.shape[1])
+        if grism:
+            matches &= self.grism == img.grism
+        if slit:
+            matches &= self.slit == img.slit
+        if filter:
+            matches &= self.filter == img.filter
+
+        indices = np.nonzero(matches)[0]
+        if get_closest_time and len(indices) > 0:
+            # The first file in the list is used if two files are equally close in time:
+            idx = np.argmin(np.abs(self.mjd[indices] - img.mjd))
+            indices = indices[idx:idx+1]
+        return list(self.files[indices])
+
+    def match_single(self, img, **criteria):
+        """
+        Return the single file that matches the raw image `img`, as `match_single_calib`:
+        if more than one file matches, the file closest in time is used.
+        Returns None if no file matches.
+        """
+        matches = self.match(img, **criteria)
+        if len(matches) > 1:
+            criteria['get_closest_time'] = True
+            matches = self.match(img, **criteria)
+        if len(matches) != 1:
+            return None
+        return matches[0]
+
+
+class CalibrationPlan(dict):
+    """
+    The calibrations of each science frame: a dictionary with the calibration filename
+    for each filetype (None if no calibration matched) for each science filename.
+    """
+    def __init__(self, plan=None, filetypes=None):
+        if plan is None:
+            plan = {}
+        if filetypes is None:
+            filetypes = {}
+        dict.__init__(self, plan)
+        self.filetypes = filetypes
+
+    def update(self, other):
+        dict.update(self, other)
+        self.filetypes.update(other.filetypes)
+
+    def get_calibration(self, sci_img, tag, log=None):
+        """
+        Return the calibration of filetype `tag` of the raw science image `sci_img`.
+        Raises a KeyError if no calibration was matched.
+        """
+        calib_fname = self.get(sci_img.filename, {}).get(tag)
+        if calib_fname is None:
+            if log:
+                log.error("Could not match filetype %s" % tag)
+                log.error("Check that the filetype exists in the PFC database")
+            raise KeyError("Could not match filetype %s" % tag)
+        return calib_fname
+
+    def save(self, output_fname):
+        """Save the calibration plan as a table with a section for each filetype of science frames"""
+        with open(output_fname, 'w') as output:
+            output.write("## PyNOT Calibration Plan\n\n")
+            for filetype, rules in association_rules.items():
+                filenames = sorted([fname for fname, ftype in self.filetypes.items() if ftype == filetype])
+                if len(filenames) == 0:
+                    continue
+                tags = [tag for tag, _ in rules]
+                header_names = ['FILENAME'] + tags
+                rows = list()
+                for fname in filenames:
+                    calibs = self[fname]
+                    row = [fname] + [calibs.get(tag) or '-' for tag in tags]
+                    rows.append(row)
+                max_len = [max(len(row[i]) for row in rows + [header_names]) for i in range(len(header_names))]
+                line_fmt = "  ".join(["%-{}s".format(n) for n in max_len])
+                output.write("## %s:\n" % filetype)
+                output.write(('## ' + line_fmt % tuple(header_names)).rstrip() + '\n')
+                for row in rows:
+                    output.write((' ' + line_fmt % tuple(row)).rstrip() + '\n')
+                output.write("\n")
+
+
+def plan_calibrations(images, database, filetype='SPEC_OBJECT'):
+    """
+    Associate the raw science images with their calibrations.
+
+    Parameters
+    ==========
+    images : list(:class:`pynot.data.organizer.RawImage`)
+        The raw science frames
+
+    database : :class:`pynot.data.organizer.TagDatabase`
+        The file classification database with the calibration files
+
+    filetype : string  [default='SPEC_OBJECT']
+        Filetype of the science frames, determines the calibrations and the criteria
+        used to match them, see `association_rules`.
+
+    Returns
+    =======
+    plan : :class:`CalibrationPlan`
+        The calibrations of each science frame
+    """
+    tables = dict()
+    for tag, _ in association_rules[filetype]:
+        files = database.get(tag, [])
+        if tag == 'RESPONSE':
+            tables[tag] = CalibrationTable.from_response_files(files)
+        else:
+            tables[tag] = CalibrationTable.from_index(files, database.index)
+
+    plan = CalibrationPlan()
+    for img in images:
+        calibs = dict()
+        for tag, criteria in association_rules[filetype]:
+            calibs[tag] = tables[tag].match_single(img, **criteria)
+        plan[img.filename] = calibs
+        plan.filetypes[img.filename] = filetype
+    return plan
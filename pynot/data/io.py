@@ -8,6 +8,7 @@ from astropy.io import fits
 import numpy as np
 
 from pynot.data.organizer import TagDatabase
+from pynot.data.metaindex import MetadataIndex, get_index_fname
 from pynot import instrument
 
 veclen = np.vectorize(len)
@@ -35,7 +36,12 @@ def get_header_info(fname):
 
 
 def save_database(database, output_fname):
-    """Save file database to file."""
+    """
+    Save file database to file.
+    The header metadata index of the database is saved next to the file, see `get_index_fname`.
+    """
+    index = database.index
+    index.save(get_index_fname(output_fname))
     with open(output_fname, 'w') as output:
         output.write("## PyNOT File Classification Table\n\n")
         for filetype, files in sorted(database.items()):
@@ -43,18 +49,17 @@ def save_database(database, output_fname):
             file_list = list()
             files += database.inactive.get(filetype, [])
             sorted_files = sorted(files, key=lambda x: x[1:] if len(x) > 1 else x)
-            for fname in sorted_files:
-                try:
-                    if fname[0] == '#':
-                        object, exptime, grism, slit, filter, shape = get_header_info(fname[1:])
-                    else:
-                        object, exptime, grism, slit, filter, shape = get_header_info(fname)
-                except FileNotFoundError:
+            paths = [fname[1:] if fname[0] == '#' else fname for fname in sorted_files]
+            records = index.get_records(paths, skip_missing=True)
+            for fname, path in zip(sorted_files, paths):
+                if path not in records:
                     print("[WARNING] - File not found: %s" % fname)
                     continue
-                except Exception:
+                summary = records[path]['summary']
+                if summary is None:
                     print("[WARNING] - Problem reading header information: %s" % fname)
-                    object, exptime, grism, slit, filter, shape = '-', '-', '-', '-', '-', '-'
+                    summary = ['-', '-', '-', '-', '-', '-']
+                object, exptime, grism, slit, filter, shape = summary
                 file_list.append((fname, filetype, object, exptime, grism, slit, filter, shape))
             file_list = np.array(file_list, dtype=str)
             if len(file_list) == 0:
@@ -74,7 +79,7 @@ def save_database(database, output_fname):
 
 
 def load_database(input_fname):
-    """Load file database from file."""
+    """Load file database from file together with its header metadata index."""
     all_lines = np.loadtxt(input_fname, dtype=str, usecols=(0, 1), comments='##')
     # file_database = {key: val for key, val in all_lines}
     # inactive_files = {key: val for key, val in all_lines}
@@ -85,4 +90,5 @@ def load_database(input_fname):
             inactive_files[fname] = ftype
         else:
             file_database[fname] = ftype
-    return TagDatabase(file_database, inactive_files)
+    index = MetadataIndex(get_index_fname(input_fname))
+    return TagDatabase(file_database, inactive_files, index=index)
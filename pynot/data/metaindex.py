@@ -0,0 +1,285 @@
+# -*- coding: UTF-8 -*-
+"""
+Persistent index of the header metadata of the files in a dataset.
+
+The file classification table (.pfc) only holds the filenames and their filetypes.
+The header information needed to match calibrations and to write the classification table
+(grism, slit, filter, date, binning, image shape, etc.) is kept in an SQLite database
+next to the .pfc file, such that each header is only read once. The index is filled when
+the files are classified and the entries are read again when the modification time
+or the size of a file changes.
+"""
+
+from astropy.io import fits
+from collections import ChainMap
+import json
+import os
+import sqlite3
+
+from pynot import instrument
+
+# Increase when the content of the metadata records changes:
+index_version = 1
+
+# Metadata of each file:
+metadata_keys = ['target', 'grism', 'slit', 'filter', 'date', 'mjd', 'binning', 'shape', 'summary']
+
+
+def get_index_fname(pfc_fname):
+    """Filename of the metadata index belonging to the file classification table `pfc_fname`"""
+    base, _ = os.path.splitext(pfc_fname)
+    return base + '.sqlite'
+
+
+def _get_value(func, hdr):
+    try:
+        return func(hdr)
+    except Exception:
+        return None
+
+
+def _get_shape(hdr):
+    # Use the original image shape before overscan subtraction:
+    shape = [hdr['NAXIS2'], hdr['NAXIS1']]
+    if 'OVERSCAN' in hdr:
+        shape = [shape[0] + hdr['OVERSCAN_Y'], shape[1] + hdr['OVERSCAN_X']]
+    return shape
+
+
+def _get_date(hdr):
+    date = instrument.get_date(hdr)
+    if 'T' in date:
+        date = date.split('T')[0]
+    return date
+
+
+def _get_summary(hdr, ins_hdr):
+    # Columns of the file classification table: object, exptime, grism, slit, filter, shape
+    if hdr['INSTRUME'] == 'PyNOT':
+        return [hdr['OBJECT'], str(hdr['EXPTIME']), hdr['GRISM'], hdr['SLIT'], '...', '...']
+    return [instrument.get_object(ins_hdr),
+            "%.1f" % instrument.get_exptime(ins_hdr),
+            instrument.get_grism(ins_hdr),
+            instrument.get_slit(ins_hdr),
+            instrument.get_filter(ins_hdr),
+            "%ix%i" % (ins_hdr['NAXIS1'], ins_hdr['NAXIS2'])]
+
+
+def _find_end_card(block):
+    for num in range(0, 2880, 80):
+        keyword = block[num:num+8]
+        if keyword == b'END     ':
+            return True
+    return False
+
+
+def read_extension_shape(fname, header):
+    """
+    Return the NAXIS1 and NAXIS2 keywords of the first extension of the FITS file `fname`
+    as a dictionary, or None if the file has no extension. `header` is the primary header.
+    Only the raw header cards are scanned, the extension header is not parsed.
+    """
+    data_size = 0
+    if header.get('NAXIS', 0) > 0:
+        data_size = abs(header['BITPIX']) // 8
+        for num in range(1, header['NAXIS'] + 1):
+            data_size *= header['NAXIS%i' % num]
+    with open(fname, 'rb') as fileobj:
+        # Skip the primary header and data:
+        block = fileobj.read(2880)
+        while len(block) == 2880 and not _find_end_card(block):
+            block = fileobj.read(2880)
+        fileobj.seek(-(-data_size // 2880) * 2880, 1)
+        block = fileobj.read(2880)
+        if not block.startswith(b'XTENSION'):
+            return None
+        shape = dict()
+        while len(block) == 2880:
+            for num in range(0, 2880, 80):
+                keyword = block[num:num+8].rstrip()
+                if keyword in (b'NAXIS1', b'NAXIS2'):
+                    shape[keyword.decode()] = int(block[num+10:num+80].split(b'/')[0])
+                elif keyword == b'END':
+                    return shape
+            block = fileobj.read(2880)
+    return shape
+
+
+def get_file_id(fname):
+    """Modification time (ns) and size of the file `fname` used to invalidate the index"""
+    stat = os.stat(fname)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def read_metadata(fname, header=None, ext_header=None):
+    """
+    Read the header metadata of the FITS file `fname`.
+    Values that cannot be determined from the header are set to None.
+
+    Parameters
+    ==========
+    fname : string
+        Filename of the FITS file
+
+    header : astropy.io.fits.Header  [default=None]
+        The primary header of `fname` if it has already been read
+
+    ext_header : astropy.io.fits.Header or dict  [default=None]
+        The header (or the NAXIS1 and NAXIS2 keywords from `read_extension_shape`)
+        of the image extension of `fname` if it has already been read.
+        Its keywords take precedence over the primary header as in `instrument.get_header`.
+
+    Returns
+    =======
+    metadata : dict
+        The header metadata with the keys given in `metadata_keys`
+    """
+    if header is None:
+        header = fits.getheader(fname)
+    hdr = header
+    metadata = dict()
+    metadata['target'] = _get_value(instrument.get_object, hdr)
+    metadata['grism'] = _get_value(instrument.get_grism, hdr)
+    metadata['slit'] = _get_value(instrument.get_slit, hdr)
+    metadata['filter'] = _get_value(instrument.get_filter, hdr)
+    metadata['date'] = _get_value(_get_date, hdr)
+    metadata['mjd'] = _get_value(instrument.get_mjd, hdr)
+    metadata['binning'] = _get_value(instrument.get_binning_from_hdr, hdr)
+    if hdr.get('INSTRUME') == 'PyNOT' or hdr.get('NAXIS', 0) >= 2:
+        # The image is in the primary extension, no need to read the header again:
+        ins_hdr = hdr
+    elif ext_header is not None:
+        # Look up the keywords without copying and merging the headers:
+        ins_hdr = ChainMap(ext_header, hdr)
+    else:
+        ins_hdr = _get_value(instrument.get_header, fname)
+    if ins_hdr is None:
+        metadata['shape'] = None
+        metadata['summary'] = None
+    else:
+        metadata['shape'] = _get_value(_get_shape, ins_hdr)
+        try:
+            metadata['summary'] = _get_summary(hdr, ins_hdr)
+        except Exception:
+            metadata['summary'] = None
+    return metadata
+
+
+class MetadataIndex(object):
+    """
+    Index of header metadata stored in the SQLite database `fname`.
+    By default the index is only kept in memory until it is saved using `save`.
+    """
+    def __init__(self, fname=':memory:'):
+        self.filename = fname
+        self._connect()
+
+    def _connect(self):
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        with self.connection:
+            if version != index_version:
+                self.connection.execute("DROP TABLE IF EXISTS files")
+                self.connection.execute("PRAGMA user_version = %i" % index_version)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files "
+                                    "(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, metadata TEXT)")
+
+    def get_records(self, filelist, skip_missing=False):
+        """
+        Return the header metadata of the files in `filelist`.
+        Files which are not in the index or which have changed since they were indexed
+        are read and added to the index.
+
+        Parameters
+        ==========
+        filelist : list(str)
+            List of filenames
+
+        skip_missing : bool  [default=False]
+            Leave out files that do not exist instead of raising a FileNotFoundError
+
+        Returns
+        =======
+        records : dict
+            The metadata (see `read_metadata`) of each filename in `filelist`
+        """
+        records = dict()
+        new_records = dict()
+        for fname in filelist:
+            if fname in records:
+                continue
+            path = os.path.abspath(fname)
+            try:
+                file_id = get_file_id(path)
+            except FileNotFoundError:
+                if skip_missing:
+                    continue
+                raise
+            row = self.connection.execute("SELECT mtime_ns, size, metadata FROM files WHERE path = ?",
+                                          (path,)).fetchone()
+            if row is not None and row[:2] == file_id:
+                records[fname] = json.loads(row[2])
+            else:
+                metadata = read_metadata(path)
+                records[fname] = metadata
+                new_records[path] = (file_id, metadata)
+
+        self.add_records(new_records)
+        return records
+
+    def add_records(self, records):
+        """
+        Add the metadata of files that have already been read to the index.
+        `records` is a dictionary of `(file_id, metadata)` for each filename,
+        where `file_id` is given by `get_file_id` at the time the header was read.
+        """
+        rows = list()
+        for fname, (file_id, metadata) in records.items():
+            rows.append((os.path.abspath(fname), file_id[0], file_id[1], json.dumps(metadata)))
+        if rows:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+
+    def get(self, fname):
+        """Return the header metadata of the file `fname`"""
+        return self.get_records([fname])[fname]
+
+    def update(self, filelist):
+        """Add the files in `filelist` to the index if they are not already indexed"""
+        self.get_records(filelist)
+
+    def merge(self, other):
+        """Add the entries of the index `other` to this index"""
+        if other is self:
+            return
+        rows = other.connection.execute("SELECT * FROM files").fetchall()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+
+    def save(self, fname):
+        """Save the index to the SQLite database `fname` and keep using the database file"""
+        if os.path.abspath(fname) == os.path.abspath(self.filename):
+            self.connection.commit()
+            return
+        output = sqlite3.connect(fname, timeout=60)
+        with output:
+            self.connection.backup(output)
+        output.close()
+        self.connection.close()
+        self.filename = fname
+        self._connect()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def __getstate__(self):
+        # The connection cannot be pickled (e.g., when passed to worker processes).
+        # An index in memory is passed on as an empty index.
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._connect()
+
+    def __repr__(self):
+        return "<MetadataIndex: %s  %i files>" % (self.filename, len(self))
@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import os
 import sys
@@ -14,6 +15,7 @@ import re
 from pynot.response import lookup_std_star
 from pynot import instrument
 from pynot.fitsio import verify_header_key
+from pynot.data.metaindex import MetadataIndex, get_file_id, read_extension_shape, read_metadata
 
 # -- use os.path
 code_dir = os.path.dirname(os.path.abspath(__file__))
@@ -111,11 +113,11 @@ def match_response(sci_img, file_list, exact_date=False):
 
 
 def match_single_calib(raw_img, database, tag, log, **kwargs):
-    calib_list = raw_img.match_files(database[tag], **kwargs)
+    calib_list = raw_img.match_files(database[tag], index=database.index, **kwargs)
 
     if len(calib_list) > 1:
         kwargs['get_closest_time'] = True
-        calib_list = raw_img.match_files(database[tag], **kwargs)
+        calib_list = raw_img.match_files(database[tag], index=database.index, **kwargs)
 
     if len(calib_list) != 1:
         log.error("Could not match filetype %s" % tag)
@@ -251,104 +253,150 @@ def get_unclassified_files(file_list, database):
     return missing_files
 
 
-def classify_file(fname, rules):
+class RuleCondition(object):
     """
-    Classify input FITS file according to the set of `rules`
+    Single condition of a classification rule, e.g., `EXPTIME < 0.01`,
+    with the header keyword and the value parsed once when the rules are compiled.
+    """
+    def __init__(self, condition, linenum, rule):
+        self.condition = condition
+        if '==' in condition:
+            self.operator = '=='
+        elif '!=' in condition:
+            self.operator = '!='
+        elif '>' in condition:
+            self.operator = '>'
+        elif '<' in condition:
+            self.operator = '<'
+        elif ' contains ' in condition:
+            self.operator = 'contains'
+        elif ' !contains ' in condition:
+            self.operator = '!contains'
+        else:
+            raise RuleFormatError("Invalid condition in rule at line %i:  %s" % (linenum, rule))
+
+        key, val = condition.split(self.operator)
+        self.key = verify_header_key(key)
+        # Shutter and aperture states are matched as substrings:
+        self.state = None
+        if self.operator in ['==', '!=']:
+            if 'open' in val.lower():
+                self.state = 'open'
+            elif 'closed' in val.lower():
+                self.state = 'closed'
+        if self.state is None:
+            self.value = parse_value(val)
+
+    def __call__(self, hdr):
+        if self.key not in hdr:
+            raise RuleCriterionError(self.key, self.condition)
+        hdr_value = hdr[self.key]
+        if self.operator == '==':
+            if self.state:
+                return self.state in hdr_value.lower()
+            return self.value == hdr_value
+        elif self.operator == '!=':
+            if self.state:
+                return self.state not in hdr_value.lower()
+            return self.value != hdr_value
+        elif self.operator == '>':
+            return hdr_value > self.value
+        elif self.operator == '<':
+            return hdr_value < self.value
+        elif self.operator == 'contains':
+            return self.value in hdr_value
+        else:
+            return self.value not in hdr_value
 
-    fname : string
+    def __repr__(self):
+        return "<RuleCondition: %s>" % self.condition.strip()
+
+
+class Rule(object):
+    """Classification rule: the filetype `ftype` and the list of conditions that must all be fulfilled"""
+    def __init__(self, ftype, conditions):
+        self.ftype = ftype
+        self.conditions = conditions
+
+    def __call__(self, hdr):
+        # All conditions are evaluated such that missing header keywords are always reported
+        criteria = [condition(hdr) for condition in self.conditions]
+        return all(criteria)
+
+    def __repr__(self):
+        return "<Rule: %s : %i conditions>" % (self.ftype, len(self.conditions))
+
+
+class RuleBook(list):
+    """List of compiled classification rules and the header keywords used by the rules"""
+    def __init__(self, rules):
+        list.__init__(self, rules)
+        self.keys = list()
+        for rule in self:
+            for condition in rule.conditions:
+                if condition.key not in self.keys:
+                    self.keys.append(condition.key)
+
+    def get_values(self, hdr):
+        """Read the values of the keywords used by the rules from the FITS header `hdr`"""
+        return {key: hdr[key] for key in self.keys if key in hdr}
+
+
+def compile_rules(rules):
+    """
+    Parse the lines of a classification rulebook into a list of rules.
 
     rules : list[string]
         A list of string conditions for header keywords. Each rule corresponds to one filetype:
-        e.g. BIAS, SPEC_FLAT, SPEC_OBJECT.
+        e.g. BIAS, SPEC_FLAT, SPEC_OBJECT. Lines containing '#' are ignored.
 
     Returns
     -------
-    ftype : string
-        Filetype that matches the given input file
+    rulebook : RuleBook
+        The compiled rules which can be passed to `classify_file` or `classify_header`
 
     Raises
     ------
-    MultipleFileTypeError : if more than one filetype matches the given file
-    NoFileTypeError : if no filetype matches the given file
     RuleFormatError : if one or more criteria in a rule cannot be parsed correctly
-    raised by fits.getheader : TypeError, IndexError, OSError, FileNotFoundError
-
     """
-    h = fits.getheader(fname)
-
-    matches = list()
+    rulebook = list()
     for linenum, rule in enumerate(rules):
+        if isinstance(rule, Rule):
+            rulebook.append(rule)
+            continue
         rule = rule.strip()
         if ('#' in rule) or (len(rule) == 0):
             continue
 
+        if ':' not in rule:
+            raise RuleFormatError("Invalid format of rule at line %i:  %s" % (linenum, rule))
         ftype = rule.split(':')[0].strip()
         all_conditions = rule.split(':')[1].split(' and ')
-        criteria = list()
-        for cond in all_conditions:
-            if '==' in cond:
-                key, val = cond.split('==')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                if 'open' in val.lower():
-                    criteria.append('open' in h[key].lower())
-                elif 'closed' in val.lower():
-                    criteria.append('closed' in h[key].lower())
-                else:
-                    val = parse_value(val)
-                    criteria.append(val == h[key])
-
-            elif '!=' in cond:
-                key, val = cond.split('!=')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                if 'open' in val.lower():
-                    criteria.append('open' not in h[key].lower())
-                elif 'closed' in val.lower():
-                    criteria.append('closed' not in h[key].lower())
-                else:
-                    val = parse_value(val)
-                    criteria.append(val != h[key])
-
-            elif '>' in cond:
-                key, val = cond.split('>')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                val = parse_value(val)
-                criteria.append(h[key] > val)
-
-            elif '<' in cond:
-                key, val = cond.split('<')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                val = parse_value(val)
-                criteria.append(h[key] < val)
-
-            elif ' contains ' in cond:
-                key, val = cond.split('contains')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                val = parse_value(val)
-                criteria.append(val in h[key])
-
-            elif ' !contains ' in cond:
-                key, val = cond.split('!contains')
-                key = verify_header_key(key)
-                if key not in h:
-                    raise RuleCriterionError(key, cond)
-                val = parse_value(val)
-                criteria.append(val not in h[key])
+        conditions = [RuleCondition(cond, linenum, rule) for cond in all_conditions]
+        rulebook.append(Rule(ftype, conditions))
+    return RuleBook(rulebook)
 
-            else:
-                raise RuleFormatError("Invalid condition in rule at line %i:  %s" % (linenum, rule))
 
-        if np.all(criteria):
-            matches.append(ftype)
+def load_rules(rule_file=instrument.rulefile):
+    """Load and compile the classification rules of the file `rule_file`"""
+    if not os.path.exists(rule_file):
+        raise FileNotFoundError("Instrument ruleset could not be found: %s" % rule_file)
+
+    with open(rule_file) as rulebook:
+        rules = rulebook.readlines()
+    return compile_rules(rules)
+
+
+def classify_header(h, rulebook, fname=''):
+    """
+    Classify the FITS header `h` of the file `fname` according to the compiled `rulebook`.
+    See `classify_file`.
+    """
+    values = rulebook.get_values(h)
+    matches = list()
+    for rule in rulebook:
+        if rule(values):
+            matches.append(rule.ftype)
 
     if len(matches) == 1:
         ftype = matches[0]
@@ -370,6 +418,35 @@ def classify_file(fname, rules):
         raise MultipleFileTypeError(err_msg, matches)
 
 
+def classify_file(fname, rules):
+    """
+    Classify input FITS file according to the set of `rules`
+
+    fname : string
+
+    rules : list[string] or list[Rule]
+        A list of string conditions for header keywords. Each rule corresponds to one filetype:
+        e.g. BIAS, SPEC_FLAT, SPEC_OBJECT. The rules can be compiled beforehand using
+        `compile_rules` when classifying many files.
+
+    Returns
+    -------
+    ftype : string
+        Filetype that matches the given input file
+
+    Raises
+    ------
+    MultipleFileTypeError : if more than one filetype matches the given file
+    NoFileTypeError : if no filetype matches the given file
+    RuleFormatError : if one or more criteria in a rule cannot be parsed correctly
+    raised by fits.getheader : TypeError, IndexError, OSError, FileNotFoundError
+
+    """
+    rulebook = compile_rules(rules)
+    h = fits.getheader(fname)
+    return classify_header(h, rulebook, fname)
+
+
 class RuleCriterionError(Exception):
     def __init__(self, key, condition):
         self.key = key
@@ -377,6 +454,9 @@ class RuleCriterionError(Exception):
         self.message = "Error in condition: %s. No FITS header key: %s" % (self.condition, self.key)
         super().__init__(self.message)
 
+    def __reduce__(self):
+        return (self.__class__, (self.key, self.condition))
+
 class RuleFormatError(Exception):
     pass
 
@@ -390,17 +470,83 @@ class MultipleFileTypeError(Exception):
         self.matches_str = ", ".join(matches)
         super().__init__(self.message)
 
+    def __reduce__(self):
+        return (self.__class__, (self.message, self.matches))
+
+
+def classify_files(files, rulebook):
+    """
+    Read the headers of the input `files` and classify them according to the compiled `rulebook`.
+    The header metadata of the classified files are returned for the `MetadataIndex`.
+
+    Returns
+    -------
+    results : list[tuple]
+        For each file a tuple of (fname, ftype, file_id, metadata, warning_msgs, error).
+        `ftype`, `file_id` and `metadata` are None if the file could not be classified.
+        `warning_msgs` is a list of messages if the classification is ambiguous or missing,
+        `error` is a message if the file could not be read.
+    """
+    results = list()
+    for fname in files:
+        ftype = file_id = metadata = None
+        warning_msgs = list()
+        error = ''
+        try:
+            file_id = get_file_id(fname)
+            with fits.open(fname) as hdu:
+                h = hdu[0].header
+                # if it passes then there's only one filetype
+                ftype = classify_header(h, rulebook, fname)
+                # The image shape is read from the extension only if the primary has no image:
+                ext_h = None
+                if h.get('INSTRUME') != 'PyNOT' and h.get('NAXIS', 0) < 2:
+                    ext_h = read_extension_shape(fname, h)
+                metadata = read_metadata(fname, header=h, ext_header=ext_h)
+
+        except NoFileTypeError as e:
+            warning_msgs.append(str(e))
+
+        except MultipleFileTypeError as e:
+            warning_msgs.append(str(e))
+            warning_msgs.append(e.matches_str)
+
+        except (TypeError, IndexError, OSError, FileNotFoundError) as e:
+            # error in file handling from astropy.io.fits
+            error = str(e)
+
+        results.append((fname, ftype, file_id, metadata, warning_msgs, error))
+    return results
+
 
-def classify(data_in, rule_file=instrument.rulefile, progress=True):
+def print_progress(num, total):
+    sys.stdout.write("\r  %6.2f%%" % (100.*num/total))
+    sys.stdout.flush()
+
+
+def classify(data_in, rule_file=instrument.rulefile, progress=True, workers=1, chunk_size=50):
     """
     The input can be a single .fits file, a string given the path to a directory,
     a list of .fits files, or a list of directories.
     Classify given input files using the rules defined in `rule_file`.
 
+    Parameters
+    ----------
+    progress : bool or callable  [default=True]
+        Print the progress of the classification. A function `progress(num, total)`
+        can be given instead, which is called with the number of files classified so far.
+
+    workers : int  [default=1]
+        Number of processes used to read and classify the headers
+
+    chunk_size : int  [default=50]
+        Number of files classified at a time by each process
+
     Returns
     -------
     database : TagDatabase or None
         An instance of TagDatabase containing the file classifications
+        and the header metadata index of the classified files
 
     output_msg : string
         A string of logging messages
@@ -428,41 +574,51 @@ def classify(data_in, rule_file=instrument.rulefile, progress=True):
 
     data_types = dict()
     not_classified_files = list()
+    records = dict()
 
-    if not os.path.exists(rule_file):
-        raise FileNotFoundError("Instrument ruleset could not be found: %s" % rule_file)
-
-    with open(rule_file) as rulebook:
-        rules = rulebook.readlines()
+    try:
+        rulebook = load_rules(rule_file)
+    except RuleFormatError as e:
+        msg.append(" [ERROR]  - " + str(e))
+        msg.append("")
+        return None, "\n".join(msg)
 
-    if progress:
+    if progress is True:
+        progress = print_progress
         print("")
         print(" Classifying files: ")
 
-    for num, fname in enumerate(files):
-        try:
-            # if it passes then there's only one filetype
-            ftype = classify_file(fname, rules)
-            data_types[fname] = ftype
-
-        except NoFileTypeError as e:
-            msg.append("[WARNING] - " + str(e))
-            not_classified_files.append(fname)
-
-        except MultipleFileTypeError as e:
-            msg.append("[WARNING] - " + str(e))
-            msg.append("[WARNING] - " + e.matches_str)
-            not_classified_files.append(fname)
-
-        except (RuleFormatError, TypeError, IndexError, OSError, FileNotFoundError) as e:
-            # error! either in file handling from astropy.io.fits or in rulebook
-            msg.append(" [ERROR]  - " + str(e))
-            msg.append("")
-            return None, "\n".join(msg)
+    chunks = [files[i:i+chunk_size] for i in range(0, len(files), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        all_results = executor.map(classify_files, chunks, [rulebook]*len(chunks))
+    else:
+        executor = None
+        all_results = (classify_files(chunk, rulebook) for chunk in chunks)
+
+    try:
+        num = 0
+        for results in all_results:
+            for fname, ftype, file_id, metadata, warning_msgs, error in results:
+                if error:
+                    msg.append(" [ERROR]  - " + error)
+                    msg.append("")
+                    return None, "\n".join(msg)
+
+                if ftype is None:
+                    for warning in warning_msgs:
+                        msg.append("[WARNING] - " + warning)
+                    not_classified_files.append(fname)
+                else:
+                    data_types[fname] = ftype
+                    records[fname] = (file_id, metadata)
 
-        if progress:
-            sys.stdout.write("\r  %6.2f%%" % (100.*(num+1)/len(files)))
-            sys.stdout.flush()
+            num += len(results)
+            if progress:
+                progress(num, len(files))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
     msg.append("")
     msg.append("          - Classification finished.")
@@ -476,7 +632,9 @@ def classify(data_in, rule_file=instrument.rulefile, progress=True):
     msg.append("")
     output_msg = "\n".join(msg)
 
-    database = TagDatabase(data_types)
+    index = MetadataIndex()
+    index.add_records(records)
+    database = TagDatabase(data_types, index=index)
 
     return database, output_msg
 
@@ -542,16 +700,23 @@ class UnknownObservingMode(Exception):
 class RawImage(object):
     """
     Create a raw image instance from a FITS image.
+    Only the header is read when the instance is created, the pixel data are read
+    from the file when the `data` attribute is accessed.
+    If `memmap` is True, the data are memory-mapped when possible.
 
     Raises:
     ValueError, UnknownObservingMode, OSError, FileNotFoundError, TypeError, IndexError
     """
-    def __init__(self, fname, filetype=None):
+    def __init__(self, fname, filetype=None, memmap=False):
         self.filename = fname
-        self.data = fits.getdata(fname)
-        self.shape = self.data.shape
+        self.memmap = memmap
+        self._data = None
         self.filetype = filetype
         self.header = instrument.get_header(fname)
+        if 'NAXIS1' in self.header and 'NAXIS2' in self.header:
+            self.shape = (self.header['NAXIS2'], self.header['NAXIS1'])
+        else:
+            self.shape = self.data.shape
         self.binning = instrument.get_binning_from_hdr(self.header)
         # file_root = fname.split('/')[-1]
         self.dispaxis = None
@@ -621,19 +786,44 @@ class RawImage(object):
         self.x_type = self.header['CTYPE1']
         self.y_type = self.header['CTYPE2']
 
+    @property
+    def data(self):
+        """The pixel data, read from the file on each access unless the data have been set"""
+        if self._data is not None:
+            return self._data
+        if self.memmap:
+            try:
+                return fits.getdata(self.filename, memmap=True)
+            except ValueError:
+                # Scaled integer data (BZERO/BSCALE) cannot be memory-mapped
+                pass
+        return fits.getdata(self.filename)
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
     def set_filetype(self, filetype):
         self.filetype = filetype
 
-    def match_files(self, filelist, date=True, binning=True, shape=True, grism=False, slit=False, filter=False, get_closest_time=False, debug=False):
-        """Return list of filenames that match the given criteria"""
+    def match_files(self, filelist, date=True, binning=True, shape=True, grism=False, slit=False, filter=False, get_closest_time=False, debug=False, index=None):
+        """
+        Return list of filenames that match the given criteria.
+        The header information is looked up in the metadata `index` (e.g., `TagDatabase.index`).
+        """
+        if index is None:
+            index = MetadataIndex()
+        records = index.get_records(filelist)
         matches = list()
         # sort by:
         all_times = list()
         for fname in filelist:
-            this_hdr = fits.getheader(fname, 0)
+            metadata = records[fname]
             criteria = list()
             criteria_name = list()
-            this_mjd = instrument.get_mjd(this_hdr)
+            this_mjd = metadata['mjd']
+            if this_mjd is None:
+                this_mjd = np.nan
             if date:
                 # Match files from same night, midnight ± 9hr
                 dt = self.mjd - this_mjd
@@ -642,39 +832,30 @@ class RawImage(object):
 
             if binning:
                 # Match files with same binning and readout speed:
-                this_binning = instrument.get_binning_from_hdr(this_hdr)
-                criteria.append(this_binning == self.binning)
+                criteria.append(metadata['binning'] == self.binning)
                 criteria_name.append('binning')
 
             if shape:
-                # Match files with same image shape:
-                hdr = instrument.get_header(fname)
-                this_shape = (hdr['NAXIS2'], hdr['NAXIS1'])
-                if 'OVERSCAN' in hdr:
-                    # use original image shape before overscan-sub
-                    over_x = hdr['OVERSCAN_X']
-                    over_y = hdr['OVERSCAN_Y']
-                    this_shape = (this_shape[0]+over_y, this_shape[1]+over_x)
-
+                # Match files with same image shape (before overscan-sub):
+                this_shape = metadata['shape']
+                if this_shape is not None:
+                    this_shape = tuple(this_shape)
                 criteria.append(this_shape == self.shape)
                 criteria_name.append('shape')
 
             if grism:
                 # Match files with same grism:
-                this_grism = instrument.get_grism(this_hdr)
-                criteria.append(this_grism == self.grism)
+                criteria.append(metadata['grism'] == self.grism)
                 criteria_name.append('grism')
 
             if slit:
                 # Match files with the same slit-width:
-                this_slit = instrument.get_slit(this_hdr)
-                criteria.append(this_slit == self.slit)
+                criteria.append(metadata['slit'] == self.slit)
                 criteria_name.append('slit')
 
             if filter:
                 # Match files with the same filter:
-                this_filter = instrument.get_filter(this_hdr)
-                criteria.append(this_filter == self.filter)
+                criteria.append(metadata['filter'] == self.filter)
                 criteria_name.append('filter')
 
             if np.all(criteria):
@@ -689,11 +870,15 @@ class RawImage(object):
 
 
 class TagDatabase(dict):
-    def __init__(self, file_database, inactive_files=None):
+    def __init__(self, file_database, inactive_files=None, index=None):
         # Convert file_database with file-classifications
         # to a tag_database containing a list of all files with a given tag:
         if inactive_files is None:
             inactive_files = {}
+        if index is None:
+            index = MetadataIndex()
+
+        self.index = index
 
         self.file_database = file_database
         self.inactive_file_database = inactive_files
@@ -722,7 +907,8 @@ class TagDatabase(dict):
         for fname, tag in other.inactive_file_database.items():
             self.inactive_file_database[fname] = tag
 
-        return TagDatabase(self.file_database, self.inactive_file_database)
+        self.index.merge(other.index)
+        return TagDatabase(self.file_database, self.inactive_file_database, index=self.index)
 
     def __radd__(self, other):
         if other == 0:
@@ -737,18 +923,26 @@ class TagDatabase(dict):
 
     def get_files(self, tag, grism=None, slit=None, filter=None, date=None, target=None, **kwargs):
         file_list = self.get(tag, [])
-        if grism:
-            file_list = filter_files(file_list, get_grism, grism)
-        if filter:
-            file_list = filter_files(file_list, get_filter, filter)
-        if slit:
-            file_list = filter_files(file_list, get_slit, slit)
-        if date:
-            file_list = filter_files(file_list, get_date, date)
-        if target:
-            file_list = filter_files(file_list, get_target, target)
+        criteria = [('grism', grism), ('filter', filter), ('slit', slit), ('date', date), ('target', target)]
+        criteria = [(key, value) for key, value in criteria if value]
+        if len(criteria) == 0:
+            return file_list
+
+        records = self.index.get_records(file_list)
+        for key, value in criteria:
+            file_list = filter_files(file_list, get_metadata_function(records, key), value)
         return file_list
 
+def get_metadata_function(records, key):
+    """Function returning the metadata `key` of a filename from the `records` of a MetadataIndex"""
+    def get_value(fname):
+        value = records[fname][key]
+        if value is None:
+            return ''
+        return value
+    return get_value
+
+
 def get_target(fname):
     hdr = fits.getheader(fname)
     return instrument.get_object(hdr)
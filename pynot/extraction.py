@@ -1,4 +1,5 @@
 # coding/PyNOT/multi_extract.py
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from astropy.io import fits
 from matplotlib.backends import backend_pdf
@@ -10,8 +11,9 @@ import warnings
 
 from lmfit import Parameters, minimize
 
-from pynot.functions import mad, NN_moffat, NN_gaussian, fix_nans, get_version_number
+from pynot.functions import mad, NN_moffat, NN_gaussian, NN_moffat_jac, NN_gaussian_jac, fix_nans, get_version_number
 from pynot import instrument
+from pynot.fitsio import read_fits_image
 
 __version__ = get_version_number()
 
@@ -85,6 +87,27 @@ def model_residuals(pars, x, y, N, model_name='moffat'):
     return y - trace_model(pars, x, N, model_name=model_name)
 
 
+def model_jacobian(pars, x, y, N, model_name='moffat'):
+    """
+    Analytic Jacobian of `model_residuals` with respect to the varying parameters.
+    The columns follow the order of the parameters in `pars`, as expected by `lmfit`
+    when passed as `Dfun` to `minimize`.
+    """
+    if model_name == 'gaussian':
+        par_names = ['mu', 'sig', 'logamp']
+        jac_func = NN_gaussian_jac
+    elif model_name == 'moffat':
+        par_names = ['mu', 'a', 'b', 'logamp']
+        jac_func = NN_moffat_jac
+    columns = {'bg': -np.ones_like(x)}
+    for i in range(N):
+        keys = ['%s_%i' % (name, i) for name in par_names]
+        jac = jac_func(x, *[pars[key].value for key in keys])
+        for key, dmodel in zip(keys, jac.T):
+            columns[key] = -dmodel
+    return np.column_stack([columns[name] for name, par in pars.items() if par.vary])
+
+
 def prep_parameters(peaks, prominence, size=np.inf, model_name='moffat'):
     values = zip(peaks, prominence)
     pars = Parameters()
@@ -112,12 +135,58 @@ def median_filter_data(x, kappa=5., window=21):
     return (med_x, mask)
 
 
-def fit_trace(img2D, x, y, model_name='moffat', dx=50, kappa=10., ymin=5, ymax=-5, xmin=None, xmax=None):
+def fit_trace_bins(columns, y, col_mask, peaks, prominences, model_name='moffat', warm_start=False):
+    """
+    Fit the spatial profile of each binned column in `columns` one after another.
+    If `warm_start` is True, the fit of a column is initiated from the solution
+    of the previous column, otherwise from the detected `peaks` and `prominences`.
+
+    Returns
+    =======
+    trace_parameters : list(lmfit.Parameters)
+        The fitted parameters for each column. Parameters without uncertainty are given an error of 100.
+    """
+    N_obj = len(peaks)
+    trace_parameters = list()
+    previous = None
+    for col in columns:
+        if warm_start and previous is not None:
+            pars = previous.copy()
+        else:
+            pars = prep_parameters(peaks, prominences, size=len(y), model_name=model_name)
+        try:
+            popt = minimize(model_residuals, pars, args=(y[col_mask], col[col_mask], N_obj),
+                            kws={'model_name': model_name}, Dfun=model_jacobian)
+            for par_val in popt.params.values():
+                if par_val.stderr is None:
+                    par_val.stderr = 100.
+            trace_parameters.append(popt.params)
+            previous = popt.params if popt.success else None
+        except ValueError:
+            for par_val in pars.values():
+                par_val.stderr = 100.
+            trace_parameters.append(pars)
+            previous = None
+    return trace_parameters
+
+
+def _fit_trace_block(args):
+    columns, y, col_mask, peaks, prominences, model_name, warm_start = args
+    return fit_trace_bins(columns, y, col_mask, peaks, prominences, model_name=model_name, warm_start=warm_start)
+
+
+def fit_trace(img2D, x, y, model_name='moffat', dx=50, kappa=10., ymin=5, ymax=-5, xmin=None, xmax=None,
+              warm_start=False, workers=1):
     """
     Perform automatic localization of the trace if possible, otherwise use fixed
     aperture to extract the 1D spectrum.
     The spectra are assumed to be horizontal. Check orientation before passing img2D!
     When fitting the trace, reject pixels in a column below `ymin` and above `ymax`.
+
+    If `warm_start` is True, each bin of `dx` columns is fitted starting from the solution
+    of the previous bin instead of the initial peak detection. If `workers` is larger than 1,
+    the bins are split into `workers` contiguous blocks which are fitted in parallel.
+    The first bin of each block is always fitted from the initial peak detection.
     """
     msg = list()
     if not xmin:
@@ -158,33 +227,74 @@ def fit_trace(img2D, x, y, model_name='moffat', dx=50, kappa=10., ymin=5, ymax=-
 
     # Fit trace with N objects:
     msg.append("          - Fitting the spectral trace with a %s profile" % model_name.title())
-    trace_parameters = list()
+    if warm_start:
+        msg.append("          - Starting the fit of each bin from the solution of the previous bin")
     x_binned = np.arange(0., img2D.shape[1], dx, dtype=np.float64)
-    for num in range(0, img2D.shape[1], dx):
-        pars = prep_parameters(peaks, prominences, size=img2D.shape[0], model_name=model_name)
-        col = np.nanmean(img2D[:, num:num+dx], axis=1)
-        col_mask = np.ones_like(col, dtype=bool)
-        col_mask[:ymin] = 0.
-        col_mask[ymax:] = 0.
-        try:
-            popt = minimize(model_residuals, pars, args=(y[col_mask], col[col_mask], N_obj),
-                            kws={'model_name': model_name})
-            for par_val in popt.params.values():
-                if par_val.stderr is None:
-                    par_val.stderr = 100.
-            trace_parameters.append(popt.params)
-        except ValueError:
-            for par_val in pars.values():
-                par_val.stderr = 100.
-            trace_parameters.append(pars)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        columns = [np.nanmean(img2D[:, num:num+dx], axis=1) for num in range(0, img2D.shape[1], dx)]
+    col_mask = np.ones(img2D.shape[0], dtype=bool)
+    col_mask[:ymin] = 0.
+    col_mask[ymax:] = 0.
+    workers = min(workers, len(columns))
+    if workers > 1:
+        blocks = [(block, y, col_mask, peaks, prominences, model_name, warm_start)
+                  for block in np.array_split(np.array(columns), workers)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            trace_parameters = sum(executor.map(_fit_trace_block, blocks), [])
+    else:
+        trace_parameters = fit_trace_bins(columns, y, col_mask, peaks, prominences,
+                                          model_name=model_name, warm_start=warm_start)
     msg.append("          - Fitted %i points along the spectral trace" % len(trace_parameters))
     output_msg = "\n".join(msg)
     return (x_binned, N_obj, trace_parameters, fwhm, output_msg)
 
 
+class BandedProfile(object):
+    """
+    Spatial profile of a trace stored in a band of rows around the trace.
+    Column `i` of `data` holds the profile of the image rows `row_start[i]` to `row_start[i] + height - 1`.
+    The profile is zero outside the band.
+
+    shape : tuple (M, N)
+        Shape of the full image
+    """
+    def __init__(self, row_start, height, shape):
+        self.shape = shape
+        self.row_start = np.asarray(row_start, dtype=int)
+        self.rows = self.row_start[np.newaxis, :] + np.arange(height)[:, np.newaxis]
+        self.columns = np.arange(shape[1])[np.newaxis, :]
+        self.data = np.zeros(self.rows.shape)
+
+    @classmethod
+    def around(cls, center, half_width, shape):
+        """Band of ±`half_width` pixels around the trace `center` of each column, kept within the image"""
+        half_width = int(np.ceil(half_width))
+        height = 2*half_width + 2
+        if height >= shape[0]:
+            return cls(np.zeros(shape[1]), shape[0], shape)
+        row_start = np.clip(np.floor(center).astype(int) - half_width, 0, shape[0] - height)
+        return cls(row_start, height, shape)
+
+    def normalize(self):
+        """Normalize the profile of each column to unit sum"""
+        self.data /= np.sum(self.data, axis=0)
+
+    def take(self, img2D):
+        """Pixels of the 2D image `img2D` within the band"""
+        return img2D[self.rows, self.columns]
+
+    def toarray(self):
+        """The profile as a full 2D image"""
+        profile2D = np.zeros(self.shape)
+        profile2D[self.rows, self.columns] = self.data
+        return profile2D
+
+
 def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_det=10.,
                       xmin=None, xmax=None, ymin=None, ymax=None, order_center=3, order_width=0,
-                      w_cen=15, kappa_cen=3., w_width=21, kappa_width=3.):
+                      w_cen=15, kappa_cen=3., w_width=21, kappa_width=3., band_width=10.,
+                      warm_start=False, workers=1):
     """
     img2D : np.array(M, N)
         Input image with dispersion along x-axis!
@@ -225,9 +335,19 @@ def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_de
         Threshold for median filtering. Reject outliers above: ±`kappa` * sigma,
         where sigma is the robust standard deviation of the data points.
 
+    band_width : float  [default=10]
+        The Moffat and Gaussian profiles are calculated within ±`band_width` times
+        the maximal FWHM of the trace from the centroid
+
+    warm_start : bool  [default=False]
+        Start the fit of each bin along the trace from the solution of the previous bin
+
+    workers : int  [default=1]
+        Number of processes used to fit the bins along the trace
+
     Returns
     -------
-    trace_models_2d : list(np.array(M, N))
+    trace_models_2d : list(BandedProfile)
         List of trace models, one for each object identified in the image
 
     trace_info : list
@@ -254,12 +374,14 @@ def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_de
 
     if model_name == 'tophat':
         # Fit the centroid using a Moffat profile, but the discard the with for the profile calculation
-        fit_values = fit_trace(img2D, x, y, model_name='moffat', dx=dx, ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax)
+        fit_values = fit_trace(img2D, x, y, model_name='moffat', dx=dx, ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax,
+                               warm_start=warm_start, workers=workers)
         fwhm = fit_values[3]
         if fwhm is None:
             raise ValueError("FWHM of the spectral trace could not be determined! Maybe more than one object in slit...")
     else:
-        fit_values = fit_trace(img2D, x, y, model_name=model_name, dx=dx, ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax, kappa=kappa_det)
+        fit_values = fit_trace(img2D, x, y, model_name=model_name, dx=dx, ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax, kappa=kappa_det,
+                               warm_start=warm_start, workers=workers)
     x_binned, N_obj, trace_parameters, fwhm, fit_msg = fit_values
     msg.append(fit_msg)
 
@@ -285,11 +407,10 @@ def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_de
         info_dict['mu'] = mu
         info_dict['mu_err'] = mu_err
         info_dict['mask_mu'] = mask_mu
-        info_dict['fit_mu'] = mu_fit(x)
+        center = mu_fit(x)
+        info_dict['fit_mu'] = center
 
         # Fit polynomium:
-        trace2D = np.zeros_like(img2D)
-        trace2D = np.zeros_like(img2D)
         if model_name == 'gaussian':
             # Median filter
             sig = np.array([p['sig_%i' % n] for p in trace_parameters])
@@ -304,12 +425,13 @@ def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_de
             info_dict['sig'] = sig
             info_dict['sig_err'] = sig_err
             info_dict['mask_sig'] = mask_sig
-            info_dict['fit_sig'] = sig_fit(x)
+            sigma = sig_fit(x)
+            info_dict['fit_sig'] = sigma
 
-            for num, x_i in enumerate(x):
-                P_i = NN_gaussian(y, mu_fit(x_i), sig_fit(x_i), 0.)
-                P_i = P_i/np.sum(P_i)
-                trace2D[:, num] = P_i
+            trace_fwhm = 2*np.sqrt(2*np.log(2)) * np.abs(sigma)
+            trace2D = BandedProfile.around(center, band_width*np.max(trace_fwhm), img2D.shape)
+            trace2D.data = NN_gaussian(trace2D.rows, center, sigma, 0.)
+            trace2D.normalize()
             trace_models_2d.append(trace2D)
 
         elif model_name == 'moffat':
@@ -336,24 +458,27 @@ def create_2d_profile(img2D, model_name='moffat', dx=25, width_scale=2, kappa_de
             info_dict['a'] = a
             info_dict['a_err'] = a_err
             info_dict['mask_a'] = mask_a
-            info_dict['fit_a'] = a_fit(x)
+            alpha = a_fit(x)
+            beta = b_fit(x)
+            info_dict['fit_a'] = alpha
             info_dict['b'] = b
             info_dict['b_err'] = b_err
             info_dict['mask_b'] = mask_b
-            info_dict['fit_b'] = b_fit(x)
+            info_dict['fit_b'] = beta
 
-            for num, x_i in enumerate(x):
-                P_i = NN_moffat(y, mu_fit(x_i), a_fit(x_i), b_fit(x_i), 0.)
-                P_i = P_i/np.sum(P_i)
-                trace2D[:, num] = P_i
+            with np.errstate(invalid='ignore'):
+                trace_fwhm = 2*np.abs(alpha) * np.sqrt(2**(1/beta) - 1)
+            trace2D = BandedProfile.around(center, band_width*np.nanmax(trace_fwhm), img2D.shape)
+            trace2D.data = NN_moffat(trace2D.rows, center, alpha, beta, 0.)
+            trace2D.normalize()
             trace_models_2d.append(trace2D)
 
         elif model_name == 'tophat':
-            for num, x_i in enumerate(x):
-                center = mu_fit(x_i)
-                lower = int(center - width_scale*fwhm)
-                upper = int(center + width_scale*fwhm)
-                trace2D[lower:upper+1, num] = 1 / (upper - lower + 1)
+            lower = (center - width_scale*fwhm).astype(int)
+            upper = (center + width_scale*fwhm).astype(int)
+            trace2D = BandedProfile.around(center, width_scale*fwhm + 1, img2D.shape)
+            aperture = (trace2D.rows >= lower) & (trace2D.rows <= upper)
+            trace2D.data = aperture / (upper - lower + 1.)
             trace_models_2d.append(trace2D)
             info_dict['fwhm'] = fwhm
         trace_info.append(info_dict)
@@ -428,7 +553,7 @@ def plot_diagnostics(pdf, spec1D, err1D, info_dict, width_scale=2):
 def auto_extract_img(img2D, err2D, *, N=None, pdf_fname=None, mask=None, model_name='moffat',
                      dx=50, width_scale=2, xmin=None, xmax=None, ymin=None, ymax=None,
                      order_center=3, order_width=0, w_cen=15, kappa_cen=3., w_width=21, kappa_width=3.,
-                     kappa_det=10.):
+                     kappa_det=10., warm_start=False, workers=1):
     assert err2D.shape == img2D.shape, "input image and error image do not match in shape"
     if N == 0:
         raise ValueError("Invalid input: N must be an integer larger than or equal to 1, not %r" % N)
@@ -450,7 +575,7 @@ def auto_extract_img(img2D, err2D, *, N=None, pdf_fname=None, mask=None, model_n
                                        xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax,
                                        order_center=order_center, order_width=order_width,
                                        w_cen=w_cen, kappa_cen=kappa_cen, w_width=w_width, kappa_width=kappa_width,
-                                       kappa_det=kappa_det)
+                                       kappa_det=kappa_det, warm_start=warm_start, workers=workers)
     trace_models_2d, trace_info, profile_msg = profile_values
     msg.append(profile_msg)
 
@@ -468,14 +593,19 @@ def auto_extract_img(img2D, err2D, *, N=None, pdf_fname=None, mask=None, model_n
         pdf = backend_pdf.PdfPages(pdf_fname)
 
     spectra = list()
-    for P, info_dict in zip(trace_models_2d, trace_info):
+    for trace2D, info_dict in zip(trace_models_2d, trace_info):
+        # Only the pixels within the band of the profile contribute:
+        P = trace2D.data
+        M_band = trace2D.take(M)
+        img_band = trace2D.take(img2D)
+        var_band = trace2D.take(var2D)
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
-            spec1D = np.sum(M*P*img2D/var2D, axis=0) / np.sum(M*P**2/var2D, axis=0)
-            var1D = np.sum(M*P, axis=0) / np.sum(M*P**2/var2D, axis=0)
+            spec1D = np.sum(M_band*P*img_band/var_band, axis=0) / np.sum(M_band*P**2/var_band, axis=0)
+            var1D = np.sum(M_band*P, axis=0) / np.sum(M_band*P**2/var_band, axis=0)
             err1D = np.sqrt(var1D)
             err1D = fix_nans(err1D)
-            mask1D = np.sum((1-M)*P, axis=0) / np.sum((1-M)*P**2, axis=0) > 0
+            mask1D = np.sum((1-M_band)*P, axis=0) / np.sum((1-M_band)*P**2, axis=0) > 0
             trace_pos = np.median(info_dict['fit_mu'])
             spectra.append([spec1D, err1D, mask1D, trace_pos])
 
@@ -493,29 +623,28 @@ def auto_extract_img(img2D, err2D, *, N=None, pdf_fname=None, mask=None, model_n
 
 def auto_extract(fname, output, dispaxis=1, *, N=None, pdf_fname=None, model_name='moffat',
                  dx=50, width_scale=2, xmin=None, xmax=None, ymin=None, ymax=None,
-                 order_center=3, order_width=1, w_cen=15, kappa_cen=3., w_width=21, kappa_width=3., kappa_det=10., **kwargs):
+                 order_center=3, order_width=1, w_cen=15, kappa_cen=3., w_width=21, kappa_width=3., kappa_det=10.,
+                 warm_start=False, workers=1, **kwargs):
     """Automatically extract object spectra in the given file. Dispersion along the x-axis is assumed!"""
     msg = list()
-    img2D = fits.getdata(fname)
-    hdr = fits.getheader(fname)
+    img2D, extensions, hdr = read_fits_image(fname)
     if 'DISPAXIS' in hdr:
         dispaxis = hdr['DISPAXIS']
     msg.append("          - Loaded image data: %s" % fname)
 
     mask2D = None
     err2D = None
-    with fits.open(fname) as hdu_list:
-        for hdu in hdu_list:
-            if hdu.name.upper() in ['MASK', 'QUAL', 'QC', 'DQ']:
-                mask2D = hdu.data
-                msg.append("          - Loaded pixel mask")
-            elif hdu.name.upper() in ['ERR', 'ERROR', 'ERRS', 'FLUX_ERR', 'FLUX_ERRS']:
-                err2D = hdu.data
-                msg.append("          - Loaded error image extension")
-            elif hdu.name.upper() in ['IVAR']:
-                err2D = 1./np.sqrt(hdu.data)
-                msg.append("          - Loaded inverse variance image extension")
-                msg.append("          - Converted inverse variance to error image")
+    for extname, ext_data in extensions.items():
+        if extname.upper() in ['MASK', 'QUAL', 'QC', 'DQ']:
+            mask2D = ext_data
+            msg.append("          - Loaded pixel mask")
+        elif extname.upper() in ['ERR', 'ERROR', 'ERRS', 'FLUX_ERR', 'FLUX_ERRS']:
+            err2D = ext_data
+            msg.append("          - Loaded error image extension")
+        elif extname.upper() in ['IVAR']:
+            err2D = 1./np.sqrt(ext_data)
+            msg.append("          - Loaded inverse variance image extension")
+            msg.append("          - Converted inverse variance to error image")
 
     if err2D is None:
         noise = 1.5*mad(img2D)
@@ -527,6 +656,10 @@ def auto_extract(fname, output, dispaxis=1, *, N=None, pdf_fname=None, model_nam
     if mask2D is None:
         mask2D = np.zeros_like(img2D)
 
+    # The products may be stored as float32:
+    img2D = img2D.astype(np.float64)
+    err2D = err2D.astype(np.float64)
+
     if dispaxis == 2:
         img2D = img2D.T
         err2D = err2D.T
@@ -544,6 +677,8 @@ def auto_extract(fname, output, dispaxis=1, *, N=None, pdf_fname=None, model_nam
                                         kappa_cen=kappa_cen,
                                         kappa_width=kappa_width,
                                         kappa_det=kappa_det,
+                                        warm_start=warm_start,
+                                        workers=workers,
                                         )
     msg.append(ext_msg)
 
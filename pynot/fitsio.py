@@ -391,24 +391,95 @@ def load_fits_spectrum(fname, ext=None, iraf_obj=None):
                 return wavelength, data, error, mask, data_hdr, msg
 
 
-def load_fits_image(fname):
-    """Load a FITS image with an associated error extension and an optional data quality MASK."""
-    with fits.open(fname) as hdu_list:
-        image = hdu_list[0].data
-        hdr = hdu_list[0].header
-        # Loop through HDU list instead to check all
-        # for hdu in hdu_list:
-        if 'ERR' in hdu_list:
-            error = hdu_list['ERR'].data
-        elif len(hdu_list) > 1:
-            error = hdu_list[1].data
-        else:
-            raise IndexError("No error image detected")
+def native_byteorder(array):
+    """
+    Return the `array` in native byte order. FITS data are stored as big-endian,
+    the bytes are swapped in place such that no new array is allocated.
+    Memory-mapped data are opened as copy-on-write, so the file is not modified.
+    """
+    if array is None or array.dtype.isnative:
+        return array
+    array.byteswap(inplace=True)
+    return array.view(array.dtype.newbyteorder('='))
+
+
+def read_fits_image(fname, memmap=True):
+    """
+    Read the image data, the image extensions and the header of the FITS file `fname`.
+    The file is only opened once and all arrays are converted to native byte order,
+    such that they can be passed directly to SEP, astroscrappy and scipy.
 
-        if 'MASK' in hdu_list:
-            mask = hdu_list['MASK'].data
+    Parameters
+    ----------
+    fname : string
+        Filename of the FITS image
+
+    memmap : bool  [default=True]
+        Memory-map the data when possible. Scaled integer data (BZERO/BSCALE)
+        are always read into memory.
+
+    Returns
+    -------
+    image : np.array
+        The image data of the primary extension
+
+    extensions : dict
+        The data of the following extensions by extension name (e.g., 'ERR' and 'MASK'),
+        in the order of the file. If several extensions have the same name, the first is used.
+
+    hdr : fits.Header
+        FITS Header of the primary extension
+    """
+    try:
+        with fits.open(fname, memmap=memmap) as hdu_list:
+            image = native_byteorder(hdu_list[0].data)
+            hdr = hdu_list[0].header
+            extensions = {}
+            for hdu in hdu_list[1:]:
+                if hdu.name not in extensions:
+                    extensions[hdu.name] = native_byteorder(hdu.data)
+    except ValueError:
+        if not memmap:
+            raise
+        # Scaled integer data (BZERO/BSCALE) cannot be memory-mapped
+        return read_fits_image(fname, memmap=False)
+    return image, extensions, hdr
+
+
+def read_image_data(fname, memmap=True):
+    """
+    Read the image data and the primary header of the FITS file `fname` opening the file once.
+    The image is taken from the first extension with data as in `fits.getdata`
+    (e.g., the image extension of raw ALFOSC data) and returned in native byte order.
+    """
+    image, extensions, hdr = read_fits_image(fname, memmap=memmap)
+    if image is None:
+        for data in extensions.values():
+            if data is not None:
+                image = data
+                break
         else:
-            mask = np.zeros_like(image, dtype=bool)
+            raise IndexError("No data in any element of the FITS file: %s" % fname)
+    return image, hdr
+
+
+def load_fits_image(fname):
+    """
+    Load a FITS image with an associated error extension and an optional data quality MASK.
+    The arrays are returned in native byte order, see `read_fits_image`.
+    """
+    image, extensions, hdr = read_fits_image(fname)
+    if 'ERR' in extensions:
+        error = extensions['ERR']
+    elif len(extensions) > 0:
+        error = list(extensions.values())[0]
+    else:
+        raise IndexError("No error image detected")
+
+    if 'MASK' in extensions:
+        mask = extensions['MASK']
+    else:
+        mask = np.zeros_like(image, dtype=bool)
     return image, error, mask, hdr
 
 
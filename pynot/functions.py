@@ -1,5 +1,6 @@
 import astropy.units as u
 import numpy as np
+from scipy.ndimage import median_filter
 import yaml
 import os
 
@@ -67,11 +68,105 @@ def get_option_descr(opt_fname):
 
 
 
-def mad(img):
+def mad(img, axis=None):
     """Calculate Median Absolute Deviation from the median. This is a robust variance estimator.
     For a Gaussian distribution: sigma ≈ 1.4826 * MAD
+
+    If `axis` is given, the MAD is calculated along the given axis.
+    """
+    if axis is None:
+        return np.nanmedian(np.abs(img - np.nanmedian(img)))
+    # `nanmedian` along an axis is much slower than `median`, only use it if needed:
+    median = np.nanmedian if np.any(np.isnan(img)) else np.median
+    return median(np.abs(img - median(img, axis, keepdims=True)), axis)
+
+
+def median_filter_rows(img, size):
+    """
+    Median filter each row of the 2D image `img` with a window of `size` pixels.
+    Equivalent to `scipy.ndimage.median_filter(row, size)` for every row,
+    but filters all the rows in one call.
+    """
+    # Pad every row by reflection, as done by `median_filter`, so that the
+    # filter window never reaches the neighbouring row of the flattened image:
+    pad = size // 2
+    padded = np.pad(img, ((0, 0), (pad, pad)), mode='symmetric')
+    filtered = median_filter(padded.ravel(), size).reshape(padded.shape)
+    return filtered[:, pad:padded.shape[1]-pad]
+
+
+def chebyshev_fit_rows(x, rows, weights, order, domain=None, max_cond=1.e8):
     """
-    return np.nanmedian(np.abs(img - np.nanmedian(img)))
+    Weighted least-squares fit of a Chebyshev polynomial to every row of `rows`.
+    All rows are sampled on the same pixel array `x`, so the fits share the Vandermonde matrix
+    and are solved at once as a stack of normal equations.
+
+    Parameters
+    ==========
+    x : np.array (N)
+        Pixel array of the rows
+
+    rows : np.array (M, N)
+        Data to fit, one polynomial per row
+
+    weights : np.array (M, N)
+        Weight of every pixel in the sum of squared residuals.
+        Use a boolean pixel mask to fit only the pixels that are `True`.
+
+    order : integer
+        Order of the Chebyshev polynomial
+
+    domain : [float, float]  [default=None]
+        Domain of the polynomial. By default: [x.min(), x.max()]
+
+    max_cond : float  [default=1.e8]
+        Maximal condition number of the normal equations of a row.
+        Rows above this limit are fitted individually by least-squares.
+
+    Returns
+    =======
+    coeffs : np.array (M, order+1)
+        Chebyshev coefficients of each row.
+        Rows with no more than `order+1` pixels of non-zero weight are NaN.
+
+    vander : np.array (N, order+1)
+        The Vandermonde matrix of the Chebyshev polynomials evaluated at `x`.
+        The fitted rows are evaluated by: `coeffs @ vander.T`
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if domain is None:
+        domain = [x.min(), x.max()]
+    offset, scale = np.polynomial.polyutils.mapparms(domain, [-1, 1])
+    x_scaled = offset + scale*x
+    vander = np.polynomial.chebyshev.chebvander(x_scaled, order)
+
+    weights = np.asarray(weights, dtype=np.float64)
+    rows = np.where(weights > 0, rows, 0.)
+    # Normal equations for every row:  (V^T W V) c = V^T W y
+    outer = (vander[:, :, np.newaxis] * vander[:, np.newaxis, :]).reshape(len(x), -1)
+    lhs = (weights @ outer).reshape(-1, order+1, order+1)
+    rhs = (weights * rows) @ vander
+
+    good_rows = np.sum(weights > 0, 1) > order + 1
+    coeffs = np.full(rhs.shape, np.nan)
+    if not np.any(good_rows):
+        return coeffs, vander
+
+    # The normal equations square the condition number of the fit. Rows with poorly constrained
+    # fits (e.g., large gaps at the edges) are instead solved by least-squares one at a time:
+    col_norm = np.sqrt(np.einsum('...ii->...i', lhs[good_rows]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cond = np.linalg.cond(lhs[good_rows] / (col_norm[:, :, np.newaxis] * col_norm[:, np.newaxis, :]))
+    well_posed = np.zeros_like(good_rows)
+    well_posed[good_rows] = np.isfinite(cond) & (cond < max_cond)
+    if np.any(well_posed):
+        coeffs[well_posed] = np.linalg.solve(lhs[well_posed], rhs[well_posed][..., np.newaxis])[..., 0]
+
+    for num in np.nonzero(good_rows & ~well_posed)[0]:
+        pixels = weights[num] > 0
+        coeffs[num] = np.polynomial.chebyshev.chebfit(x_scaled[pixels], rows[num][pixels], order,
+                                                       w=np.sqrt(weights[num][pixels]))
+    return coeffs, vander
 
 
 def NN_moffat(x, mu, alpha, beta, logamp):
@@ -84,6 +179,21 @@ def NN_moffat(x, mu, alpha, beta, logamp):
     return amp*(1. + ((x-mu)**2/alpha**2))**(-beta)
 
 
+def NN_moffat_jac(x, mu, alpha, beta, logamp):
+    """
+    Jacobian of `NN_moffat` with respect to the parameters (mu, alpha, beta, logamp).
+    The last axis of the output runs over the four parameters.
+    """
+    u = x - mu
+    q = 1. + u**2/alpha**2
+    profile = 10**logamp * q**(-beta)
+    dprofile = 2*beta*profile/(q*alpha**2)
+    return np.stack([dprofile * u,
+                     dprofile * u**2/alpha,
+                     -profile * np.log(q),
+                     profile * np.log(10)], axis=-1)
+
+
 def gaussian(x, mu, sigma, amp):
     """ One-dimensional Gaussian profile."""
     return amp * np.exp(-0.5*(x-mu)**2/sigma**2)
@@ -95,12 +205,38 @@ def NN_gaussian(x, mu, sigma, logamp):
     return amp * np.exp(-0.5*(x-mu)**2/sigma**2)
 
 
+def NN_gaussian_jac(x, mu, sigma, logamp):
+    """
+    Jacobian of `NN_gaussian` with respect to the parameters (mu, sigma, logamp).
+    The last axis of the output runs over the three parameters.
+    """
+    u = x - mu
+    profile = 10**logamp * np.exp(-0.5*u**2/sigma**2)
+    return np.stack([profile * u/sigma**2,
+                     profile * u**2/sigma**3,
+                     profile * np.log(10)], axis=-1)
+
+
 def NN_mod_gaussian(x, bg, mu, sigma, logamp):
     """ One-dimensional modified non-negative Gaussian profile."""
     amp = 10**logamp
     return bg + amp * np.exp(-0.5*(x-mu)**4/sigma**2)
 
 
+def NN_mod_gaussian_jac(x, bg, mu, sigma, logamp):
+    """
+    Jacobian of `NN_mod_gaussian` with respect to the parameters (bg, mu, sigma, logamp).
+    The last axis of the output runs over the four parameters.
+    """
+    u = x - mu
+    u2 = u*u
+    profile = 10**logamp * np.exp(-0.5*u2*u2/sigma**2)
+    return np.stack([np.ones_like(profile),
+                     profile * 2*u2*u/sigma**2,
+                     profile * u2*u2/sigma**3,
+                     profile * np.log(10)], axis=-1)
+
+
 def tophat(x, low, high):
     """Tophat profile: 1 within [low: high], 0 outside"""
     mask = (x >= low) & (x <= high)
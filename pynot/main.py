@@ -74,7 +74,7 @@ def set_help_width(max_width=30):
         return ArgumentDefaultsHelpFormatter
 
 
-def initialize(path, mode, pfc_fname='dataset.pfc', pars_fname='options.yml', verbose=True):
+def initialize(path, mode, pfc_fname='dataset.pfc', pars_fname='options.yml', verbose=True, workers=1):
     """
     Initialize new dataset with file classification table and default options.
 
@@ -93,6 +93,9 @@ def initialize(path, mode, pfc_fname='dataset.pfc', pars_fname='options.yml', ve
 
     verbose : bool  [default=True]
         Print logging to terminal
+
+    workers : int  [default=1]
+        Number of processes used to classify the files
     """
     print_credits()
     from pynot.data import organizer as do
@@ -100,7 +103,7 @@ def initialize(path, mode, pfc_fname='dataset.pfc', pars_fname='options.yml', ve
 
     # Classify files:
     # args.silent is set to "store_false", so by default it is true!
-    database, message = do.classify(path, progress=verbose)
+    database, message = do.classify(path, progress=verbose, workers=workers)
     if database is None:
         print(message)
         return
@@ -168,6 +171,8 @@ def main():
                              help="Filename of file classification table (*.pfc)")
     parser_init.add_argument("-s", "--silent", action='store_false',
                              help="Minimze the output to terminal")
+    parser_init.add_argument("--workers", type=int, default=1,
+                             help="Number of processes used to classify the files")
 
     parser_org = tasks.add_parser('classify', formatter_class=set_help_width(31),
                                   help="Classify the files in `path`")
@@ -177,6 +182,8 @@ def main():
                             help="Filename of file classification table (*.pfc)")
     parser_org.add_argument("-f", "--force", action="store_true",
                             help="Force overwrite of the file classification table (*.pfc)")
+    parser_org.add_argument("--workers", type=int, default=1,
+                            help="Number of processes used to classify the files")
 
     parser_obd = tasks.add_parser('update-obs', formatter_class=set_help_width(31),
                                   help="Update the OB database based on a classification table")
@@ -194,6 +201,12 @@ def main():
                              help="Threshold for sigma clipping")
     parser_bias.add_argument("--method", type=str, default='mean', choices=['mean', 'median'],
                              help="Method for image combination")
+    parser_bias.add_argument("--memory_limit", type=float, default=1024,
+                             help="Memory budget in MB for the tiled image combination")
+    parser_bias.add_argument("--incremental", action='store_true',
+                             help="Update the persistent bias accumulator and combine all accumulated frames")
+    parser_bias.add_argument("--accum_dir", type=str, default='',
+                             help="Directory of the bias accumulator. By default, the output directory is used")
 
     # -- SFLAT :: Spectral Flat Combination
     parser_sflat = tasks.add_parser('sflat', formatter_class=set_help_width(31),
@@ -223,6 +236,8 @@ def main():
                                help="Threshold for sigma clipping")
     parser_imflat.add_argument("--method", type=str, default='mean', choices=['mean', 'median'],
                                help="Method for image combination")
+    parser_imflat.add_argument("--memory_limit", type=float, default=1024,
+                               help="Memory budget in MB for the tiled image combination")
 
     # -- corr :: Raw Correction
     parser_corr = tasks.add_parser('corr', formatter_class=set_help_width(31),
@@ -421,6 +436,8 @@ def main():
                               help="Re-identify all grisms once")
     parser_redux.add_argument("-C", "--calibs", action="store_true",
                               help="Process only static calibrations: [bias, flats, arcs, response]")
+    parser_redux.add_argument("--workers", type=int, default=1,
+                              help="Number of OBs to reduce in parallel")
 
     # Imaging Redux:
     parser_phot = tasks.add_parser('phot', formatter_class=set_help_width(30),
@@ -519,6 +536,28 @@ def main():
     parser_findnew.add_argument('-z', "--zp", type=float,
                                 help="Magnitude zero point in case the source catalog has not been flux calibrated")
 
+    parser_seed = tasks.add_parser('refcat-seed', formatter_class=set_help_width(30),
+                                   help="Download reference catalogs for the fields of a night")
+    parser_seed.add_argument("input", type=str, nargs='+',
+                             help="Images with WCS or a file classification table (.pfc) of the night")
+    parser_seed.add_argument("--catalogs", type=str, nargs='+', default=['gaia', 'sdss'], choices=['gaia', 'sdss'],
+                             help="Reference catalogs to download (default = gaia sdss)")
+    parser_seed.add_argument("--margin", type=float, default=2.,
+                             help="Margin in arcmin added to the field radius (default = 2)")
+    parser_seed.add_argument("--store", type=str, default='',
+                             help="Directory of the reference catalog store (default = ~/.pynot/refcat)")
+
+    parser_ingest = tasks.add_parser('refcat-ingest', formatter_class=set_help_width(30),
+                                     help="Add catalog dumps (.csv) to the reference catalog store")
+    parser_ingest.add_argument("catalog", type=str,
+                               help="Name of the catalog in the store, e.g., gaia_dr3, gaia_edr3 or sdss")
+    parser_ingest.add_argument("input", type=str, nargs='+',
+                               help="Catalog dumps (.csv) with columns 'ra' and 'dec'")
+    parser_ingest.add_argument("--cone", type=float, nargs=3,
+                               help="Cone covered by the catalog dumps (ra [deg]  dec [deg]  radius [arcmin])")
+    parser_ingest.add_argument("--store", type=str, default='',
+                               help="Directory of the reference catalog store (default = ~/.pynot/refcat)")
+
     parser_setup = tasks.add_parser('setup', formatter_class=set_help_width(30),
                                     help="Install new instrument configuration")
     parser_setup.add_argument('module', type=str,
@@ -582,7 +621,8 @@ def main():
 
 
     if task == 'init':
-        initialize(args.path, args.mode, pfc_fname=args.output, pars_fname=args.pars, verbose=args.silent)
+        initialize(args.path, args.mode, pfc_fname=args.output, pars_fname=args.pars, verbose=args.silent,
+                   workers=args.workers)
 
     elif task == 'update-obs':
         from pynot.data.obs import update_ob_database
@@ -602,21 +642,25 @@ def main():
                      make_identify=args.identify,
                      make_response=args.response,
                      calibs_only=args.calibs,
-                     restart_science=args.science
+                     restart_science=args.science,
+                     workers=args.workers
                      )
 
     elif task == 'bias':
         from pynot.calibs import combine_bias_frames
         print("Running task: Bias combination")
         input_list = np.loadtxt(args.input, dtype=str, usecols=(0,))
-        _, log = combine_bias_frames(input_list, args.output, kappa=args.kappa, method=args.method)
+        _, log = combine_bias_frames(input_list, args.output, kappa=args.kappa, method=args.method,
+                                     memory_limit=args.memory_limit, incremental=args.incremental,
+                                     accum_dir=args.accum_dir)
 
     elif task == 'sflat':
         from pynot.calibs import combine_flat_frames, normalize_spectral_flat
         print("Running task: Spectral flat field combination and normalization")
         input_list = np.loadtxt(args.input, dtype=str, usecols=(0,))
         flatcombine, log = combine_flat_frames(input_list, output='', mbias=args.bias, mode='spec',
-                                               dispaxis=args.axis, kappa=args.kappa, method=args.method)
+                                               dispaxis=args.axis, kappa=args.kappa, method=args.method,
+                                               memory_limit=args.memory_limit)
 
         options = copy(vars(args))
         vars_to_remove = ['task', 'input', 'output', 'axis', 'bias', 'kappa']
@@ -692,8 +736,8 @@ def main():
         vars_to_remove = ['task', 'input', 'arc', 'table', 'output', 'axis']
         for varname in vars_to_remove:
             options.pop(varname)
-        log = rectify(args.input, args.arc, args.table, output=args.output, fig_dir='./',
-                      dispaxis=args.axis, **options)
+        _, log = rectify(args.input, args.arc, args.table, output=args.output, fig_dir='./',
+                         dispaxis=args.axis, **options)
 
     elif task == 'skysub':
         from pynot.scired import auto_fit_background
@@ -702,9 +746,9 @@ def main():
         vars_to_remove = ['task', 'input', 'output', 'axis', 'auto']
         for varname in vars_to_remove:
             options.pop(varname)
-        log = auto_fit_background(args.input, args.output, dispaxis=args.axis,
-                                  plot_fname="skysub_diagnostics.pdf",
-                                  **options)
+        _, log = auto_fit_background(args.input, args.output, dispaxis=args.axis,
+                                     plot_fname="skysub_diagnostics.pdf",
+                                     **options)
 
     elif task == 'crr':
         from pynot.scired import correct_cosmics
@@ -713,7 +757,7 @@ def main():
         vars_to_remove = ['task', 'input', 'output']
         for varname in vars_to_remove:
             options.pop(varname)
-        log = correct_cosmics(args.input, args.output, **options)
+        _, log = correct_cosmics(args.input, args.output, **options)
 
     elif task == 'flux1d':
         from pynot.response import flux_calibrate_1d
@@ -723,7 +767,7 @@ def main():
     elif task == 'flux2d':
         from pynot.response import flux_calibrate
         print("Running task: Flux Calibration of 2D Image")
-        log = flux_calibrate(args.input, output=args.output, response_fname=args.response)
+        _, log = flux_calibrate(args.input, output=args.output, response_fname=args.response)
 
     elif task == 'scombine':
         print("Running task: Spectral Combination")
@@ -797,7 +841,7 @@ def main():
         from pynot.calibs import combine_flat_frames
         input_list = np.loadtxt(args.input, dtype=str, usecols=(0,))
         _, log = combine_flat_frames(input_list, output=args.output, mbias=args.bias, mode='img',
-                                     kappa=args.kappa, method=args.method)
+                                     kappa=args.kappa, method=args.method, memory_limit=args.memory_limit)
 
     elif task == 'imtrim':
         print("Running task: Image Trimming")
@@ -899,6 +943,37 @@ def main():
                                             mag_lim=args.limit,
                                             zp=args.zp)
 
+    elif task == 'refcat-seed':
+        print("Running task: Download reference catalogs")
+        from pynot import refcat
+        if args.store:
+            refcat.set_store_dir(args.store)
+        filelist = list()
+        for fname in args.input:
+            if fname.endswith('.pfc'):
+                from pynot.data import io
+                database = io.load_database(fname)
+                filelist += database.get('IMG_OBJECT', [])
+            else:
+                filelist.append(fname)
+        log = refcat.seed_fields(filelist, catalogs=args.catalogs, margin=args.margin)
+
+    elif task == 'refcat-ingest':
+        print("Running task: Add catalog dumps to the reference catalog store")
+        from pynot import refcat
+        if args.store:
+            refcat.set_store_dir(args.store)
+        ra, dec, radius = args.cone if args.cone else (None, None, None)
+        log = list()
+        for fname in args.input:
+            N_new, cone = refcat.store.ingest_csv(args.catalog, fname, ra=ra, dec=dec, radius=radius)
+            log.append("          - Added %i sources from %s" % (N_new, fname))
+            if cone is None:
+                log.append("[WARNING] - Unknown field of the catalog, the field is not registered as downloaded")
+                log.append("            Give the field using the option: --cone")
+        log.append(" [OUTPUT] - Updated reference catalog store: %s" % refcat.store.catalog_dir(args.catalog))
+        log = "\n".join(log)
+
     elif task == 'setup':
         print("\nInstalling new instrument settings...")
         from pynot.insconfig import setup_instrument
@@ -920,7 +995,7 @@ def main():
         from pynot.data import io
 
         # Classify files:
-        database, message = do.classify(args.path)
+        database, message = do.classify(args.path, workers=args.workers)
         print("")
         print(message)
         if database is None:
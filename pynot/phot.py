@@ -6,8 +6,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Ellipse
 from astropy.io import fits
-from astropy.modeling import models, fitting
 from astropy.table import Table
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from scipy.optimize import curve_fit
 import os
 
@@ -15,12 +16,16 @@ from astropy.coordinates import SkyCoord
 import astropy.units as u
 from astroquery.sdss import SDSS
 
-import astroalign as aa
 import sep
 
 from pynot import instrument
+from pynot import psf
+from pynot import refcat
+from pynot import registration
+from pynot import stacking
+from pynot.crossmatch import match_nearest
 from pynot.data import obs
-from pynot.fitsio import load_fits_image
+from pynot.fitsio import load_fits_image, read_fits_image, read_image_data
 from pynot.functions import get_version_number, mad
 
 __version__ = get_version_number()
@@ -69,9 +74,8 @@ def source_detection(fname, zeropoint=0., threshold=5.0, aperture=10.0, kwargs_b
     """
     msg = list()
     # get GAIN from header
-    data = fits.getdata(fname)
-    error_image = fits.getdata(fname, 'ERR')
-    hdr = fits.getheader(fname)
+    data, extensions, hdr = read_fits_image(fname)
+    error_image = extensions['ERR']
     msg.append("          - Loaded input image: %s" % fname)
 
     exptime = instrument.get_exptime(hdr)
@@ -81,8 +85,8 @@ def source_detection(fname, zeropoint=0., threshold=5.0, aperture=10.0, kwargs_b
         exptime = 1.
         msg.append("[WARNING] - No exposure time found in image header! Assuming image in counts.")
 
-    data = data * 1.
-    error_image = error_image * 1.
+    data = data.astype(np.float64)
+    error_image = error_image.astype(np.float64)
     if 'threshold' in kwargs_ext:
         threshold = kwargs_ext.pop('threshold')
     if 'aperture' in kwargs_ext:
@@ -92,11 +96,6 @@ def source_detection(fname, zeropoint=0., threshold=5.0, aperture=10.0, kwargs_b
     data_sub = data - bkg
     msg.append("          - Subtracted sky background")
     msg.append("          - Background RMS: %.2e" % bkg.globalrms)
-    data_sub = data_sub.byteswap().newbyteorder()
-    error_image = error_image.byteswap().newbyteorder()
-    if data_sub.dtype.byteorder != '<':
-        data_sub = data_sub.byteswap().newbyteorder()
-        error_image = error_image.byteswap().newbyteorder()
     extract_output = sep.extract(data_sub, threshold, err=bkg.globalrms, **kwargs_ext)
     if len(extract_output) == 2:
         objects, segmap = extract_output
@@ -225,9 +224,10 @@ def plot_objects(fig_fname, data, objects, threshold=5.):
     fig.savefig(fig_fname)
 
 
-def measure_seeing(img, centers, size=20, max_obj=10):
+def measure_seeing(img, centers, size=20, max_obj=None, refine=False):
     """
-    Measure the average seeing in an image by fitting a 2D Gaussian to pre-defined point sources.
+    Measure the average seeing in an image from the shape of pre-defined point sources.
+    The adaptive second moments of all the sources are measured at once, see `pynot.psf.measure_psf`.
 
     Parameters
     ----------
@@ -238,10 +238,14 @@ def measure_seeing(img, centers, size=20, max_obj=10):
         List of positions of point sources (x, y) in pixels
 
     size : int  [default=20]
-        Image cutout size. The Gaussian PSF is fitted in a box of size 2*size by 2*size pixels.
+        Image cutout size. The PSF is measured in a box of size 2*size by 2*size pixels.
 
-    max_obj : int  [default=10]
-        Maximum number of sources to include in the fitting.
+    max_obj : int  [default=None]
+        Maximum number of sources to include. The first `max_obj` sources in `centers` are used,
+        by default all the sources are included.
+
+    refine : bool  [default=False]
+        Refine the moments by fitting a 2D Gaussian to the sources.
 
     Returns
     -------
@@ -255,36 +259,10 @@ def measure_seeing(img, centers, size=20, max_obj=10):
         Output message of the function call.
         If no warnings occurred, this is an emptry string.
     """
-    X = np.arange(img.shape[1])
-    Y = np.arange(img.shape[0])
-    sigmas = list()
-    ratios = list()
-    good_x = (centers[:, 0] > size) & (centers[:, 0] < X.max()-size)
-    good_y = (centers[:, 1] > size) & (centers[:, 1] < Y.max()-size)
-    if np.sum(good_x & good_y) < 2:
-        msg = "[WARNING] - Not enough sources to measure seeing."
-        return (-1, -1, msg)
-    max_obj = min(max_obj, np.sum(good_x & good_y))
-    idx = np.random.choice(np.arange(len(centers))[good_x & good_y], max_obj, replace=False)
-    for x_cen, y_cen in centers[idx]:
-        x1, x2 = int(x_cen)-size, int(x_cen)+size
-        y1, y2 = int(y_cen)-size, int(y_cen)+size
-        cutout = img[y1:y2, x1:x2]
-        x, y = np.meshgrid(X[x1:x2], Y[y1:y2])
-        A = img[int(y_cen), int(x_cen)]
-        p_init = models.Gaussian2D(amplitude=A, x_mean=x_cen, y_mean=y_cen, x_stddev=5, y_stddev=5, theta=0)
-        try:
-            fitter = fitting.LevMarLSQFitter()
-        except TypeError:
-            continue
-        p_opt = fitter(p_init, x, y, cutout-np.median(cutout))
-        sigma_x = p_opt.x_stddev
-        sigma_y = p_opt.y_stddev
-        sig = np.sqrt(sigma_x**2 + sigma_y**2)
-        ba = min(sigma_x, sigma_y) / max(sigma_x, sigma_y)
-        sigmas.append(sig)
-        ratios.append(ba)
-
+    centers = np.asarray(centers)
+    if max_obj:
+        centers = centers[:max_obj]
+    _, sigmas, ratios, _ = psf.measure_psf(img, centers, size=size, refine=refine)
     if len(sigmas) < 2:
         msg = "[WARNING] - Not enough sources to measure seeing."
         return (-1, -1, msg)
@@ -308,7 +286,9 @@ def save_file_log(log_name, image_log, target_hdr):
             out.write(" %s   %.1f  %5.2f  %6.1f\n" % tuple(line))
 
 
-def image_combine(corrected_images, output='', log_name='', fringe_image='', method='weighted', max_control_points=50, detection_sigma=5, min_area=9):
+def image_combine(corrected_images, output='', log_name='', fringe_image='', method='weighted', max_control_points=50,
+                  detection_sigma=5, min_area=9, kappa=3., memory_limit=stacking.default_memory_limit, scratch_dir=None,
+                  workers=1):
     """
     Register and combine a list of FITS images using affine transformation.
 
@@ -330,8 +310,10 @@ def image_combine(corrected_images, output='', log_name='', fringe_image='', met
         If given, this image will be subtracted from each input image before combination.
 
     method : str  [default='weighted']
-        Method for image combination: mean, median or weighted.
-        By default an inverse-variance weighting is used.
+        Method for image combination: mean, median, weighted or clipped.
+        By default an inverse-variance weighting is used. The clipped combination
+        is inverse-variance weighted after rejecting pixels deviating from the median
+        by more than `kappa` times their uncertainty.
 
     max_control_points : int  [default=50]
         Maximum number of control point-sources to find the transformation.
@@ -343,19 +325,37 @@ def image_combine(corrected_images, output='', log_name='', fringe_image='', met
     min_area : int  [default=9]
         Minimum number of connected pixels to be considered a source
 
+    kappa : float  [default=3.]
+        Rejection threshold in units of the pixel uncertainty for the clipped combination
+
+    memory_limit : float  [default=1024]
+        Memory budget in MB for the tiled image combination.
+        The registered images are kept in a scratch file on disk.
+
+    scratch_dir : str  [default=None]
+        Directory of the scratch file. By default, the system temporary directory is used.
+
+    workers : int  [default=1]
+        Number of processes used to register the images
+
     Returns
     -------
     output_msg : str
         Log of messages from the function call.
     """
     msg = list()
+    if method not in ['median', 'mean', 'clipped']:
+        method = 'weighted'
     if fringe_image != '':
-        norm_sky = fits.getdata(fringe_image)
+        norm_sky, _ = read_image_data(fringe_image)
         msg.append("          - Loaded normalized fringe image: %s" % fringe_image)
     else:
         norm_sky = 1.
     target_fname = corrected_images[0]
     target, target_err, target_mask, target_hdr = load_fits_image(target_fname)
+    target = target.astype(np.float64)
+    target_err = target_err.astype(np.float64)
+    target_mask = target_mask.astype(int)
     target = target - norm_sky*np.median(target)
     exptime = instrument.get_exptime(target_hdr)
     target /= exptime
@@ -364,91 +364,77 @@ def image_combine(corrected_images, output='', log_name='', fringe_image='', met
     msg.append("          - Aligning all images to reference: %s" % target_fname)
 
     msg.append("          - Registering input images:")
-    shifted_images = [target]
-    shifted_vars = [target_err**2]
-    target = target.byteswap().newbyteorder()
-    if target.dtype.byteorder != '<':
-        target = target.byteswap().newbyteorder()
-    final_exptime = exptime
-    image_log = list()
-    if len(corrected_images) > 1:
-        for fname in corrected_images[1:]:
-            msg.append("          - Input image: %s" % fname)
-            source, source_err, source_mask, hdr_i = load_fits_image(fname)
-            source = source - norm_sky*np.median(source)
-            exptime = instrument.get_exptime(hdr_i)
-            source /= exptime
-            source_err /= exptime
-            final_exptime += exptime
+    # The registered images and variances are kept on disk and combined in tiles of rows:
+    shifted_images = stacking.ScratchCube(len(corrected_images), scratch_dir=scratch_dir)
+    shifted_vars = stacking.ScratchCube(len(corrected_images), scratch_dir=scratch_dir)
+    with shifted_images, shifted_vars:
+        shifted_images.append(target)
+        shifted_vars.append(target_err**2)
+        final_exptime = exptime
+        image_log = list()
+        if len(corrected_images) > 1:
+            # The asterisms of the reference image are used for all the images:
+            target_points = registration.get_control_points(target_fname, target, detection_sigma=detection_sigma,
+                                                            min_area=min_area,
+                                                            max_control_points=max_control_points)
             try:
-                transf, (coords) = aa.find_transform(source, target,
-                                                     max_control_points=max_control_points,
-                                                     detection_sigma=detection_sigma,
-                                                     min_area=min_area)
-            except:
-                msg.append(" [ERROR]  - Failed to find image transformation!")
-                msg.append("          - Skipping image")
-                continue
-
-            source = source.byteswap().newbyteorder()
-            source_err = source_err.byteswap().newbyteorder()
-            source_mask = source_mask.byteswap().newbyteorder()
-            if source.dtype.byteorder != '<':
-                source = source.byteswap().newbyteorder()
-            if source_err.dtype.byteorder != '<':
-                source_err = source_err.byteswap().newbyteorder()
-            if source_mask.dtype.byteorder != '<':
-                source_mask = source_mask.byteswap().newbyteorder()
-
-            registered_image, _ = aa.apply_transform(transf, source, target, fill_value=0)
-            registered_error, _ = aa.apply_transform(transf, source_err, target, fill_value=0)
-            registered_mask, _ = aa.apply_transform(transf, source_mask, target, fill_value=0)
-            target_mask += 1 * (registered_mask > 0)
-            registered_error[registered_error == 0] = np.mean(registered_error)*10
-            shifted_images.append(registered_image)
-            shifted_vars.append(registered_error**2)
-            source_list, target_list = coords
-            if len(image_log) == 0:
-                fwhm, ratio, seeing_msg = measure_seeing(target, target_list)
-                image_log.append([os.path.basename(target_fname), fwhm, ratio, exptime])
+                target_asterisms = registration.Asterisms(target_points)
+            except ValueError as e:
+                msg.append(" [ERROR]  - Failed to find control points in the reference image!")
+                msg.append(" [ERROR]  - " + str(e))
+                target_asterisms = None
+
+            frame_args = (target_asterisms, target.shape, norm_sky, max_control_points, detection_sigma, min_area)
+            all_results = register_frames(corrected_images[1:], frame_args, workers=workers)
+            for fname, (exptime, result, frame_msg) in zip(corrected_images[1:], all_results):
+                msg += frame_msg
+                final_exptime += exptime
+                if result is None:
+                    continue
+                registered_image, registered_var, registered_mask, target_list, seeing = result
+                target_mask += 1 * registered_mask
+                shifted_images.append(registered_image)
+                shifted_vars.append(registered_var)
+                fwhm, ratio, seeing_msg = seeing
+                if len(image_log) == 0:
+                    target_fwhm, target_ratio, target_seeing_msg = measure_seeing(target, target_list)
+                    image_log.append([os.path.basename(target_fname), target_fwhm, target_ratio, exptime])
+                    if target_seeing_msg:
+                        msg.append(target_seeing_msg)
                 if seeing_msg:
                     msg.append(seeing_msg)
-            fwhm, ratio, seeing_msg = measure_seeing(source, source_list)
-            if seeing_msg:
-                msg.append(seeing_msg)
-            exptime_i = instrument.get_exptime(hdr_i)
-            image_log.append([os.path.basename(fname), fwhm, ratio, exptime_i])
-
-        if log_name == '':
-            filter_name = instrument.get_filter(target_hdr)
-            target_name = instrument.get_object(target_hdr)
-            log_name = 'filelist_%s_%s.txt' % (target_name, filter_name)
-        save_file_log(log_name, image_log, target_hdr)
-        msg.append(" [OUTPUT] - Saved file log and image stats: %s" % log_name)
-
-        if method == 'median':
-            final_image = np.nanmedian(shifted_images, axis=0)
-            final_error = np.sqrt(np.nanmean(shifted_vars, axis=0))
-            target_hdr['COMBINE'] = "Median"
-        elif method == 'mean':
-            final_image = np.nanmean(shifted_images, axis=0)
-            final_error = np.sqrt(np.nanmean(shifted_vars, axis=0))
-            target_hdr['COMBINE'] = "Mean"
+                image_log.append([os.path.basename(fname), fwhm, ratio, exptime])
+
+            if log_name == '':
+                filter_name = instrument.get_filter(target_hdr)
+                target_name = instrument.get_object(target_hdr)
+                log_name = 'filelist_%s_%s.txt' % (target_name, filter_name)
+            save_file_log(log_name, image_log, target_hdr)
+            msg.append(" [OUTPUT] - Saved file log and image stats: %s" % log_name)
+
+            final_image, final_error, N_rejected = stacking.combine_stack(shifted_images, shifted_vars,
+                                                                          method=method, kappa=kappa,
+                                                                          memory_limit=memory_limit)
+            if method == 'median':
+                target_hdr['COMBINE'] = "Median"
+            elif method == 'mean':
+                target_hdr['COMBINE'] = "Mean"
+            elif method == 'clipped':
+                target_hdr['COMBINE'] = "Sigma-clipped Inverse Variance Weighted"
+                msg.append("          - Rejecting pixels deviating from the median: kappa = %.1f" % kappa)
+                msg.append("          - Total number of rejected pixels: %i" % np.sum(N_rejected))
+            else:
+                target_hdr['COMBINE'] = "Inverse Variance Weighted"
+            final_mask = 1 * (target_mask > 0)
         else:
-            w = 1./np.array(shifted_vars)
-            shifted_images = np.array(shifted_images)
-            final_image = np.nansum(w*shifted_images, axis=0) / np.sum(w, axis=0)
-            final_error = np.sqrt(1. / np.nansum(w, axis=0))
-            target_hdr['COMBINE'] = "Inverse Variance Weighted"
-        final_mask = 1 * (target_mask > 0)
-    else:
-        final_image = target
-        final_error = target_err
-        final_mask = target_mask
-        target_hdr['COMBINE'] = "None"
-
-    target_hdr['NCOMBINE'] = len(shifted_images)
-    target_hdr['EXPTIME'] = final_exptime / len(shifted_images)
+            final_image = target
+            final_error = target_err
+            final_mask = target_mask
+            target_hdr['COMBINE'] = "None"
+
+        N_combined = len(shifted_images)
+    target_hdr['NCOMBINE'] = N_combined
+    target_hdr['EXPTIME'] = final_exptime / N_combined
     # Fix NaN values from negative pixel values:
     err_NaN = np.isnan(final_error)
     final_error[err_NaN] = np.nanmean(final_error)*100
@@ -477,6 +463,86 @@ def image_combine(corrected_images, output='', log_name='', fringe_image='', met
     return output_msg
 
 
+def register_frame(fname, target, target_shape, norm_sky=1., max_control_points=50, detection_sigma=5, min_area=9):
+    """
+    Register the image `fname` to the reference image for `image_combine`.
+    The image is sky subtracted and scaled to counts per second as the reference image.
+
+    Parameters
+    ----------
+    fname : str
+        Filename of the image to register
+
+    target : :class:`pynot.registration.Asterisms`
+        Control point asterisms of the reference image
+
+    target_shape : tuple(int, int)
+        Shape of the reference image
+
+    norm_sky : float or np.array  [default=1.]
+        Normalized fringe image, see `image_combine`
+
+    Returns
+    -------
+    exptime : float
+        Exposure time of the image
+
+    result : tuple or None
+        The registered image, variance and mask, the matched control points in the reference image,
+        and the seeing measurement (fwhm, ratio, msg) of the image.
+        None if no transformation was found.
+
+    msg : list(str)
+        Log of messages from the function call.
+    """
+    msg = list()
+    msg.append("          - Input image: %s" % fname)
+    source, source_err, source_mask, hdr_i = load_fits_image(fname)
+    source = source.astype(np.float64)
+    source_err = source_err.astype(np.float64)
+    source = source - norm_sky*np.median(source)
+    exptime = instrument.get_exptime(hdr_i)
+    source /= exptime
+    source_err /= exptime
+    try:
+        source_points = registration.get_control_points(fname, source, detection_sigma=detection_sigma,
+                                                        min_area=min_area, max_control_points=max_control_points)
+        transf, (source_list, target_list) = registration.find_transform(registration.Asterisms(source_points),
+                                                                         target)
+    except Exception:
+        msg.append(" [ERROR]  - Failed to find image transformation!")
+        msg.append("          - Skipping image")
+        return exptime, None, msg
+
+    registered, _ = registration.warp_frame(transf, [source, source_err, source_mask], target_shape, fill_value=0)
+    registered_image, registered_error, registered_mask = registered
+    registered_error[registered_error == 0] = np.mean(registered_error)*10
+    seeing = measure_seeing(source, source_list)
+    result = (registered_image, registered_error**2, registered_mask > 0, target_list, seeing)
+    return exptime, result, msg
+
+
+def register_frames(filenames, frame_args, workers=1):
+    """
+    Register the images `filenames` using `register_frame` with the arguments `frame_args`
+    on a pool of `workers` processes. The results are yielded in the order of `filenames`
+    and at most 2*`workers` registered images are kept in memory at a time.
+    """
+    if workers <= 1:
+        for fname in filenames:
+            yield register_frame(fname, *frame_args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for fname in filenames:
+            pending.append(executor.submit(register_frame, fname, *frame_args))
+            if len(pending) >= 2*workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def plot_image2D(fname, image, vmin=-2, vmax=2):
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -514,8 +580,12 @@ def create_fringe_image(input_filenames, output='', fig_fname='', threshold=3.0)
     """
     msg = list()
     hdr = instrument.get_header(input_filenames[0])
-    img_list = [fits.getdata(fname) for fname in input_filenames]
-    exptimes = [instrument.get_exptime(fits.getheader(fname)) for fname in input_filenames]
+    img_list = list()
+    exptimes = list()
+    for fname in input_filenames:
+        data, _, hdr_i = read_fits_image(fname)
+        img_list.append(data.astype(np.float64))
+        exptimes.append(instrument.get_exptime(hdr_i))
     filter_name = instrument.get_filter(hdr)
     msg.append("          - Loaded input images")
     msg.append("          - Filter : %s" % filter_name)
@@ -567,29 +637,33 @@ def match_phot_catalogs(sep, phot, match_radius=1.):
         An astropy table of sources in the reference `phot` catalog that have matches
         in the SEP source catalog.
     """
-    matched_sep = list()
-    matched_phot = list()
-    refs = np.array([phot['ra'], phot['dec']]).T
-    for row in sep:
-        xy = np.array([row['ra'], row['dec']])
-        dist = np.sqrt(np.sum((refs - xy)**2, axis=1))
-        index = np.argmin(dist)
-        if np.min(dist) < match_radius/3600.:
-            matched_phot.append(np.array(phot[index]))
-            matched_sep.append(np.array(row))
-    matched_sep = np.array(matched_sep)
-    matched_phot = np.array(matched_phot)
-    return Table(matched_sep), Table(matched_phot)
+    index, ref_index, _ = match_nearest(sep['ra'], sep['dec'], phot['ra'], phot['dec'],
+                                        match_radius=match_radius)
+    return Table(sep[index]), Table(phot[ref_index])
 
 
 def get_sdss_catalog(ra, dec, radius=4.):
-    """Download the SDSS photometry using astroquery for a circular region of radius in deg."""
+    """
+    Get the SDSS photometry for a circular region of radius in arcmin.
+    The sources are taken from the local reference catalog store if the field has
+    been downloaded before, otherwise SDSS is queried (see `pynot.refcat`).
+    Returns None if there are no SDSS sources in the region.
+    """
+    sdss_result, _ = refcat.query_catalog('sdss', ra, dec, radius,
+                                          lambda: query_sdss_archive(ra, dec, radius))
+    if sdss_result is None or len(sdss_result) == 0:
+        return None
+    return sdss_result
+
+
+def query_sdss_archive(ra, dec, radius=4.):
+    """Download the SDSS photometry using astroquery for a circular region of radius in arcmin."""
     catalog_fname = 'sdss_phot_%.2f%+.2f.csv' % (ra, dec)
     fields = ['ra', 'dec', 'psfMag_u', 'psfMag_g', 'psfMag_r', 'psfMag_i', 'psfMag_z',
               'psfMagErr_u', 'psfMagErr_g', 'psfMagErr_r', 'psfMagErr_i', 'psfMagErr_z']
     field_center = SkyCoord(ra, dec, frame='icrs', unit='deg')
-    sdss_result = SDSS.query_region(field_center, radius*u.arcmin, photoobj_fields=fields)
-    if sdss_result is not None:
+    sdss_result = SDSS.query_region(field_center, radius=radius*u.arcmin, photoobj_fields=fields)
+    if sdss_result is not None and os.path.isdir(obs.output_base_phot):
         sdss_result.write(os.path.join(obs.output_base_phot, catalog_fname), format='ascii.csv', overwrite=True)
     return sdss_result
 
@@ -638,7 +712,10 @@ def flux_calibration_sdss(img_fname, sep_fname, fig_fname='', q_lim=0.8, kappa=3
     hdr = fits.getheader(img_fname)
     msg.append("          - Loaded image: %s" % img_fname)
     radius = np.sqrt(hdr['CD1_1']**2 + hdr['CD1_2']**2)*60 * hdr['NAXIS1'] / np.sqrt(2)
-    msg.append("          - Downloading SDSS photometric catalog...")
+    if refcat.store.is_covered('sdss', hdr['CRVAL1'], hdr['CRVAL2'], radius):
+        msg.append("          - Loading SDSS photometric catalog from local store: %s" % refcat.store.root)
+    else:
+        msg.append("          - Downloading SDSS photometric catalog...")
     try:
         sdss_cat = get_sdss_catalog(hdr['CRVAL1'], hdr['CRVAL2'], radius)
     except:
@@ -2,20 +2,24 @@
 Automatically Classify and Reduce a given Data Set
 """
 
-from astropy.io import fits
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import matplotlib.pyplot as plt
 import os
 import sys
+import traceback
 import numpy as np
 
-from pynot import instrument
 from pynot.data import io
 from pynot.data import organizer as do
 from pynot.data import obs
+from pynot.data.calibplan import CalibrationTable
 from pynot.phot import image_combine, create_fringe_image, source_detection, flux_calibration_sdss
 from pynot.calibs import combine_bias_frames, combine_flat_frames
 from pynot.functions import get_options, get_version_number
 from pynot.scired import raw_correction, correct_cosmics, trim_filter_edge, detect_filter_edge
+from pynot.product import checkpoint_fname, set_dtype_policy, get_dtype_policy, float64_products, compare_products
+from pynot.calibpool import set_pool_limit
 from pynot.wcs import correct_wcs
 from pynot.logging import Report
 
@@ -27,6 +31,278 @@ defaults_fname = os.path.join(calib_dir, 'default_options_img.yml')
 __version__ = get_version_number()
 
 
+def process_frame(sci_img, output_dir, master_bias_fname, flat_fname, image_region, crr_options, checkpoint, log):
+    """
+    Process a single science frame: bias and flat field correction, trimming of the filter edges
+    and cosmic ray rejection (if `crr_options['niter']` > 0).
+    The image is passed between the steps in memory and only the final image is saved,
+    together with the intermediate images selected by `checkpoint`.
+
+    Parameters
+    ==========
+    sci_img : :class:`pynot.data.organizer.RawImage`
+        The raw science frame
+
+    output_dir : str
+        Directory of the processed images
+
+    master_bias_fname : str
+        Filename of the master bias
+
+    flat_fname : str
+        Filename of the combined flat field for the filter of the frame
+
+    image_region : tuple(int)
+        The edges of the illuminated image region: (x1, x2, y1, y2)
+
+    crr_options : dict
+        Parameters for `correct_cosmics`
+
+    checkpoint : list(str) or str
+        The intermediate images to save: 'proc', 'trim' or 'all'
+
+    log : :class:`pynot.logging.Report`
+        The log of the pipeline
+
+    Returns
+    =======
+    corrected_fname : str
+        Filename of the final processed image
+
+    temp_images : list(str)
+        Filenames of the saved intermediate images
+    """
+    log.write("Filename: %s" % sci_img.filename)
+    basename = os.path.basename(sci_img.filename)
+    corrected_fname = os.path.join(output_dir, 'proc_'+basename)
+    trim_fname = os.path.join(output_dir, 'trim_'+basename)
+    crr_fname = os.path.join(output_dir, 'crr_'+basename)
+    temp_images = list()
+    # Bias correction, Flat correction
+    try:
+        output = checkpoint_fname(corrected_fname, 'proc', checkpoint)
+        image, _ = raw_correction(sci_img.data, sci_img.header.copy(), master_bias_fname, flat_fname,
+                                  output=output, overwrite=True, mode='img')
+        log.commit("          - bias+flat ")
+        if output:
+            temp_images.append(output)
+    except:
+        log.error("Bias and flat field correction failed!")
+        raise
+
+    # Trim edges:
+    try:
+        if crr_options['niter'] > 0:
+            output = checkpoint_fname(trim_fname, 'trim', checkpoint)
+        else:
+            output = trim_fname
+        image, _ = trim_filter_edge(image, *image_region, output=output)
+        log.commit(" trim ")
+    except:
+        log.error("Image trim failed!")
+        raise
+
+    # Correct Cosmic Rays Hits:
+    if crr_options['niter'] > 0:
+        try:
+            log.commit(" crr ")
+            image, _ = correct_cosmics(image, crr_fname, **crr_options)
+            log.commit("  [done]")
+            if output:
+                temp_images.append(output)
+        except:
+            log.error("Cosmic ray correction failed!")
+            raise
+    log.commit("\n")
+
+    # Compare to the processing in float64:
+    if get_dtype_policy()['validate']:
+        with float64_products():
+            reference, _ = raw_correction(sci_img.data, sci_img.header.copy(), master_bias_fname, flat_fname, mode='img')
+            reference, _ = trim_filter_edge(reference, *image_region)
+            if crr_options['niter'] > 0:
+                reference, _ = correct_cosmics(reference, '', **crr_options)
+        log.write("Validation against float64 processing:")
+        log.commit(compare_products(image, reference) + "\n")
+    return image.filename, temp_images
+
+
+def reduce_stack(corrected_images, temp_images, target_name, filter_name, output_dir, options, log):
+    """
+    Combine the processed images of a target in a given filter, followed by source extraction,
+    WCS calibration and zero point calibration (for SDSS filters).
+    The combined image is saved in the parent directory of `output_dir`.
+    """
+    output_obj_base = os.path.dirname(output_dir)
+    N_images = len(corrected_images)
+    # Create Fringe image:
+    if options['skysub']['defringe'] and N_images > 3:
+        log.write("Running task: Creating Average Fringe Image")
+        fringe_fname = os.path.join(output_dir, 'fringe_image_%s.fits' % filter_name)
+        fringe_pdf_fname = os.path.join(output_dir, 'fringe_image_%s.pdf' % filter_name)
+        try:
+            msg = create_fringe_image(corrected_images, output=fringe_fname, fig_fname=fringe_pdf_fname,
+                                      threshold=3)
+            log.commit(msg)
+            log.add_linebreak()
+        except:
+            log.error("Image combination failed!")
+            raise
+    elif options['skysub']['defringe'] and N_images <= 3:
+        log.warn("No fringe image can be created. Need at least 3 images.")
+        fringe_fname = ''
+    else:
+        fringe_fname = ''
+
+
+    # Combine individual images for a given filter:
+    log.write("Running task: Image Combination")
+    comb_log_name = os.path.join(output_dir, 'filelist_%s.txt' % target_name)
+    combined_fname = os.path.join(output_obj_base, '%s_%s.fits' % (target_name, filter_name))
+    try:
+        output_msg = image_combine(corrected_images, output=combined_fname, log_name=comb_log_name,
+                                   fringe_image=fringe_fname, **options['combine'])
+        log.commit(output_msg)
+        log.add_linebreak()
+    except (IndexError, FileNotFoundError, OSError) as e:
+        log.error("Image combination failed!")
+        log.error(str(e))
+        raise
+
+
+    # Automatic Source Detection and Aperture Photometry:
+    try:
+        log.write("Running task: Source Extraction")
+        sep_fname, _, output_msg = source_detection(combined_fname, zeropoint=0,
+                                                    kwargs_bg=options['sep-background'],
+                                                    kwargs_ext=options['sep-extract'])
+        log.commit(output_msg)
+        log.add_linebreak()
+    except:
+        log.error("Source extraction failed!")
+        raise
+
+
+    # Calibrate WCS:
+    try:
+        log.write("Running task: WCS calibration")
+        output_msg = correct_wcs(combined_fname, sep_fname, **options['wcs'])
+        log.commit(output_msg)
+        log.add_linebreak()
+    except:
+        log.error("WCS calibration failed!")
+        raise
+
+
+    # Calculate Zero Point:
+    if 'SDSS' in filter_name.upper():
+        try:
+            log.write("Running task: Self-calibration of magnitude zero point")
+            output_msg = flux_calibration_sdss(combined_fname, sep_fname, **options['sdss_flux'])
+            log.commit(output_msg)
+            log.add_linebreak()
+        except:
+            log.error("Zero point calibration failed!")
+            raise
+
+    # Clean up temporary files:
+    if options['clean'] and temp_images:
+        log.write("Cleaning up temporary images:")
+        for fname in temp_images:
+            os.system("rm %s" % fname)
+            log.write(fname)
+        log.add_linebreak()
+
+
+def start_stack_log(log, target_name, filter_name, output_dir, N_frames):
+    log.write("Target Name: %s" % target_name, prefix=' [TARGET] - ')
+    log.write("Filter : %s" % filter_name)
+    log.write("Saving images to directory: %s" % output_dir)
+    log.write("Number of frames: %i" % N_frames)
+    log.add_linebreak()
+    log.write("Running task: bias and flat field correction:")
+
+
+def _init_worker(dtype_options, calib_pool):
+    # The worker processes never show figures:
+    plt.switch_backend('Agg')
+    set_dtype_policy(**dtype_options)
+    set_pool_limit(calib_pool)
+
+
+def _run_in_worker(func, *args):
+    """
+    Run `func` in a worker process using a separate log.
+    The log lines and any exception are returned to the main process.
+    """
+    log = Report(verbose=False)
+    try:
+        result = func(*args, log=log)
+    except Exception as error:
+        traceback.print_exc()
+        return None, log.lines, error
+    return result, log.lines, None
+
+
+def run_parallel(stacks, master_bias_fname, master_flat, filter_edges, options, obdb, log, workers):
+    """
+    Process all frames of the target/filter `stacks` on a pool of `workers` processes.
+    The combination of a stack is started as soon as all its frames are processed,
+    so that independent stacks are reduced concurrently. The log of each stack is
+    written to the main log when the stack is finished.
+    The first failure stops the pool and the exception is raised.
+    """
+    frame_results = [[None]*len(stack[3]) for stack in stacks]
+    frames_left = [len(stack[3]) for stack in stacks]
+    tasks = dict()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(options['dtype'], options['calib_pool'])) as executor:
+        for num, (target_name, filter_name, output_dir, image_list) in enumerate(stacks):
+            for index, sci_img in enumerate(image_list):
+                future = executor.submit(_run_in_worker, process_frame, sci_img, output_dir, master_bias_fname,
+                                         master_flat[sci_img.filter], filter_edges[filter_name], options['crr'],
+                                         options['checkpoint'])
+                tasks[future] = (num, index)
+
+        pending = set(tasks)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                num, index = tasks[future]
+                target_name, filter_name, output_dir, image_list = stacks[num]
+                result, lines, error = future.result()
+                if index is not None:
+                    frame_results[num][index] = (result, lines)
+                    frames_left[num] -= 1
+                    if error is None and frames_left[num] > 0:
+                        continue
+
+                if index is None or error is not None:
+                    # Write the log of the finished (or failed) stack:
+                    start_stack_log(log, target_name, filter_name, output_dir, len(image_list))
+                    for frame_result in frame_results[num]:
+                        if frame_result is not None:
+                            log.commit(''.join(frame_result[1]))
+                    if index is None:
+                        log.add_linebreak()
+                        log.commit(''.join(lines))
+
+                if error is not None:
+                    executor.shutdown(cancel_futures=True)
+                    log.fatal_error()
+                    raise error
+
+                if index is not None:
+                    # All frames are processed, start the combination:
+                    corrected_images = [frame_result[0][0] for frame_result in frame_results[num]]
+                    temp_images = sum([frame_result[0][1] for frame_result in frame_results[num]], [])
+                    future = executor.submit(_run_in_worker, reduce_stack, corrected_images, temp_images,
+                                             target_name, filter_name, output_dir, options)
+                    tasks[future] = (num, None)
+                    pending.add(future)
+                else:
+                    obdb.update(output_dir, 'DONE')
+
 
 def run_pipeline(options_fname, verbose=False, force_restart=False):
     log = Report(verbose)
@@ -43,6 +319,8 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
             options[section_name].update(section)
         else:
             options[section_name] = section
+    set_dtype_policy(**options['dtype'])
+    set_pool_limit(options['calib_pool'])
 
     dataset_fname = options['dataset']
     if dataset_fname and os.path.exists(dataset_fname):
@@ -97,8 +375,9 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
         return
 
     flat_images = database['IMG_FLAT']
+    flat_records = database.index.get_records(flat_images)
     for flat_file in flat_images:
-        this_filter = instrument.get_filter(fits.getheader(flat_file))
+        this_filter = flat_records[flat_file]['filter']
         if this_filter in filter_list:
             flat_images_for_filter[this_filter].append(flat_file)
 
@@ -109,7 +388,8 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
 
     # Combine Bias Frames matched for CCD setup:
     master_bias_fname = os.path.join(output_base, 'MASTER_BIAS.fits')
-    bias_frames = raw_image_list[0].match_files(database['BIAS'], date=False)
+    bias_table = CalibrationTable.from_index(database['BIAS'], database.index)
+    bias_frames = bias_table.match(raw_image_list[0], date=False)
     if len(bias_frames) < 3:
         log.error("Must have at least 3 bias frames to combine, not %i" % len(bias_frames))
         log.error("otherwise provide a static 'master bias' frame!")
@@ -120,6 +400,9 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
         try:
             _, bias_msg = combine_bias_frames(bias_frames, output=master_bias_fname, mode='img',
                                               kappa=options['bias']['kappa'], method=options['bias']['method'],
+                                              memory_limit=options['bias']['memory_limit'],
+                                              incremental=options['bias']['incremental'],
+                                              accum_dir=options['bias']['accum_dir'],
                                               overwrite=True)
             log.commit(bias_msg)
             log.add_linebreak()
@@ -140,6 +423,7 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
             _, flat_msg = combine_flat_frames(flat_frames, comb_flat_fname, mbias=master_bias_fname,
                                               kappa=options['flat']['kappa'],
                                               method=options['flat']['method'],
+                                              memory_limit=options['flat']['memory_limit'],
                                               overwrite=True, mode='img')
             log.commit(flat_msg)
             master_flat[filter_name] = comb_flat_fname
@@ -175,6 +459,9 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
         log.write("Cosmic Ray Rejection : True")
         log.write("All individual images will be cleaned")
         log.add_linebreak()
+
+    # Collect the target/filter stacks to reduce:
+    stacks = list()
     for target_name, images_per_filter in object_images.items():
         # Create working directory:
         if ' ' in target_name:
@@ -183,8 +470,6 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
         if not os.path.exists(output_obj_base):
             os.mkdir(output_obj_base)
 
-        log.write("Target Name: %s" % target_name, prefix=' [TARGET] - ')
-
         for filter_name, image_list in images_per_filter.items():
             # Create working directory:
             output_dir = os.path.join(output_obj_base, filter_name)
@@ -196,159 +481,39 @@ def run_pipeline(options_fname, verbose=False, force_restart=False):
                 continue
             if not os.path.exists(output_dir):
                 os.mkdir(output_dir)
-            log.write("Filter : %s" % filter_name)
-            log.write("Saving images to directory: %s" % output_dir)
-            log.write("Number of frames: %i" % len(image_list))
-            log.add_linebreak()
-            log.write("Running task: bias and flat field correction:")
+            stacks.append((target_name, filter_name, output_dir, image_list))
 
+    workers = options['workers']
+    if workers > 1:
+        N_frames = sum([len(stack[3]) for stack in stacks])
+        log.write("Reducing %i frames in %i stacks using %i processes" % (N_frames, len(stacks), workers))
+        log.add_linebreak()
+        run_parallel(stacks, master_bias_fname, master_flat, filter_edges, options, obdb, log, workers)
+    else:
+        for target_name, filter_name, output_dir, image_list in stacks:
+            start_stack_log(log, target_name, filter_name, output_dir, len(image_list))
             corrected_images = list()
             temp_images = list()
             for sci_img in image_list:
-                log.write("Filename: %s" % sci_img.filename)
-                basename = os.path.basename(sci_img.filename)
-                corrected_fname = os.path.join(output_dir, 'proc_'+basename)
-                trim_fname = os.path.join(output_dir, 'trim_'+basename)
-                crr_fname = os.path.join(output_dir, 'crr_'+basename)
-                # Bias correction, Flat correction
-                flat_fname = master_flat[sci_img.filter]
                 try:
-                    _ = raw_correction(sci_img.data, sci_img.header, master_bias_fname, flat_fname,
-                                       output=corrected_fname, overwrite=True, mode='img')
-                    log.commit("          - bias+flat ")
-                    temp_images.append(corrected_fname)
-                except:
-                    log.error("Bias and flat field correction failed!")
+                    corrected_fname, temp_fnames = process_frame(sci_img, output_dir, master_bias_fname,
+                                                                 master_flat[sci_img.filter],
+                                                                 filter_edges[filter_name],
+                                                                 options['crr'], options['checkpoint'], log=log)
+                except Exception:
                     log.fatal_error()
                     print("Unexpected error:", sys.exc_info()[0])
                     raise
-
-                # Trim edges:
-                image_region = filter_edges[filter_name]
-                try:
-                    _ = trim_filter_edge(corrected_fname, *image_region, output=trim_fname)
-                    log.commit(" trim ")
-                except:
-                    log.error("Image trim failed!")
-                    log.fatal_error()
-                    print("Unexpected error:", sys.exc_info()[0])
-                    raise
-
-                # Correct Cosmic Rays Hits:
-                if options['crr']['niter'] > 0:
-                    try:
-                        log.commit(" crr ")
-                        _ = correct_cosmics(trim_fname, crr_fname, **options['crr'])
-                        log.commit("  [done]")
-                        corrected_images.append(crr_fname)
-                        temp_images.append(trim_fname)
-                    except:
-                        log.error("Cosmic ray correction failed!")
-                        log.fatal_error()
-                        print("Unexpected error:", sys.exc_info()[0])
-                        raise
-                else:
-                    corrected_images.append(trim_fname)
-                log.commit("\n")
-
+                corrected_images.append(corrected_fname)
+                temp_images += temp_fnames
             log.add_linebreak()
 
-
-            N_images = len(corrected_images)
-            # Create Fringe image:
-            if options['skysub']['defringe'] and N_images > 3:
-                log.write("Running task: Creating Average Fringe Image")
-                fringe_fname = os.path.join(output_dir, 'fringe_image_%s.fits' % filter_name)
-                fringe_pdf_fname = os.path.join(output_dir, 'fringe_image_%s.pdf' % filter_name)
-                try:
-                    msg = create_fringe_image(corrected_images, output=fringe_fname, fig_fname=fringe_pdf_fname,
-                                              threshold=3)
-                    log.commit(msg)
-                    log.add_linebreak()
-                except:
-                    log.error("Image combination failed!")
-                    log.fatal_error()
-                    print("Unexpected error:", sys.exc_info()[0])
-                    raise
-            elif options['skysub']['defringe'] and N_images <= 3:
-                log.warn("No fringe image can be created. Need at least 3 images.")
-            else:
-                fringe_fname = ''
-
-
-            # Combine individual images for a given filter:
-            if len(image_list) > 50:
-                log.warn("Large amounts of memory needed for image combination!", force=True)
-                log.warn("A total of %i images will be combined." % len(image_list), force=True)
-
-            log.write("Running task: Image Combination")
-            comb_log_name = os.path.join(output_dir, 'filelist_%s.txt' % target_name)
-            combined_fname = os.path.join(output_obj_base, '%s_%s.fits' % (target_name, filter_name))
             try:
-                output_msg = image_combine(corrected_images, output=combined_fname, log_name=comb_log_name,
-                                           fringe_image=fringe_fname, **options['combine'])
-                log.commit(output_msg)
-                log.add_linebreak()
-            except (IndexError, FileNotFoundError, OSError) as e:
-                log.error("Image combination failed!")
-                log.error(str(e))
-                log.fatal_error()
-                return
-            except:
-                log.datal_error()
-                print("Unexpected error:", sys.exc_info()[0])
-                raise
-
-
-            # Automatic Source Detection and Aperture Photometry:
-            try:
-                log.write("Running task: Source Extraction")
-                sep_fname, _, output_msg = source_detection(combined_fname, zeropoint=0,
-                                                            kwargs_bg=options['sep-background'],
-                                                            kwargs_ext=options['sep-extract'])
-                log.commit(output_msg)
-                log.add_linebreak()
-            except:
-                log.error("Source extraction failed!")
-                log.fatal_error()
-                print("Unexpected error:", sys.exc_info()[0])
-                raise
-
-
-            # Calibrate WCS:
-            try:
-                log.write("Running task: WCS calibration")
-                output_msg = correct_wcs(combined_fname, sep_fname, **options['wcs'])
-                log.commit(output_msg)
-                log.add_linebreak()
-            except:
-                log.error("WCS calibration failed!")
+                reduce_stack(corrected_images, temp_images, target_name, filter_name, output_dir, options, log=log)
+            except Exception:
                 log.fatal_error()
                 print("Unexpected error:", sys.exc_info()[0])
                 raise
-
-
-            # Calculate Zero Point:
-            if 'SDSS' in filter_name.upper():
-                try:
-                    log.write("Running task: Self-calibration of magnitude zero point")
-                    output_msg = flux_calibration_sdss(combined_fname, sep_fname, **options['sdss_flux'])
-                    log.commit(output_msg)
-                    log.add_linebreak()
-                except:
-                    log.error("Zero point calibration failed!")
-                    log.fatal_error()
-                    print("Unexpected error:", sys.exc_info()[0])
-                    raise
-
-            # Clean up temporary files:
-            if options['clean']:
-                log.write("Cleaning up temporary images:")
-                for fname in temp_images:
-                    os.system("rm %s" % fname)
-                    log.write(fname)
-                log.add_linebreak()
-
             obdb.update(output_dir, 'DONE')
 
     log.exit()
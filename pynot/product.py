@@ -0,0 +1,265 @@
+# -*- coding: UTF-8 -*-
+"""
+In-memory image products passed between the processing steps of the pipelines.
+
+An image product holds the data, error, mask and header of a processed frame
+together with any additional image extensions (e.g., the 2D sky model 'SKY').
+The processing steps (`raw_correction`, `rectify`, `auto_fit_background`,
+`correct_cosmics`, `flux_calibrate` and `trim_filter_edge`) accept either a filename
+or an `ImageProduct` and return the resulting product, such that a chain of steps
+only needs to save the products that are requested.
+
+The data types of the stored extensions follow the `dtype_policy`: by default the image data
+and error are stored as float32 and the pixel mask as an 8-bit bitmask with the named bits
+given in `mask_bits`. The processing steps compute in float64 and only convert their results.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+from astropy.io import fits
+from contextlib import contextmanager
+import numpy as np
+
+from pynot.fitsio import native_byteorder
+
+
+# Data types of the image extensions of the pipeline products:
+dtype_policy = {'data': 'float32', 'mask': 'uint8', 'validate': False}
+data_types = ['float32', 'float64']
+mask_types = ['uint8', 'uint16']
+
+# Named bits of the pixel mask (value, name, description):
+mask_bits = [(1, 'COSMIC', 'Cosmic Ray Hits'),
+             (4, 'NANERR', 'NaN error from base CCD processing'),
+             ]
+
+
+class ImageProduct(object):
+    """
+    Image product kept in memory as a list of FITS extensions. The primary extension holds
+    the image data and header, the error and pixel mask are stored in the extensions
+    'ERR' and 'MASK' (if present).
+
+    The processing steps update the product in place and return it.
+    Use `copy()` to keep an unmodified version of a product.
+    """
+    def __init__(self, hdu_list, filename=''):
+        self.hdu_list = hdu_list
+        self.filename = filename
+
+    @classmethod
+    def read(cls, fname):
+        """
+        Load all extensions of the FITS file `fname` into memory.
+        The image extensions are converted to native byte order, see `native_byteorder`.
+        """
+        with fits.open(fname, memmap=False) as hdu_list:
+            hdus = list(hdu_list)
+            for hdu in hdus:
+                if hdu.data is None or not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)):
+                    continue
+                data = native_byteorder(hdu.data)
+                if data is not hdu.data:
+                    hdu.data = data
+        return cls(fits.HDUList(hdus), filename=fname)
+
+    def save(self, output='', overwrite=True):
+        """
+        Save the product to the FITS file `output`. If no filename is given, the product
+        is only kept in memory and is no longer associated with the file it was loaded from.
+        """
+        if output:
+            self.hdu_list.writeto(output, overwrite=overwrite)
+        self.filename = output
+
+    def copy(self):
+        hdus = [hdu.copy() for hdu in self.hdu_list]
+        return ImageProduct(fits.HDUList(hdus), filename=self.filename)
+
+    @property
+    def data(self):
+        return self.hdu_list[0].data
+
+    @data.setter
+    def data(self, value):
+        self.hdu_list[0].data = value
+
+    @property
+    def header(self):
+        return self.hdu_list[0].header
+
+    @header.setter
+    def header(self, value):
+        self.hdu_list[0].header = value
+
+    @property
+    def err(self):
+        if 'ERR' in self.hdu_list:
+            return self.hdu_list['ERR'].data
+        return None
+
+    @property
+    def mask(self):
+        if 'MASK' in self.hdu_list:
+            return self.hdu_list['MASK'].data
+        return None
+
+    def append(self, hdu):
+        self.hdu_list.append(hdu)
+
+    def __contains__(self, extname):
+        return extname in self.hdu_list
+
+    def __getitem__(self, key):
+        return self.hdu_list[key]
+
+    def __iter__(self):
+        return iter(self.hdu_list)
+
+    def __len__(self):
+        return len(self.hdu_list)
+
+    def __repr__(self):
+        extnames = [hdu.name for hdu in self.hdu_list]
+        return "<ImageProduct: %s  %r>" % (self.filename, extnames)
+
+
+def load_product(img):
+    """
+    Return the image product of `img`, which is either a filename or an `ImageProduct`.
+    Filenames are loaded into memory, products are returned as they are.
+    """
+    if isinstance(img, ImageProduct):
+        return img
+    return ImageProduct.read(img)
+
+
+def get_product_name(img):
+    """Name of the image `img` for the log: the filename or a description of the product"""
+    if isinstance(img, ImageProduct):
+        if img.filename:
+            return img.filename
+        return 'in-memory product'
+    return img
+
+
+def checkpoint_fname(fname, name, checkpoint):
+    """
+    Return the filename `fname` of the intermediate product `name` if the product is selected
+    by `checkpoint`, otherwise an empty string such that the product is only kept in memory.
+
+    Parameters
+    ==========
+    fname : string
+        Filename of the product
+
+    name : string
+        Name of the product, e.g., 'RECT2D'
+
+    checkpoint : list(str) or string
+        Names of the intermediate products to save (not case sensitive),
+        or 'all' to save every product
+
+    Returns
+    =======
+    output : string
+        Filename to pass as output of the processing step
+    """
+    if not checkpoint:
+        return ''
+    if isinstance(checkpoint, str):
+        checkpoint = [checkpoint]
+    checkpoint = [item.upper() for item in checkpoint]
+    if 'ALL' in checkpoint or name.upper() in checkpoint:
+        return fname
+    return ''
+
+
+def set_dtype_policy(data='float32', mask='uint8', validate=False):
+    """
+    Set the data types of the image products.
+
+    Parameters
+    ==========
+    data : string  [default='float32']
+        Data type of the image data and error: 'float32' or 'float64'
+
+    mask : string  [default='uint8']
+        Data type of the pixel bitmask: 'uint8' or 'uint16'
+
+    validate : bool  [default=False]
+        Compare the products of the pipelines to a reduction using float64
+        and report the maximum deviation
+    """
+    if data not in data_types:
+        raise ValueError("Invalid data type: %r. Must be one of %r" % (data, data_types))
+    if mask not in mask_types:
+        raise ValueError("Invalid mask type: %r. Must be one of %r" % (mask, mask_types))
+    dtype_policy['data'] = data
+    dtype_policy['mask'] = mask
+    dtype_policy['validate'] = bool(validate)
+
+
+def get_dtype_policy():
+    return dict(dtype_policy)
+
+
+@contextmanager
+def float64_products():
+    """Temporarily store the image data and error as float64, e.g., for validation"""
+    data_type = dtype_policy['data']
+    dtype_policy['data'] = 'float64'
+    try:
+        yield
+    finally:
+        dtype_policy['data'] = data_type
+
+
+def as_data_type(array):
+    """Convert the image data or error `array` to the data type of the policy"""
+    return np.asarray(array, dtype=dtype_policy['data'])
+
+
+def as_mask_type(array):
+    """Convert the pixel mask `array` to the bitmask type of the policy"""
+    return np.asarray(array, dtype=dtype_policy['mask'])
+
+
+def add_mask_bits(header):
+    """Document the named bits of the pixel mask in the FITS `header`"""
+    for value, name, descr in mask_bits:
+        bit = int(np.log2(value))
+        header['BIT%i' % bit] = (name, descr)
+    return header
+
+
+def compare_products(product, reference):
+    """
+    Maximum deviation between the image product `product` and the `reference` product
+    of the same processing in float64.
+
+    Returns
+    =======
+    output_msg : string
+        Log of the maximum absolute deviation of the data and error, the maximum deviation
+        of the data relative to the reference error and the number of differing mask pixels.
+    """
+    msg = list()
+    data = np.asarray(product.data, dtype=np.float64)
+    ref_data = np.asarray(reference.data, dtype=np.float64)
+    delta = np.abs(data - ref_data)
+    msg.append("          - Maximum deviation of data: %.2e" % np.nanmax(delta))
+    if product.err is not None and reference.err is not None:
+        ref_err = np.asarray(reference.err, dtype=np.float64)
+        delta_err = np.abs(np.asarray(product.err, dtype=np.float64) - ref_err)
+        msg.append("          - Maximum deviation of error: %.2e" % np.nanmax(delta_err))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel_delta = delta / ref_err
+        rel_delta = rel_delta[np.isfinite(rel_delta)]
+        if len(rel_delta) > 0:
+            msg.append("          - Maximum deviation of data relative to error: %.2e" % np.max(rel_delta))
+    if product.mask is not None and reference.mask is not None:
+        N_diff = np.sum((product.mask > 0) != (reference.mask > 0))
+        msg.append("          - Number of differing pixels in mask: %i" % N_diff)
+    return "\n".join(msg)
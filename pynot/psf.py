@@ -0,0 +1,317 @@
+# -*- coding: UTF-8 -*-
+"""
+Vectorized measurement of the point spread function (PSF) of stars.
+
+The cutouts around all stars are stacked into one array (N, ny, nx) and the shape
+of every star is measured at once: the adaptive (Gaussian weighted) second moments
+give the size, axis ratio and orientation of each star, and these can optionally be
+refined by a batched Levenberg-Marquardt fit of a 2D Gaussian to all the cutouts.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+import numpy as np
+
+
+def get_cutouts(img, centers, size=20):
+    """
+    Stack the cutouts of size 2*`size` by 2*`size` pixels around the `centers` of the stars.
+    Only stars whose cutout is fully inside the image are included.
+
+    Parameters
+    ==========
+    img : np.array, shape(N, M)
+        The image
+
+    centers : np.array, shape(K, 2)
+        Positions (x, y) of the stars in pixels
+
+    size : int  [default=20]
+        Half-size of the cutouts
+
+    Returns
+    =======
+    cutouts : np.array, shape(N_stars, 2*size, 2*size)
+        The background subtracted cutouts. The background is the median of the cutout.
+
+    x, y : np.array, shape(N_stars)
+        Positions of the stars relative to the lower left corner of their cutout
+
+    index : np.array(int)
+        Index in `centers` of the stars included in `cutouts`
+    """
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    good_x = (centers[:, 0] > size) & (centers[:, 0] < img.shape[1]-1-size)
+    good_y = (centers[:, 1] > size) & (centers[:, 1] < img.shape[0]-1-size)
+    index = np.nonzero(good_x & good_y)[0]
+    x1 = centers[index, 0].astype(int) - size
+    y1 = centers[index, 1].astype(int) - size
+    offsets = np.arange(2*size)
+    rows = y1[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    cols = x1[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    cutouts = np.asarray(img, dtype=np.float64)[rows, cols]
+    if len(index) > 0:
+        cutouts -= np.median(cutouts.reshape(len(index), -1), axis=1)[:, np.newaxis, np.newaxis]
+    return cutouts, centers[index, 0] - x1, centers[index, 1] - y1, index
+
+
+def _invert_2x2(a, b, c):
+    """Inverse of the symmetric matrices [[a, b], [b, c]]"""
+    det = a*c - b**2
+    return c/det, -b/det, a/det
+
+
+def adaptive_moments(cutouts, x, y, sigma=2., max_iter=50, tol=1.e-4):
+    """
+    Adaptive second moments of all the stars: the moments are weighted by an elliptical Gaussian,
+    which is iteratively matched to the shape of each star. For a Gaussian star, the weighted moments
+    converge to half of the covariance of the star.
+
+    Parameters
+    ==========
+    cutouts : np.array, shape(N, ny, nx)
+        The background subtracted cutouts
+
+    x, y : np.array, shape(N)
+        Initial positions of the stars in the cutouts
+
+    sigma : float  [default=2.]
+        Initial width of the weight function in pixels
+
+    max_iter : int  [default=50]
+        Maximum number of iterations
+
+    tol : float  [default=1.e-4]
+        Convergence tolerance of the relative change of the moments
+
+    Returns
+    =======
+    x, y : np.array, shape(N)
+        Centroids of the stars
+
+    cov : np.array, shape(N, 3)
+        The covariance (xx, xy, yy) of the stars in pixels^2
+
+    valid : np.array(bool)
+        False for the stars where the moments did not converge
+    """
+    N, ny, nx = cutouts.shape
+    X, Y = np.meshgrid(np.arange(nx), np.arange(ny))
+    x = np.array(x, dtype=float)
+    y = np.array(y, dtype=float)
+    # Weight covariance (xx, xy, yy):
+    w_xx = np.full(N, sigma**2)
+    w_xy = np.zeros(N)
+    w_yy = np.full(N, sigma**2)
+    valid = np.ones(N, dtype=bool)
+    converged = np.zeros(N, dtype=bool)
+    max_var = (min(nx, ny) / 2.)**2
+    for _ in range(max_iter):
+        active = valid & ~converged
+        if not np.any(active):
+            break
+        i_xx, i_xy, i_yy = _invert_2x2(w_xx[active], w_xy[active], w_yy[active])
+        dx = X - x[active, np.newaxis, np.newaxis]
+        dy = Y - y[active, np.newaxis, np.newaxis]
+        q = i_xx[:, np.newaxis, np.newaxis]*dx**2 + 2*i_xy[:, np.newaxis, np.newaxis]*dx*dy
+        q += i_yy[:, np.newaxis, np.newaxis]*dy**2
+        weighted = cutouts[active] * np.exp(-0.5*q)
+        flux = weighted.sum(axis=(1, 2))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_shift = np.sum(weighted*dx, axis=(1, 2)) / flux
+            y_shift = np.sum(weighted*dy, axis=(1, 2)) / flux
+            m_xx = np.sum(weighted*dx**2, axis=(1, 2)) / flux - x_shift**2
+            m_xy = np.sum(weighted*dx*dy, axis=(1, 2)) / flux - x_shift*y_shift
+            m_yy = np.sum(weighted*dy**2, axis=(1, 2)) / flux - y_shift**2
+
+        # The new weight matches the shape of the star: w = 2*M
+        ok = (flux > 0) & (m_xx > 0) & (m_yy > 0) & (m_xx*m_yy - m_xy**2 > 0)
+        ok &= (2*m_xx < max_var) & (2*m_yy < max_var)
+        change = (np.abs(2*m_xx - w_xx[active]) + np.abs(2*m_yy - w_yy[active])) / (w_xx[active] + w_yy[active])
+        idx = np.nonzero(active)[0]
+        valid[idx[~ok]] = False
+        idx = idx[ok]
+        x[idx] += x_shift[ok]
+        y[idx] += y_shift[ok]
+        w_xx[idx] = 2*m_xx[ok]
+        w_xy[idx] = 2*m_xy[ok]
+        w_yy[idx] = 2*m_yy[ok]
+        converged[idx] = change[ok] < tol
+        # Stars drifting out of the cutout are rejected:
+        valid &= (x > 0) & (x < nx-1) & (y > 0) & (y < ny-1)
+
+    valid &= converged
+    cov = np.column_stack([w_xx, w_xy, w_yy])
+    return x, y, cov, valid
+
+
+def fit_gaussian(cutouts, x, y, cov, valid=None, max_iter=20, tol=1.e-6):
+    """
+    Fit a 2D Gaussian to all the stars at once using Levenberg-Marquardt iterations,
+    starting from the adaptive moments. The Gaussian is parametrized as:
+
+        G = A * exp(-(a*dx**2 + 2*b*dx*dy + c*dy**2))
+
+    Parameters
+    ==========
+    cutouts : np.array, shape(N, ny, nx)
+        The background subtracted cutouts
+
+    x, y : np.array, shape(N)
+        Initial positions of the stars in the cutouts
+
+    cov : np.array, shape(N, 3)
+        Initial covariance (xx, xy, yy) of the stars, see `adaptive_moments`
+
+    valid : np.array(bool)  [default=None]
+        Only the valid stars are fitted. By default, all stars are fitted.
+
+    max_iter : int  [default=20]
+        Maximum number of iterations
+
+    tol : float  [default=1.e-6]
+        Convergence tolerance of the relative improvement of the chi-square
+
+    Returns
+    =======
+    amplitude, x, y : np.array, shape(N)
+        Best-fit peak amplitude and position of each star
+
+    cov : np.array, shape(N, 3)
+        Best-fit covariance (xx, xy, yy) of the stars in pixels^2
+
+    valid : np.array(bool)
+        False for the stars that could not be fitted
+    """
+    N, ny, nx = cutouts.shape
+    if valid is None:
+        valid = np.ones(N, dtype=bool)
+    valid = valid.copy()
+    X, Y = np.meshgrid(np.arange(nx), np.arange(ny))
+    X = X.ravel()
+    Y = Y.ravel()
+    data = cutouts.reshape(N, -1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a, b, c = _invert_2x2(*cov.T)
+    pars = np.column_stack([np.zeros(N), x, y, a/2, b/2, c/2])
+    pars[~valid] = [0., 0., 0., 0.5, 0., 0.5]
+
+    def model(p):
+        dx = X - p[:, 1, np.newaxis]
+        dy = Y - p[:, 2, np.newaxis]
+        shape = np.exp(-(p[:, 3, np.newaxis]*dx**2 + 2*p[:, 4, np.newaxis]*dx*dy + p[:, 5, np.newaxis]*dy**2))
+        return shape, dx, dy
+
+    # Linear least-squares amplitude of the initial shape:
+    shape, _, _ = model(pars)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pars[:, 0] = np.sum(shape*data, axis=1) / np.sum(shape**2, axis=1)
+    valid &= np.isfinite(pars[:, 0])
+    chi2 = np.sum((data - pars[:, 0, np.newaxis]*shape)**2, axis=1)
+    damping = np.full(N, 1.e-3)
+    # Stars are no longer fitted when the chi-square does not improve:
+    active = valid.copy()
+    for _ in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        p = pars[idx]
+        shape, dx, dy = model(p)
+        G = p[:, 0, np.newaxis] * shape
+        jac = np.stack([shape,
+                        G*(2*p[:, 3, np.newaxis]*dx + 2*p[:, 4, np.newaxis]*dy),
+                        G*(2*p[:, 4, np.newaxis]*dx + 2*p[:, 5, np.newaxis]*dy),
+                        -G*dx**2,
+                        -2*G*dx*dy,
+                        -G*dy**2], axis=2)
+        JT = jac.transpose(0, 2, 1)
+        JTJ = JT @ jac
+        JTr = (JT @ (data[idx] - G)[..., np.newaxis])[..., 0]
+        JTJ_damped = JTJ + damping[idx, np.newaxis, np.newaxis] * JTJ * np.eye(6)
+        try:
+            step = np.linalg.solve(JTJ_damped, JTr[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            # Singular matrices of stars without signal:
+            step = (np.linalg.pinv(JTJ_damped) @ JTr[..., np.newaxis])[..., 0]
+        trial = p + step
+        shape_trial, _, _ = model(trial)
+        chi2_trial = np.sum((data[idx] - trial[:, 0, np.newaxis]*shape_trial)**2, axis=1)
+        positive = (trial[:, 3] > 0) & (trial[:, 5] > 0) & (trial[:, 3]*trial[:, 5] - trial[:, 4]**2 > 0)
+        better = positive & (chi2_trial < chi2[idx])
+        done = better & (chi2[idx] - chi2_trial < tol*chi2[idx])
+        pars[idx[better]] = trial[better]
+        chi2[idx[better]] = chi2_trial[better]
+        damping[idx[better]] /= 10.
+        damping[idx[~better]] *= 10.
+        active[idx[done]] = False
+        active &= damping < 1.e10
+
+    valid &= (pars[:, 0] > 0) & (pars[:, 1] > 0) & (pars[:, 1] < nx-1) & (pars[:, 2] > 0) & (pars[:, 2] < ny-1)
+    i_xx, i_xy, i_yy = _invert_2x2(2*pars[:, 3], 2*pars[:, 4], 2*pars[:, 5])
+    cov = np.column_stack([i_xx, i_xy, i_yy])
+    return pars[:, 0], pars[:, 1], pars[:, 2], cov, valid
+
+
+def shape_parameters(cov):
+    """
+    Size, axis ratio and orientation of the stars from their covariance (xx, xy, yy).
+
+    Returns
+    =======
+    sigma : np.array
+        Quadratic sum of the standard deviations along the major and minor axes: sqrt(xx + yy)
+
+    ratio : np.array
+        Axis ratio (minor / major) of the stars
+
+    pa : np.array
+        Position angle of the major axis in degrees counter-clockwise from the x-axis
+    """
+    c_xx, c_xy, c_yy = np.asarray(cov).T
+    trace = c_xx + c_yy
+    root = np.sqrt((c_xx - c_yy)**2 + 4*c_xy**2)
+    major = (trace + root) / 2
+    minor = np.clip((trace - root) / 2, 0., None)
+    sigma = np.sqrt(trace)
+    ratio = np.sqrt(minor / major)
+    pa = np.degrees(0.5*np.arctan2(2*c_xy, c_xx - c_yy))
+    return sigma, ratio, pa
+
+
+def measure_psf(img, centers, size=20, refine=False):
+    """
+    Measure the shape of all the stars at the given positions in the image.
+
+    Parameters
+    ==========
+    img : np.array, shape(N, M)
+        The image
+
+    centers : np.array, shape(K, 2)
+        Positions (x, y) of the stars in pixels
+
+    size : int  [default=20]
+        Half-size of the cutouts around each star
+
+    refine : bool  [default=False]
+        Refine the adaptive moments by fitting a 2D Gaussian to the stars
+
+    Returns
+    =======
+    index : np.array(int)
+        Index in `centers` of the stars that were measured
+
+    sigma, ratio, pa : np.array
+        Size, axis ratio and position angle of each measured star, see `shape_parameters`
+    """
+    cutouts, x, y, index = get_cutouts(img, centers, size=size)
+    if len(index) == 0:
+        return index, np.zeros(0), np.zeros(0), np.zeros(0)
+
+    x, y, cov, valid = adaptive_moments(cutouts, x, y)
+    if refine:
+        _, x, y, cov, valid = fit_gaussian(cutouts, x, y, cov, valid=valid)
+    sigma, ratio, pa = shape_parameters(cov[valid])
+    return index[valid], sigma, ratio, pa
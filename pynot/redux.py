@@ -3,16 +3,20 @@ Automatically Classify and Reduce a given Data Set
 """
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob
+import matplotlib.pyplot as plt
 import numpy as np
 import os
 import sys
+import traceback
 
 from PyQt5.QtWidgets import QApplication
 
 from pynot.data import io
 from pynot.data import organizer as do
 from pynot.data import obs
+from pynot.data.calibplan import CalibrationPlan, plan_calibrations, get_plan_fname
 from pynot.calibs import task_bias, task_sflat, task_prep_arcs
 from pynot.extraction import auto_extract
 from pynot import extract_gui
@@ -23,6 +27,8 @@ from pynot.scired import raw_correction, auto_fit_background, correct_cosmics
 from pynot.scombine import combine_2d
 from pynot.response import flux_calibrate, task_response
 from pynot.logging import Report
+from pynot.product import checkpoint_fname, set_dtype_policy, float64_products, compare_products
+from pynot.calibpool import set_pool_limit
 from pynot.tasks import parse_tasks, WorkflowParsingError
 
 code_dir = os.path.dirname(os.path.abspath(__file__))
@@ -56,9 +62,378 @@ class State(dict):
         return matches
 
 
+def reduce_ob(sci_img, output_dir, database, task_options, status, log, identify_all=False, app=None, plan=None):
+    """
+    Reduce a single science OB in the working directory `output_dir`, which is emptied first.
+    The log of the OB is saved as `pynot.log` in the working directory.
+
+    Parameters
+    ==========
+    sci_img : :class:`pynot.data.organizer.RawImage`
+        The raw science frame of the OB
+
+    output_dir : str
+        Working directory of the OB
+
+    database : :class:`pynot.data.organizer.TagDatabase`
+        The file classification database used to find the matching calibrations
+
+    task_options : dict
+        The pipeline options for each task
+
+    status : :class:`State`
+        The pipeline state holding the available pixel tables
+
+    log : :class:`pynot.logging.Report`
+        The log of the OB
+
+    identify_all : bool  [default=False]
+        Run the arc line identification if no pixel table exists for the arc frame of the OB
+
+    app : QApplication  [default=None]
+        The application instance used by the graphical interfaces
+
+    plan : :class:`pynot.data.calibplan.CalibrationPlan`  [default=None]
+        The calibrations of the science frames. If not given, the calibrations
+        of `sci_img` are matched from the `database`.
+
+    Returns
+    =======
+    comb_base : str
+        Basename of the last 2D product of the OB, used for the combination of OBs
+    """
+    output_base = obs.output_base_spec
+    comb_base = None
+    set_dtype_policy(**task_options['dtype'])
+    set_pool_limit(task_options['calib_pool'])
+    if os.path.exists(output_dir):
+        files_to_remove = glob.glob(output_dir+'/*')
+        for fname in files_to_remove:
+            os.remove(fname)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # Start new log in working directory:
+    log_fname = os.path.join(output_dir, 'pynot.log')
+    log.clear()
+    log.set_filename(log_fname)
+    log.write("------------------------------------------------------------", prefix='')
+    log.write("Starting PyNOT Longslit Spectroscopic Reduction")
+    log.add_linebreak()
+    log.write("Target Name: %s" % sci_img.target_name)
+    log.write("Input Filename: %s" % sci_img.filename)
+    log.write("Grism: %s" % sci_img.grism)
+    log.write("Saving output to directory: %s" % output_dir)
+    log.add_linebreak()
+
+    # Prepare output filenames:
+    grism = sci_img.grism
+    rect2d_fname = os.path.join(output_dir, 'RECT2D_%s.fits' % (sci_img.target_name))
+    bgsub2d_fname = os.path.join(output_dir, 'SKYSUB2D_%s.fits' % (sci_img.target_name))
+    crr_fname = os.path.join(output_dir, 'CRR_SKYSUB2D_%s.fits' % (sci_img.target_name))
+    corrected_2d_fname = os.path.join(output_dir, 'CORR2D_%s.fits' % (sci_img.target_name))
+    flux2d_fname = os.path.join(output_dir, 'FLUX2D_%s.fits' % (sci_img.target_name))
+    flux1d_fname = os.path.join(output_dir, 'FLUX1D_%s.fits' % (sci_img.target_name))
+    extract_pdf_fname = os.path.join(output_dir, 'extraction_details.pdf')
+
+    if plan is None or sci_img.filename not in plan:
+        plan = plan_calibrations([sci_img], database, 'SPEC_OBJECT')
+
+    # Find Bias Frame:
+    try:
+        master_bias_fname = plan.get_calibration(sci_img, 'MBIAS', log)
+    except Exception:
+        log.fatal_error()
+        raise
+
+    # Find Flat Frame:
+    try:
+        norm_flat_fname = plan.get_calibration(sci_img, 'NORM_SFLAT', log)
+    except Exception:
+        log.fatal_error()
+        raise
+
+    # Find Arc Frame:
+    try:
+        arc_fname = plan.get_calibration(sci_img, 'ARC_CORR', log)
+    except Exception:
+        log.fatal_error()
+        raise
+
+    arc_base = os.path.splitext(os.path.basename(arc_fname))[0]
+    pixtable_fname = os.path.join(output_base, 'arcs', "pixtab_%s_%s.dat" % (arc_base, grism))
+    if os.path.exists(pixtable_fname):
+        pixtable = pixtable_fname
+    elif identify_all:
+        log.write("Running task: Arc Line Identification")
+        try:
+            linelist_fname = ''
+            pixtab_fname = os.path.join(calib_dir, '%s_pixeltable.dat' % grism)
+            output_pixtable_fname = os.path.join(output_base, 'arcs', "pixtab_%s_%s.dat" % (arc_base, grism))
+            order_wl, pixtable, msg = create_pixtable(arc_fname, grism,
+                                                      output_pixtable_fname,
+                                                      pixtab_fname, linelist_fname,
+                                                      order_wl=task_options['identify']['order_wl'],
+                                                      app=app)
+            status["pixtab_%s_%s" % (arc_base, grism)] = pixtable
+            log.commit(msg)
+            log.add_linebreak()
+        except Exception:
+            log.error("Identification of arc lines failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+    else:
+        pixtab_fnames = status.find_pixtab(grism)
+        pixtable = pixtab_fnames[0]
+
+
+    # Find Response Function:
+    response_fname = plan[sci_img.filename]['RESPONSE']
+    if response_fname is None:
+        if database.has_tag('RESPONSE'):
+            log.warn("No response function matches the grism: %s" % grism)
+            log.warn("The spectrum will not be flux calibrated")
+            log.add_linebreak()
+        response_fname = ''
+
+    # The 2D products are passed between the tasks in memory. The intermediate products
+    # are only saved if given in `checkpoint`, the final 2D product is always saved:
+    checkpoint = task_options['checkpoint']
+    if not checkpoint:
+        checkpoint = []
+    elif isinstance(checkpoint, str):
+        checkpoint = [checkpoint]
+    if response_fname:
+        final_product = 'FLUX2D'
+    elif task_options['crr']['niter'] > 0:
+        final_product = 'CRR_SKYSUB2D'
+    elif task_options['skysub']['auto']:
+        final_product = 'SKYSUB2D'
+    else:
+        final_product = 'RECT2D'
+    checkpoint = checkpoint + [final_product]
+
+
+    # Bias correction, Flat correction
+    log.write("Running task: Bias and Flat Field Correction")
+    try:
+        output = checkpoint_fname(corrected_2d_fname, 'CORR2D', checkpoint)
+        corr2d, output_msg = raw_correction(sci_img.data, sci_img.header.copy(), master_bias_fname, norm_flat_fname,
+                                            output=output, overwrite=True)
+        log.commit(output_msg)
+        log.add_linebreak()
+    except Exception:
+        log.error("Bias and flat field correction failed!")
+        log.fatal_error()
+        print("Unexpected error:", sys.exc_info()[0])
+        raise
+
+
+    # Call rectify
+    log.write("Running task: 2D Rectification and Wavelength Calibration")
+    try:
+        output = checkpoint_fname(rect2d_fname, 'RECT2D', checkpoint)
+        rect2d, rect_msg = rectify(corr2d, arc_fname, pixtable,
+                                   output=output, fig_dir=output_dir,
+                                   dispaxis=sci_img.dispaxis, **task_options['rectify'])
+        if rect2d is None:
+            raise WavelengthError(rect_msg)
+        log.commit(rect_msg)
+        log.add_linebreak()
+        comb_base = 'RECT2D'
+    except WavelengthError:
+        log.error("2D rectification failed!")
+        log.fatal_error()
+        print("Unexpected error:", sys.exc_info()[0])
+        print("")
+        raise
+
+
+    # Automatic Background Subtraction:
+    if task_options['skysub']['auto']:
+        bgsub_pdf_name = os.path.join(output_dir, 'skysub_diagnostics.pdf')
+        log.write("Running task: Background Subtraction")
+        try:
+            output = checkpoint_fname(bgsub2d_fname, 'SKYSUB2D', checkpoint)
+            bgsub2d, bg_msg = auto_fit_background(rect2d, output, dispaxis=1,
+                                                  plot_fname=bgsub_pdf_name, **task_options['skysub'])
+            log.commit(bg_msg)
+            if output:
+                log.write("2D sky model is saved in extension 'SKY' of the file: %s" % output)
+            else:
+                log.write("2D sky model is kept in extension 'SKY' of the 2D products")
+            log.add_linebreak()
+            comb_base = 'SKYSUB2D'
+        except Exception:
+            log.error("Automatic background subtraction failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+    else:
+        log.warn("No sky-subtraction has been performed on the 2D spectrum!")
+        log.write("Cosmic ray rejection may fail... double check the output or turn off 'crr' by setting niter=0.")
+        log.add_linebreak()
+        bgsub2d = rect2d
+
+
+    # Correct Cosmic Rays Hits:
+    if task_options['crr']['niter'] > 0:
+        log.write("Running task: Cosmic Ray Rejection")
+        try:
+            output = checkpoint_fname(crr_fname, 'CRR_SKYSUB2D', checkpoint)
+            crr2d, crr_msg = correct_cosmics(bgsub2d, output, **task_options['crr'])
+            if crr2d is None:
+                raise RuntimeError(crr_msg)
+            comb_base = 'CRR2D'
+            log.commit(crr_msg)
+            log.add_linebreak()
+        except Exception:
+            log.error("Cosmic ray correction failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+    else:
+        crr2d = bgsub2d
+
+
+    # Flux Calibration:
+    if response_fname:
+        log.write("Running task: Flux Calibration")
+        try:
+            flux2d, flux_msg = flux_calibrate(crr2d, output=flux2d_fname, response_fname=response_fname)
+            if flux2d is None:
+                raise RuntimeError(flux_msg)
+            log.commit(flux_msg)
+            log.add_linebreak()
+            status['FLUX2D'] = flux2d_fname
+            comb_base = 'FLUX2D'
+        except Exception:
+            log.error("Flux calibration failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+    else:
+        log.warn("Could not find a response function that matches the observations!")
+        log.warn("The spectra will not be flux clibrated!")
+        status['FLUX2D'] = crr2d.filename
+        flux2d = crr2d
+
+
+    # Validate the data types of the 2D products:
+    if task_options['dtype']['validate']:
+        log.write("Running task: Validation of 2D products against a float64 reduction")
+        try:
+            val_msg = validate_2d_products(flux2d, sci_img, master_bias_fname, norm_flat_fname, arc_fname,
+                                           pixtable, response_fname, task_options)
+            log.commit(val_msg)
+            log.add_linebreak()
+        except Exception:
+            log.error("Validation of the 2D products failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+
+
+    # Extract 1D spectrum:
+    log.write("Running task: 1D Extraction")
+    extract_fname = status['FLUX2D']
+    if task_options['extract']['interactive']:
+        try:
+            log.write("Extraction: Starting Graphical User Interface")
+            extract_gui.run_gui(extract_fname, output_fname=flux1d_fname,
+                                app=app, **task_options['extract'])
+            log.write("Writing fits table: %s" % flux1d_fname, prefix=" [OUTPUT] - ")
+        except:
+            log.error("Interactive 1D extraction failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+    else:
+        try:
+            ext_msg = auto_extract(extract_fname, flux1d_fname,
+                                   dispaxis=1, pdf_fname=extract_pdf_fname,
+                                   **task_options['extract'])
+            log.commit(ext_msg)
+            log.add_linebreak()
+        except np.linalg.LinAlgError:
+            log.warn("Automatic extraction failed. Try manual extraction...")
+        except Exception:
+            log.error("Spectral 1D extraction failed!")
+            log.fatal_error()
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
+
+    log.exit()
+    return comb_base
+
+
+def validate_2d_products(product, sci_img, master_bias_fname, norm_flat_fname, arc_fname, pixtable,
+                         response_fname, task_options):
+    """
+    Repeat the 2D reduction of `sci_img` storing the image data as float64 and report
+    the maximum deviation of the final 2D `product` from this reference reduction.
+    The products of the reference reduction are not saved.
+
+    Returns
+    =======
+    output_msg : str
+        Log of the maximum deviations
+    """
+    msg = list()
+    msg.append("          - Data types of the 2D products: data=%s  mask=%s" % (product.data.dtype, product.mask.dtype))
+    with float64_products():
+        reference, _ = raw_correction(sci_img.data, sci_img.header.copy(), master_bias_fname, norm_flat_fname)
+        rect_options = dict(task_options['rectify'], plot=False)
+        reference, _ = rectify(reference, arc_fname, pixtable, dispaxis=sci_img.dispaxis, **rect_options)
+        if task_options['skysub']['auto']:
+            reference, _ = auto_fit_background(reference, '', dispaxis=1, **task_options['skysub'])
+        if task_options['crr']['niter'] > 0:
+            reference, _ = correct_cosmics(reference, '', **task_options['crr'])
+        if response_fname:
+            reference, _ = flux_calibrate(reference, output='', response_fname=response_fname)
+    msg.append(compare_products(product, reference))
+    msg.append("")
+    return "\n".join(msg)
+
+
+def run_ob(sci_img, output_dir, database, task_options, status, log, identify_all=False, app=None, plan=None):
+    """
+    Reduce a single science OB using :func:`reduce_ob`. A failure of the reduction is reported
+    in the returned status instead of being raised, so that the remaining OBs can continue.
+
+    Returns
+    =======
+    ob_status : str
+        The status of the OB for the OB database: 'DONE' or 'FAILED'
+
+    comb_base : str
+        Basename of the last 2D product of the OB, used for the combination of OBs
+    """
+    try:
+        comb_base = reduce_ob(sci_img, output_dir, database, task_options, status, log,
+                              identify_all=identify_all, app=app, plan=plan)
+    except Exception:
+        print(" [ERROR]  - Reduction of OB failed: %s" % output_dir)
+        traceback.print_exc()
+        print("")
+        return 'FAILED', None
+    return 'DONE', comb_base
+
+
+def _init_ob_worker():
+    # The worker processes never show figures:
+    plt.switch_backend('Agg')
+
+
+def _run_ob_worker(sci_img, output_dir, database, task_options, status, plan):
+    log = Report(verbose=False)
+    return run_ob(sci_img, output_dir, database, task_options, status, log, plan=plan)
+
+
 def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False, no_interactive=False, force_restart=False,
                  make_bias=False, make_flat=False, make_arcs=False, make_identify=False, make_response=False, calibs_only=False,
-                 restart_science=False):
+                 restart_science=False, workers=1):
     log = Report(verbose)
     status = State()
 
@@ -74,6 +449,7 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
             options[section_name].update(section)
         else:
             options[section_name] = section
+    set_pool_limit(options['calib_pool'])
 
     if object_id is None:
         pass
@@ -114,6 +490,8 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
         log.error("Dataset does not exist : %s" % dataset_fname)
         log.fatal_error()
         return
+    plan_fname = get_plan_fname(dataset_fname)
+    calib_plan = CalibrationPlan()
 
 
     # -- Parse tasks from the workflow
@@ -205,6 +583,9 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
     # -- response
     if not database.has_tag('RESPONSE') or make_response or force_restart:
         if database.has_tag('SPEC_FLUX-STD'):
+            std_images = list(map(do.RawImage, database['SPEC_FLUX-STD']))
+            calib_plan.update(plan_calibrations(std_images, database, 'SPEC_FLUX-STD'))
+            calib_plan.save(plan_fname)
             for task_pars in task_manager['response']:
                 task_options = options.copy()
                 opts = task_pars.pop('options', {})
@@ -215,7 +596,7 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
                         task_options[section_name] = section
 
                 task_output, log = task_response(task_options, database, status, log=log, verbose=verbose, app=app,
-                                                 output_dir=os.path.join(output_base, 'std'),
+                                                 output_dir=os.path.join(output_base, 'std'), plan=calib_plan,
                                                  **task_pars)
             for tag, response_files in task_output.items():
                 database[tag] = response_files
@@ -267,6 +648,11 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
             log.fatal_error()
             return
 
+        # Associate the science frames with their calibrations:
+        calib_plan.update(plan_calibrations(objects_to_reduce, database, 'SPEC_OBJECT'))
+        calib_plan.save(plan_fname)
+        log.write("Saved calibration plan: %s" % plan_fname, prefix=" [OUTPUT] - ")
+
 
         # Organize the science files according to target and instrument setup (insID)
         science_frames = defaultdict(lambda: defaultdict(list))
@@ -287,15 +673,18 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
         log.write("Updating OB database")
         log.add_linebreak()
 
-        comb_base = None
+        # Collect the OBs to reduce:
+        output_id = task_options.pop('output', '')
+        ob_groups = list()
+        ob_tasks = list()
         for target_name, frames_per_setup in science_frames.items():
             for insID, frames in frames_per_setup.items():
+                if output_id:
+                    insID += '_'+output_id
+                ob_dirs = list()
                 for obnum, sci_img in enumerate(frames, 1):
                     # Create working directory:
                     obID = 'ob%i' % obnum
-                    output_id = task_options.pop('output', '')
-                    if output_id:
-                        insID += '_'+output_id
                     output_dir = os.path.join(output_base, sci_img.target_name, insID, obID)
                     if output_dir in obdb.data and obdb.data[output_dir] in ['DONE', 'SKIP']:
                         if (force_restart or restart_science) and obdb.data[output_dir] == 'DONE':
@@ -306,194 +695,77 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
                             log.write("or run the pipeline with the '--science' option to force re-reduction of all OBs")
                             log.add_linebreak()
                             continue
-
-                    if os.path.exists(output_dir):
-                        files_to_remove = glob.glob(output_dir+'/*')
-                        for fname in files_to_remove:
-                            os.remove(fname)
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-
-                    # Start new log in working directory:
-                    log_fname = os.path.join(output_dir, 'pynot.log')
-                    log.clear()
-                    log.set_filename(log_fname)
-                    log.write("------------------------------------------------------------", prefix='')
-                    log.write("Starting PyNOT Longslit Spectroscopic Reduction")
-                    log.add_linebreak()
-                    log.write("Target Name: %s" % sci_img.target_name)
-                    log.write("Input Filename: %s" % sci_img.filename)
-                    log.write("Grism: %s" % sci_img.grism)
-                    log.write("Saving output to directory: %s" % output_dir)
-                    log.add_linebreak()
-
-                    # Prepare output filenames:
-                    grism = sci_img.grism
-                    rect2d_fname = os.path.join(output_dir, 'RECT2D_%s.fits' % (sci_img.target_name))
-                    bgsub2d_fname = os.path.join(output_dir, 'SKYSUB2D_%s.fits' % (sci_img.target_name))
-                    corrected_2d_fname = os.path.join(output_dir, 'CORR2D_%s.fits' % (sci_img.target_name))
-                    flux2d_fname = os.path.join(output_dir, 'FLUX2D_%s.fits' % (sci_img.target_name))
-                    flux1d_fname = os.path.join(output_dir, 'FLUX1D_%s.fits' % (sci_img.target_name))
-                    extract_pdf_fname = os.path.join(output_dir, 'extraction_details.pdf')
-                    comb_base = None
-
-                    # Find Bias Frame:
-                    try:
-                        master_bias_fname = do.match_single_calib(sci_img, database, 'MBIAS', log, date=False)
-                    except Exception:
-                        log.fatal_error()
-                        raise
-
-                    # Find Flat Frame:
-                    try:
-                        norm_flat_fname = do.match_single_calib(sci_img, database, 'NORM_SFLAT', log, date=False,
-                                                                grism=True, slit=True, filter=True)
-                    except Exception:
-                        log.fatal_error()
-                        raise
-
-                    # Find Arc Frame:
-                    try:
-                        arc_fname = do.match_single_calib(sci_img, database, 'ARC_CORR', log, date=False,
-                                                          grism=True, slit=True, get_closest_time=True)
-                    except Exception:
-                        log.fatal_error()
-                        raise
-
-                    arc_base = os.path.splitext(os.path.basename(arc_fname))[0]
-                    pixtable_fname = os.path.join(output_base, 'arcs', "pixtab_%s_%s.dat" % (arc_base, grism))
-                    if os.path.exists(pixtable_fname):
-                        pixtable = pixtable_fname
-                    elif identify_all:
-                        log.write("Running task: Arc Line Identification")
-                        try:
-                            linelist_fname = ''
-                            pixtab_fname = os.path.join(calib_dir, '%s_pixeltable.dat' % grism)
-                            output_pixtable_fname = os.path.join(output_base, 'arcs', "pixtab_%s_%s.dat" % (arc_base, grism))
-                            order_wl, pixtable, msg = create_pixtable(arc_fname, grism,
-                                                                      output_pixtable_fname,
-                                                                      pixtab_fname, linelist_fname,
-                                                                      order_wl=task_options['identify']['order_wl'],
-                                                                      app=app)
-                            status["pixtab_%s_%s" % (arc_base, grism)] = pixtable
-                            log.commit(msg)
-                            log.add_linebreak()
-                        except Exception:
-                            log.error("Identification of arc lines failed!")
-                            log.fatal_error()
-                            print("Unexpected error:", sys.exc_info()[0])
-                            raise
-                    else:
-                        pixtab_fnames = status.find_pixtab(grism)
-                        pixtable = pixtab_fnames[0]
-
-
-                    # Bias correction, Flat correction
-                    log.write("Running task: Bias and Flat Field Correction")
+                    ob_dirs.append(output_dir)
+                    ob_tasks.append((sci_img, output_dir))
+                ob_groups.append((target_name, insID, ob_dirs))
+
+        # Reduce the OBs:
+        interactive_tasks = identify_all or task_options['extract']['interactive']
+        if workers > 1 and len(ob_tasks) > 1 and interactive_tasks:
+            log.warn("Interactive tasks cannot run in parallel. The OBs are reduced one at a time")
+            log.add_linebreak()
+        comb_bases = dict()
+        if workers > 1 and len(ob_tasks) > 1 and not interactive_tasks:
+            log.write("Reducing %i OBs using %i processes" % (len(ob_tasks), workers))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_ob_worker) as executor:
+                futures = dict()
+                for sci_img, output_dir in ob_tasks:
+                    future = executor.submit(_run_ob_worker, sci_img, output_dir, database, task_options, status, calib_plan)
+                    futures[future] = output_dir
+                for future in as_completed(futures):
+                    output_dir = futures[future]
+                    ob_status, comb_bases[output_dir] = future.result()
+                    obdb.update(output_dir, ob_status)
+                    log.write("Finished OB: %s  (status=%s)" % (output_dir, ob_status))
+            log.add_linebreak()
+            log.save()
+        else:
+            for sci_img, output_dir in ob_tasks:
+                ob_status, comb_bases[output_dir] = run_ob(sci_img, output_dir, database, task_options, status,
+                                                           log, identify_all=identify_all, app=app, plan=calib_plan)
+                obdb.update(output_dir, ob_status)
+
+        for target_name, insID, ob_dirs in ob_groups:
+            comb_base = None
+            for output_dir in ob_dirs:
+                if comb_bases[output_dir]:
+                    comb_base = comb_bases[output_dir]
+
+            # -- Combine OBs for same target:
+
+            # Check whether to combine or link OB files:
+            if comb_base:
+                pattern = os.path.join(output_base, target_name, insID, '*', '%s*.fits' % comb_base)
+                files_to_combine = glob.glob(pattern)
+                files_to_combine = list(filter(lambda x: obdb.data[os.path.dirname(x)] == 'DONE', files_to_combine))
+            else:
+                files_to_combine = []
+            if len(files_to_combine) > 1:
+                # Combine individual OBs
+                comb_basename = '%s_%s_comb2d.fits' % (target_name, insID)
+                comb2d_fname = os.path.join(output_base, target_name, comb_basename)
+                if not os.path.exists(comb2d_fname) or force_restart:
+                    log.write("Running task: Spectral Combination")
                     try:
-                        output_msg = raw_correction(sci_img.data, sci_img.header, master_bias_fname, norm_flat_fname,
-                                                    output=corrected_2d_fname, overwrite=True)
+                        comb_output = combine_2d(files_to_combine, comb2d_fname)
+                        final_wl, final_flux, final_err, final_mask, output_msg = comb_output
                         log.commit(output_msg)
                         log.add_linebreak()
                     except Exception:
-                        log.error("Bias and flat field correction failed!")
-                        log.fatal_error()
-                        print("Unexpected error:", sys.exc_info()[0])
-                        raise
-
-
-                    # Call rectify
-                    log.write("Running task: 2D Rectification and Wavelength Calibration")
-                    try:
-                        rect_msg = rectify(corrected_2d_fname, arc_fname, pixtable,
-                                           output=rect2d_fname, fig_dir=output_dir,
-                                           dispaxis=sci_img.dispaxis, **task_options['rectify'])
-                        log.commit(rect_msg)
-                        log.add_linebreak()
-                        comb_base = 'RECT2D'
-                    except WavelengthError:
-                        log.error("2D rectification failed!")
-                        log.fatal_error()
-                        print("Unexpected error:", sys.exc_info()[0])
-                        print("")
+                        log.warn("Combination of 2D spectra failed... Try again manually")
                         raise
 
-
-                    # Automatic Background Subtraction:
-                    if task_options['skysub']['auto']:
-                        bgsub_pdf_name = os.path.join(output_dir, 'skysub_diagnostics.pdf')
-                        log.write("Running task: Background Subtraction")
-                        try:
-                            bg_msg = auto_fit_background(rect2d_fname, bgsub2d_fname, dispaxis=1,
-                                                         plot_fname=bgsub_pdf_name, **task_options['skysub'])
-                            log.commit(bg_msg)
-                            log.write("2D sky model is saved in extension 'SKY' of the file: %s" % bgsub2d_fname)
-                            log.add_linebreak()
-                            comb_base = 'SKYSUB2D'
-                        except Exception:
-                            log.error("Automatic background subtraction failed!")
-                            log.fatal_error()
-                            print("Unexpected error:", sys.exc_info()[0])
-                            raise
-                    else:
-                        log.warn("No sky-subtraction has been performed on the 2D spectrum!")
-                        log.write("Cosmic ray rejection may fail... double check the output or turn off 'crr' by setting niter=0.")
-                        log.add_linebreak()
-                        bgsub2d_fname = rect2d_fname
-
-
-                    # Correct Cosmic Rays Hits:
-                    if task_options['crr']['niter'] > 0:
-                        log.write("Running task: Cosmic Ray Rejection")
-                        crr_fname = os.path.join(output_dir, 'CRR_SKYSUB2D_%s.fits' % (sci_img.target_name))
-                        try:
-                            crr_msg = correct_cosmics(bgsub2d_fname, crr_fname, **task_options['crr'])
-                            comb_base = 'CRR2D'
-                            log.commit(crr_msg)
-                            log.add_linebreak()
-                        except Exception:
-                            log.error("Cosmic ray correction failed!")
-                            log.fatal_error()
-                            print("Unexpected error:", sys.exc_info()[0])
-                            raise
-                    else:
-                        crr_fname = bgsub2d_fname
-
-
-                    # Flux Calibration:
-                    if database.has_tag('RESPONSE'):
-                        response_fname = do.match_response(sci_img, database['RESPONSE'], exact_date=False)
-                    else:
-                        response_fname = ''
-
-                    if response_fname:
-                        log.write("Running task: Flux Calibration")
-                        try:
-                            flux_msg = flux_calibrate(crr_fname, output=flux2d_fname, response_fname=response_fname)
-                            log.commit(flux_msg)
-                            log.add_linebreak()
-                            status['FLUX2D'] = flux2d_fname
-                            comb_base = 'FLUX2D'
-                        except Exception:
-                            log.error("Flux calibration failed!")
-                            log.fatal_error()
-                            print("Unexpected error:", sys.exc_info()[0])
-                            raise
-                    else:
-                        log.warn("Could not find a response function that matches the observations!")
-                        log.warn("The spectra will not be flux clibrated!")
-                        status['FLUX2D'] = crr_fname
-
-
-                    # Extract 1D spectrum:
+                comb_basename = '%s_%s_comb1d.fits' % (target_name, insID)
+                comb1d_fname = os.path.join(output_base, target_name, comb_basename)
+                if not os.path.exists(comb1d_fname) or force_restart:
+                    log.add_linebreak()
                     log.write("Running task: 1D Extraction")
-                    extract_fname = status['FLUX2D']
                     if task_options['extract']['interactive']:
                         try:
                             log.write("Extraction: Starting Graphical User Interface")
-                            extract_gui.run_gui(extract_fname, output_fname=flux1d_fname,
+                            extract_gui.run_gui(comb2d_fname, output_fname=comb1d_fname,
                                                 app=app, **task_options['extract'])
-                            log.write("Writing fits table: %s" % flux1d_fname, prefix=" [OUTPUT] - ")
+                            log.write("Writing fits table: %s" % comb1d_fname, prefix=" [OUTPUT] - ")
                         except:
                             log.error("Interactive 1D extraction failed!")
                             log.fatal_error()
@@ -501,95 +773,36 @@ def run_pipeline(options_fname, object_id=None, verbose=True, interactive=False,
                             raise
                     else:
                         try:
-                            ext_msg = auto_extract(extract_fname, flux1d_fname,
+                            pdf_basename = 'comb_%s_extraction_details.pdf' % insID
+                            extract_pdf_fname = os.path.join(output_base, target_name, pdf_basename)
+                            ext_msg = auto_extract(comb2d_fname, comb1d_fname,
                                                    dispaxis=1, pdf_fname=extract_pdf_fname,
                                                    **task_options['extract'])
                             log.commit(ext_msg)
                             log.add_linebreak()
-                        except np.linalg.LinAlgError:
-                            log.warn("Automatic extraction failed. Try manual extraction...")
-                        except Exception:
-                            log.error("Spectral 1D extraction failed!")
-                            log.fatal_error()
-                            print("Unexpected error:", sys.exc_info()[0])
-                            raise
-
-                    obdb.update(output_dir, 'DONE')
-                    log.exit()
-
-
-                # -- Combine OBs for same target:
-
-                # Check whether to combine or link OB files:
-                if comb_base:
-                    pattern = os.path.join(output_base, target_name, insID, '*', '%s*.fits' % comb_base)
-                    files_to_combine = glob.glob(pattern)
-                    files_to_combine = list(filter(lambda x: obdb.data[os.path.dirname(x)] == 'DONE', files_to_combine))
-                else:
-                    files_to_combine = []
-                if len(files_to_combine) > 1:
-                    # Combine individual OBs
-                    comb_basename = '%s_%s_comb2d.fits' % (target_name, insID)
-                    comb2d_fname = os.path.join(output_base, target_name, comb_basename)
-                    if not os.path.exists(comb2d_fname) or force_restart:
-                        log.write("Running task: Spectral Combination")
-                        try:
-                            comb_output = combine_2d(files_to_combine, comb2d_fname)
-                            final_wl, final_flux, final_err, final_mask, output_msg = comb_output
-                            log.commit(output_msg)
-                            log.add_linebreak()
                         except Exception:
-                            log.warn("Combination of 2D spectra failed... Try again manually")
-                            raise
+                            log.warn("Automatic extraction failed. Try manual extraction...")
 
-                    comb_basename = '%s_%s_comb1d.fits' % (target_name, insID)
-                    comb1d_fname = os.path.join(output_base, target_name, comb_basename)
-                    if not os.path.exists(comb1d_fname) or force_restart:
-                        log.add_linebreak()
-                        log.write("Running task: 1D Extraction")
-                        if task_options['extract']['interactive']:
-                            try:
-                                log.write("Extraction: Starting Graphical User Interface")
-                                extract_gui.run_gui(comb2d_fname, output_fname=comb1d_fname,
-                                                    app=app, **task_options['extract'])
-                                log.write("Writing fits table: %s" % comb1d_fname, prefix=" [OUTPUT] - ")
-                            except:
-                                log.error("Interactive 1D extraction failed!")
-                                log.fatal_error()
-                                print("Unexpected error:", sys.exc_info()[0])
-                                raise
-                        else:
-                            try:
-                                pdf_basename = 'comb_%s_extraction_details.pdf' % insID
-                                extract_pdf_fname = os.path.join(output_base, target_name, pdf_basename)
-                                ext_msg = auto_extract(comb2d_fname, comb1d_fname,
-                                                       dispaxis=1, pdf_fname=extract_pdf_fname,
-                                                       **task_options['extract'])
-                                log.commit(ext_msg)
-                                log.add_linebreak()
-                            except Exception:
-                                log.warn("Automatic extraction failed. Try manual extraction...")
-
-                elif len(files_to_combine) == 1:
-                    # Create a hard link to the individual file instead
-                    comb_basename = '%s_%s_comb2d.fits' % (target_name, insID)
-                    comb2d_fname = os.path.join(output_base, target_name, comb_basename)
-                    source_2d = files_to_combine[0]
-                    if os.path.exists(comb2d_fname):
-                        os.remove(comb2d_fname)
-                    os.link(source_2d, comb2d_fname)
+            elif len(files_to_combine) == 1:
+                # Create a hard link to the individual file instead
+                comb_basename = '%s_%s_comb2d.fits' % (target_name, insID)
+                comb2d_fname = os.path.join(output_base, target_name, comb_basename)
+                source_2d = files_to_combine[0]
+                if os.path.exists(comb2d_fname):
+                    os.remove(comb2d_fname)
+                os.link(source_2d, comb2d_fname)
+                log.write("Created file link:")
+                log.write("%s" % source_2d, prefix=" [OUTPUT] - ")
+                log.write("-> %s" % comb2d_fname, prefix=" [OUTPUT] ")
+
+                comb_basename = '%s_%s_comb1d.fits' % (target_name, insID)
+                comb1d_fname = os.path.join(output_base, target_name, comb_basename)
+                source_1d = source_2d.replace(comb_base, 'FLUX1D')
+                if os.path.exists(comb1d_fname):
+                    os.remove(comb1d_fname)
+                if os.path.exists(source_1d):
+                    os.link(source_1d, comb1d_fname)
                     log.write("Created file link:")
-                    log.write("%s" % source_2d, prefix=" [OUTPUT] - ")
-                    log.write("-> %s" % comb2d_fname, prefix=" [OUTPUT] ")
-
-                    comb_basename = '%s_%s_comb1d.fits' % (target_name, insID)
-                    comb1d_fname = os.path.join(output_base, target_name, comb_basename)
-                    source_1d = source_2d.replace(comb_base, 'FLUX1D')
-                    if os.path.exists(comb1d_fname):
-                        os.remove(comb1d_fname)
-                    if os.path.exists(source_1d):
-                        os.link(source_1d, comb1d_fname)
-                        log.write("Created file link:")
-                        log.write("%s" % (source_1d), prefix=" [OUTPUT] - ")
-                        log.write("-> %s" % (comb1d_fname), prefix=" [OUTPUT] ")
-                        log.add_linebreak()
+                    log.write("%s" % (source_1d), prefix=" [OUTPUT] - ")
+                    log.write("-> %s" % (comb1d_fname), prefix=" [OUTPUT] ")
+                    log.add_linebreak()
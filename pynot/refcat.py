@@ -0,0 +1,401 @@
+# -*- coding: UTF-8 -*-
+"""
+Local store of reference catalogs (Gaia, SDSS) for the WCS and zero point calibration.
+
+The sources are partitioned in sky tiles: declination zones of `tile_size` degrees,
+each divided in right ascension into tiles of roughly the same size on the sky.
+Each tile is saved as a binary numpy array in the directory of the catalog.
+The store also records which cones on the sky have been fully downloaded (the coverage),
+such that a cone search is only answered locally if the whole cone has been downloaded.
+
+On a miss, the remote query is called and its result is added to the store,
+see `query_catalog`. Existing catalog dumps (.csv) can be added using `ingest_csv`
+and the fields of a night can be downloaded in advance using `seed_fields`.
+
+The store is located in `~/.pynot/refcat` or in the directory given by
+the environment variable `PYNOT_REFCAT`.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+from astropy.io import fits
+from astropy.table import Table
+from contextlib import contextmanager
+import numpy as np
+import os
+import re
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the store is then only locked within a process:
+    fcntl = None
+
+# Height of the declination zones in degrees:
+tile_size = 1.
+
+default_store_dir = os.environ.get('PYNOT_REFCAT', os.path.join(os.path.expanduser('~'), '.pynot', 'refcat'))
+
+coverage_dtype = [('ra', 'f8'), ('dec', 'f8'), ('radius', 'f8')]
+position_dtype = [('ra', 'f8'), ('dec', 'f8')]
+
+# Pointing and radius (arcmin) in the filenames of the catalog dumps of `correct_wcs` and `find_new_sources`:
+dump_pattern = re.compile(r'_(?P<ra>[0-9.]+)(?P<dec>[+-][0-9.]+)_(?P<radius>[0-9.]+)\.csv$')
+# Uncertainty of the pointing in the filenames (rounded to 0.01 deg) in arcmin:
+dump_precision = 0.3
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """Angular distance in degrees between positions in degrees (haversine formula)"""
+    ra1, dec1, ra2, dec2 = [np.radians(x) for x in (ra1, dec1, ra2, dec2)]
+    a = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(a, 0., 1.))))
+
+
+def _get_zone(dec):
+    n_zones = int(np.ceil(180. / tile_size))
+    return np.clip(np.floor((np.asarray(dec) + 90.) / tile_size).astype(int), 0, n_zones-1)
+
+
+def _get_zone_width(zone):
+    # Number of tiles in right ascension of the given declination zone:
+    dec_min = zone*tile_size - 90.
+    dec_max = min(dec_min + tile_size, 90.)
+    dec_edge = min(abs(dec_min), abs(dec_max)) if dec_min*dec_max > 0 else 0.
+    return max(1, int(np.floor(360. / tile_size * np.cos(np.radians(dec_edge)))))
+
+
+def get_tiles(ra, dec):
+    """Return the zone and index of the tile of each position in degrees"""
+    ra = np.atleast_1d(ra) % 360.
+    zones = np.atleast_1d(_get_zone(dec))
+    n_ra = np.ones_like(zones)
+    for zone in np.unique(zones):
+        n_ra[zones == zone] = _get_zone_width(zone)
+    index = np.floor(ra / 360. * n_ra).astype(int) % n_ra
+    return zones, index
+
+
+def get_cone_tiles(ra, dec, radius):
+    """Return the list of (zone, index) tiles overlapping the cone at `ra`, `dec` of `radius` in arcmin"""
+    r = radius / 60.
+    tiles = list()
+    for zone in range(_get_zone(max(dec - r, -90.)), _get_zone(min(dec + r, 90.)) + 1):
+        n_ra = _get_zone_width(zone)
+        if abs(dec) + r >= 89.9:
+            tiles += [(zone, i) for i in range(n_ra)]
+            continue
+        # Half-width of the cone in right ascension:
+        delta_ra = np.degrees(np.arcsin(min(np.sin(np.radians(r)) / np.cos(np.radians(abs(dec) + r)), 1.)))
+        if delta_ra >= 90.:
+            tiles += [(zone, i) for i in range(n_ra)]
+            continue
+        i_min = int(np.floor((ra - delta_ra) / 360. * n_ra))
+        i_max = int(np.floor((ra + delta_ra) / 360. * n_ra))
+        indices = sorted(set(i % n_ra for i in range(i_min, i_max+1)))
+        tiles += [(zone, i) for i in indices]
+    return tiles
+
+
+def table_to_array(table):
+    """
+    Convert the catalog `table` to a structured array of the numerical columns.
+    Positions are kept in double precision, other columns in single precision.
+    Masked values are set to NaN.
+    """
+    names = [name for name in table.colnames if table[name].dtype.kind in 'fiub']
+    dtype = [(name, 'f8' if name in ('ra', 'dec') else 'f4') for name in names]
+    array = np.zeros(len(table), dtype=dtype)
+    for name in names:
+        array[name] = np.ma.filled(np.ma.asarray(table[name]).astype(float), np.nan)
+    return array
+
+
+class ReferenceStore(object):
+    """
+    Store of reference catalogs in the directory `root`.
+    Each catalog (e.g., 'gaia_dr3', 'sdss') is kept in its own sub-directory.
+    Updates of a catalog are serialized by a lock file in its sub-directory,
+    such that the store can be shared by parallel processes.
+    """
+    def __init__(self, root=default_store_dir):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def catalog_dir(self, catalog):
+        return os.path.join(self.root, catalog)
+
+    def _tile_fname(self, catalog, tile):
+        return os.path.join(self.catalog_dir(catalog), 'tile_%03i_%04i.npy' % tuple(tile))
+
+    def _coverage_fname(self, catalog):
+        return os.path.join(self.catalog_dir(catalog), 'coverage.npy')
+
+    def _columns_fname(self, catalog):
+        return os.path.join(self.catalog_dir(catalog), 'columns.npy')
+
+    @contextmanager
+    def _locked(self, catalog):
+        """Lock the tiles and coverage of `catalog` for the threads and processes using the store"""
+        with self._lock:
+            os.makedirs(self.catalog_dir(catalog), exist_ok=True)
+            with open(os.path.join(self.catalog_dir(catalog), '.lock'), 'w') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _save(self, fname, array):
+        # Write to a temporary file first, such that readers never see a partial file:
+        temp_fname = fname + '.%i.tmp' % os.getpid()
+        with open(temp_fname, 'wb') as output:
+            np.save(output, array)
+        os.replace(temp_fname, fname)
+
+    def get_coverage(self, catalog):
+        """Return the cones (ra, dec, radius in arcmin) that have been downloaded for `catalog`"""
+        fname = self._coverage_fname(catalog)
+        if not os.path.exists(fname):
+            return np.zeros(0, dtype=coverage_dtype)
+        return np.load(fname)
+
+    def get_columns(self, catalog):
+        """Return an empty structured array with the columns of `catalog`"""
+        fname = self._columns_fname(catalog)
+        if not os.path.exists(fname):
+            return np.zeros(0, dtype=position_dtype)
+        return np.load(fname)
+
+    def is_covered(self, catalog, ra, dec, radius):
+        """Is the cone at `ra`, `dec` (deg) of `radius` (arcmin) inside a downloaded cone?"""
+        coverage = self.get_coverage(catalog)
+        if len(coverage) == 0:
+            return False
+        dist = angular_distance(ra, dec, coverage['ra'], coverage['dec']) * 60.
+        return bool(np.any(dist + radius <= coverage['radius'] + 1.e-6))
+
+    def cone_search(self, catalog, ra, dec, radius):
+        """
+        Return the sources of `catalog` within `radius` (arcmin) of `ra`, `dec` (deg)
+        as a :class:`astropy.table.Table`, or None if the cone is not in the store.
+        """
+        if not self.is_covered(catalog, ra, dec, radius):
+            return None
+
+        sources = list()
+        for tile in get_cone_tiles(ra, dec, radius):
+            fname = self._tile_fname(catalog, tile)
+            if os.path.exists(fname):
+                sources.append(np.load(fname))
+        if len(sources) == 0:
+            return Table(self.get_columns(catalog))
+        sources = np.concatenate(sources)
+        dist = angular_distance(ra, dec, sources['ra'], sources['dec']) * 60.
+        return Table(sources[dist <= radius])
+
+    def ingest(self, catalog, table, ra=None, dec=None, radius=None):
+        """
+        Add the sources of `table` (must have columns 'ra' and 'dec' in degrees) to `catalog`.
+        If the table is the complete result of a cone search, give the cone (`ra`, `dec`, `radius`
+        in arcmin) to register it as downloaded. Sources already in the store are not repeated.
+
+        Returns
+        =======
+        N_new : int
+            Number of sources added to the store
+        """
+        if table is None:
+            table = Table()
+        if 'ra' in table.colnames and 'dec' in table.colnames:
+            sources = table_to_array(table)
+        else:
+            sources = np.zeros(0, dtype=position_dtype)
+
+        N_new = 0
+        with self._locked(catalog):
+            if len(sources.dtype.names) > 2 and not os.path.exists(self._columns_fname(catalog)):
+                self._save(self._columns_fname(catalog), sources[:0])
+            zones, index = get_tiles(sources['ra'], sources['dec'])
+            tile_ids = np.column_stack([zones, index])
+            for tile in np.unique(tile_ids, axis=0):
+                in_tile = (zones == tile[0]) & (index == tile[1])
+                new = sources[in_tile]
+                fname = self._tile_fname(catalog, tile)
+                if os.path.exists(fname):
+                    old = np.load(fname)
+                    # Use the columns of the existing tile:
+                    aligned = np.full(len(new), np.nan, dtype=old.dtype)
+                    for name in old.dtype.names:
+                        if name in new.dtype.names:
+                            aligned[name] = new[name]
+                    N_before = len(old)
+                    new = np.concatenate([old, aligned])
+                else:
+                    N_before = 0
+                # Remove duplicate sources:
+                _, unique = np.unique(np.column_stack([new['ra'], new['dec']]), axis=0, return_index=True)
+                new = new[np.sort(unique)]
+                N_new += len(new) - N_before
+                self._save(fname, new)
+
+            if radius is not None and not self.is_covered(catalog, ra, dec, radius):
+                coverage = self.get_coverage(catalog)
+                cone = np.array([(ra, dec, radius)], dtype=coverage_dtype)
+                self._save(self._coverage_fname(catalog), np.concatenate([coverage, cone]))
+        return N_new
+
+    def ingest_csv(self, catalog, fname, ra=None, dec=None, radius=None):
+        """
+        Add the catalog dump `fname` (.csv) to `catalog`. If no cone is given, the cone is taken
+        from the filename if it follows the pattern 'name_RA+DEC_RADIUS.csv' used for the Gaia dumps,
+        otherwise the sources are added without registering the cone as downloaded.
+
+        Returns
+        =======
+        N_new : int
+            Number of sources added to the store
+
+        cone : tuple or None
+            The cone (ra, dec, radius) registered as downloaded
+        """
+        table = Table.read(fname, format='ascii.csv')
+        if radius is None:
+            match = dump_pattern.search(os.path.basename(fname))
+            if match:
+                ra = float(match.group('ra'))
+                dec = float(match.group('dec'))
+                radius = float(match.group('radius')) - dump_precision
+        if radius is not None and radius <= 0:
+            radius = None
+        N_new = self.ingest(catalog, table, ra, dec, radius)
+        cone = None if radius is None else (ra, dec, radius)
+        return N_new, cone
+
+    def __repr__(self):
+        return "<ReferenceStore: %s>" % self.root
+
+
+# The store of the running process:
+store = ReferenceStore()
+
+
+def set_store_dir(root):
+    """Use the reference catalog store in the directory `root`"""
+    store.root = root
+
+
+def query_catalog(catalog, ra, dec, radius, remote_query, limit=None):
+    """
+    Cone search in the local store. If the cone has not been downloaded,
+    the `remote_query` is called and the result is added to the store.
+
+    Parameters
+    ==========
+    catalog : string
+        Name of the catalog in the store, e.g., 'gaia_dr3' or 'sdss'
+
+    ra, dec : float
+        Center of the cone in degrees
+
+    radius : float
+        Radius of the cone in arcmin
+
+    remote_query : callable
+        Function without arguments that downloads the cone and returns an :class:`astropy.table.Table`
+        (or None if there are no sources). Replace by a local stand-in to run offline.
+
+    limit : int  [default=None]
+        Maximum number of sources returned by the remote query. If the result is truncated,
+        the sources are stored but the cone is not registered as downloaded.
+
+    Returns
+    =======
+    result : :class:`astropy.table.Table`
+        The sources within the cone (None if the remote query found no sources)
+
+    cached : bool
+        True if the result was found in the local store
+    """
+    result = store.cone_search(catalog, ra, dec, radius)
+    if result is not None:
+        return result, True
+
+    result = remote_query()
+    complete = limit is None or result is None or len(result) < limit
+    store.ingest(catalog, result, ra, dec, radius if complete else None)
+    return result, False
+
+
+def get_field(fname):
+    """
+    Return the pointing (ra, dec in deg) and the radius (arcmin) of the field
+    of the image `fname` from the WCS of the header.
+    The radius covers the cones used by `correct_wcs` and `flux_calibration_sdss`.
+    """
+    from pynot import instrument
+    hdr = fits.getheader(fname)
+    if 'CRVAL1' not in hdr or 'CD1_1' not in hdr:
+        hdr = instrument.get_header(fname)
+    image_scale = np.sqrt(hdr['CD1_1']**2 + hdr['CD1_2']**2) * 60.
+    radius = image_scale * np.max([hdr['NAXIS1'], hdr['NAXIS2']]) / np.sqrt(2)
+    return hdr['CRVAL1'], hdr['CRVAL2'], radius
+
+
+def seed_fields(filelist, catalogs=('gaia', 'sdss'), margin=2.):
+    """
+    Download the reference catalogs for the fields of the images in `filelist`
+    (e.g., the imaging frames of a night) into the local store.
+
+    Parameters
+    ==========
+    filelist : list(str)
+        Filenames of images with a WCS in the header (raw or processed)
+
+    catalogs : list(str)  [default=('gaia', 'sdss')]
+        The catalogs to download
+
+    margin : float  [default=2.]
+        Radius in arcmin added to the field radius to allow for offsets between exposures
+
+    Returns
+    =======
+    output_msg : string
+        Log of messages from the function call.
+    """
+    from pynot.wcs import get_gaia_catalog
+    from pynot.phot import get_sdss_catalog
+
+    msg = list()
+    msg.append("          - Reference catalog store: %s" % store.root)
+    fields = list()
+    for fname in filelist:
+        try:
+            ra, dec, radius = get_field(fname)
+        except (KeyError, OSError, IndexError) as e:
+            msg.append("[WARNING] - Could not determine the field of %s: %s" % (fname, str(e)))
+            continue
+        radius += margin
+        # Skip offset exposures of fields already listed, the offsets are covered by the margin:
+        if any(angular_distance(ra, dec, ra0, dec0)*60. <= margin and radius <= r0 for ra0, dec0, r0 in fields):
+            continue
+        fields.append((ra, dec, radius))
+    msg.append("          - Found %i field%s" % (len(fields), '' if len(fields) == 1 else 's'))
+
+    query_functions = {'gaia': get_gaia_catalog, 'sdss': get_sdss_catalog}
+    for ra, dec, radius in fields:
+        for catalog in catalogs:
+            try:
+                result = query_functions[catalog](ra, dec, radius=radius)
+                N_sources = 0 if result is None else len(result)
+                msg.append("          - %s: (ra, dec) = (%.5f ; %+.5f)  within %.1f arcmin: %i sources" % (
+                           catalog.upper(), ra, dec, radius, N_sources))
+            except Exception as e:
+                msg.append(" [ERROR]  - Could not download %s catalog for (ra, dec) = (%.5f ; %+.5f): %s" % (
+                           catalog.upper(), ra, dec, str(e)))
+    msg.append("")
+    return "\n".join(msg)
@@ -0,0 +1,288 @@
+# -*- coding: UTF-8 -*-
+"""
+Image registration for the image combination.
+
+The transformation between two images is found by matching triangles (asterisms)
+of bright point sources as in `astroalign`. The control points of each frame are
+detected once using SEP (or taken from an existing source catalog `_phot.fits`),
+the asterisms of the reference frame are only computed once for the whole sequence,
+and the transformations can be found on a pool of processes.
+The data, error and mask images of a frame are resampled in one pass sharing
+the footprint of the transformation.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+from astropy.table import Table
+import astroalign as aa
+from itertools import combinations
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+import sep
+from skimage.transform import estimate_transform, warp
+
+# Number of nearest neighbours used to build the asterisms of each control point (as in astroalign):
+num_nearest_neighbors = 5
+
+# Maximum distance between matching invariants (as in astroalign):
+invariant_radius = 0.1
+
+# Maximum residual in pixels of a matching triangle (astroalign.PIXEL_TOL):
+pixel_tolerance = 2
+
+# Fraction of the matching triangles required to accept a transformation (astroalign.MIN_MATCHES_FRACTION):
+min_matches_fraction = 0.8
+
+# Vertex shared by two sides of a triangle with sides: 0: (v0, v1), 1: (v1, v2), 2: (v2, v0)
+_shared_vertex = np.array([[-1, 1, 0],
+                           [1, -1, 2],
+                           [0, 2, -1]])
+
+
+def find_control_points(img, detection_sigma=5, min_area=9, max_control_points=50):
+    """
+    Detect point sources in the image `img` using SEP as in `astroalign`.
+
+    Returns
+    =======
+    points : np.array (N, 2)
+        The (x, y) positions of the `max_control_points` brightest sources, sorted by flux
+    """
+    image = np.ascontiguousarray(img, dtype=np.float32)
+    bkg = sep.Background(image)
+    sources = sep.extract(image - bkg.back(), detection_sigma * bkg.globalrms, minarea=min_area)
+    sources.sort(order='flux')
+    sources = sources[::-1]
+    points = np.column_stack([sources['x'], sources['y']]).astype(np.float64)
+    return points[:max_control_points]
+
+
+def get_catalog_fname(fname):
+    """Filename of the source catalog from `source_detection` of the image `fname`"""
+    base, _ = os.path.splitext(fname)
+    return base + '_phot.fits'
+
+
+def read_control_points(catalog_fname, max_control_points=50):
+    """Return the (x, y) positions of the brightest sources in the SEP source catalog (_phot.fits)"""
+    catalog = Table.read(catalog_fname)
+    order = np.argsort(catalog['flux_auto'])[::-1]
+    points = np.column_stack([catalog['x'][order], catalog['y'][order]]).astype(np.float64)
+    return points[:max_control_points]
+
+
+def get_control_points(fname, img, detection_sigma=5, min_area=9, max_control_points=50):
+    """
+    Control points of the image `img` from the file `fname`. The sources are taken from
+    the source catalog of the image if it exists, otherwise they are detected using SEP.
+    """
+    catalog_fname = get_catalog_fname(fname)
+    if os.path.exists(catalog_fname):
+        return read_control_points(catalog_fname, max_control_points)
+    return find_control_points(img, detection_sigma=detection_sigma, min_area=min_area,
+                               max_control_points=max_control_points)
+
+
+class Asterisms(object):
+    """
+    The triangles of nearest neighbours (asterisms) of a set of control points and
+    their invariants: the ratios of the sides L3/L2 and L2/L1 where L1 < L2 < L3.
+    The vertices of each triangle are ordered as in `astroalign`: (a, b, c) where `a` is
+    the vertex between L1 and L2, `b` is the vertex between L2 and L3, and `c` between L3 and L1.
+
+    Parameters
+    ==========
+    points : np.array (N, 2)
+        The (x, y) positions of the control points
+    """
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.float64)
+        if len(self.points) < 3:
+            raise ValueError("Less than 3 control points found in the image")
+
+        knn = min(len(self.points), num_nearest_neighbors)
+        _, neighbors = cKDTree(self.points).query(self.points, knn)
+        triplets = np.array(list(combinations(range(knn), 3)))
+        triangles = neighbors[:, triplets].reshape(-1, 3)
+
+        # Remove triangles that appear for more than one control point,
+        # keeping the last occurrence as in `astroalign`:
+        _, unique = np.unique(np.sort(triangles, axis=1)[::-1], axis=0, return_index=True)
+        triangles = triangles[np.sort(len(triangles) - 1 - unique)]
+
+        vertices = self.points[triangles]
+        sides = np.column_stack([np.linalg.norm(vertices[:, 0] - vertices[:, 1], axis=1),
+                                 np.linalg.norm(vertices[:, 1] - vertices[:, 2], axis=1),
+                                 np.linalg.norm(vertices[:, 2] - vertices[:, 0], axis=1)])
+        order = np.argsort(sides, axis=1)
+        l1, l2, l3 = order.T
+        rows = np.arange(len(triangles))
+        self.asterisms = np.column_stack([triangles[rows, _shared_vertex[l1, l2]],
+                                          triangles[rows, _shared_vertex[l2, l3]],
+                                          triangles[rows, _shared_vertex[l3, l1]]])
+        sorted_sides = np.take_along_axis(sides, order, axis=1)
+        self.invariants = np.column_stack([sorted_sides[:, 2] / sorted_sides[:, 1],
+                                           sorted_sides[:, 1] / sorted_sides[:, 0]])
+        self.tree = cKDTree(self.invariants)
+
+    def __len__(self):
+        return len(self.asterisms)
+
+
+def _ransac(matches, model, thresh, min_matches, chunk_size=256):
+    """
+    Find the similarity transformation of the matched triangles using RANSAC as `astroalign._ransac`.
+    The transformations of the single triangles are calculated at once and tested against all
+    matches in chunks, in the same random order as in `astroalign`, instead of one at a time.
+
+    Returns
+    =======
+    transform : skimage.transform.SimilarityTransform
+        The best transformation
+
+    inliers : np.array(int)
+        Indices of the matches that fit the transformation
+    """
+    n_data = len(matches)
+    all_idxs = np.arange(n_data)
+    np.random.default_rng().shuffle(all_idxs)
+
+    # Positions of the triangle vertices as complex numbers, shape (N, 3):
+    src = model.source[matches[:, :, 0]]
+    dst = model.target[matches[:, :, 1]]
+    src = src[:, :, 0] + 1j*src[:, :, 1]
+    dst = dst[:, :, 0] + 1j*dst[:, :, 1]
+    # The least-squares similarity transformation of each triangle: z -> a*(z - src_0) + dst_0
+    src_0 = src.mean(axis=1)
+    dst_0 = dst.mean(axis=1)
+    src_c = src - src_0[:, np.newaxis]
+    dst_c = dst - dst_0[:, np.newaxis]
+    a = np.sum(np.conj(src_c) * dst_c, axis=1) / np.sum(np.abs(src_c)**2, axis=1)
+
+    good_fit = None
+    for start in range(0, n_data, chunk_size):
+        idxs = all_idxs[start:start+chunk_size]
+        pred = a[idxs, np.newaxis, np.newaxis] * (src[np.newaxis, :, :] - src_0[idxs, np.newaxis, np.newaxis])
+        error = np.abs(pred + dst_0[idxs, np.newaxis, np.newaxis] - dst[np.newaxis, :, :]).max(axis=2)
+        error[np.arange(len(idxs)), idxs] = np.inf
+        N_inliers = np.sum(error < thresh, axis=1)
+        accepted = np.nonzero(N_inliers >= min_matches)[0]
+        if len(accepted) > 0:
+            iter_i = start + accepted[0]
+            maybe_idx = all_idxs[iter_i]
+            test_idxs = np.concatenate([all_idxs[:iter_i], all_idxs[iter_i+1:]])
+            maybe_fit = model.fit(matches[maybe_idx:maybe_idx+1])
+            also_idxs = test_idxs[model.get_error(matches[test_idxs], maybe_fit) < thresh]
+            good_data = np.concatenate([matches[maybe_idx:maybe_idx+1], matches[also_idxs]])
+            good_fit = model.fit(good_data)
+            break
+
+    if good_fit is None:
+        raise aa.MaxIterError("List of matching triangles exhausted before an acceptable "
+                              "transformation was found")
+
+    better_fit = good_fit
+    for i in range(3):
+        test_err = model.get_error(matches, better_fit)
+        inliers = np.arange(n_data)[test_err < thresh]
+        better_fit = model.fit(matches[inliers])
+    return better_fit, inliers
+
+
+class MatchTransform(object):
+    """
+    Similarity transformation of matching triangles between the `source` and `target`
+    control points for the RANSAC search (as `astroalign._MatchTransform`).
+    The matches are given as an array (N, 3, 2) of the indices of the triangle vertices
+    in the source and target points.
+    """
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+
+    def fit(self, data):
+        """Return the best similarity transformation of all the matching triangles in `data`"""
+        s, d = data.reshape(-1, 2).T
+        return estimate_transform('similarity', self.source[s], self.target[d])
+
+    def get_error(self, data, approx_t):
+        """Return the largest residual of the vertices of each matching triangle in `data`"""
+        s, d = data.reshape(-1, 2).T
+        resid = approx_t.residuals(self.source[s], self.target[d]).reshape(data.shape[:2])
+        return resid.max(axis=1)
+
+
+def find_transform(source, target):
+    """
+    Find the similarity transformation from the `source` to the `target` control points.
+
+    Parameters
+    ==========
+    source : :class:`Asterisms`
+        Asterisms of the frame to register
+
+    target : :class:`Asterisms`
+        Asterisms of the reference frame
+
+    Returns
+    =======
+    transform : skimage.transform.SimilarityTransform
+        The transformation mapping (x, y) in the source frame to the target frame
+
+    (source_points, target_points) : tuple(np.array, np.array)
+        The matched control points in the source and target frame
+    """
+    matches_list = source.tree.query_ball_tree(target.tree, r=invariant_radius)
+    matches = [np.stack([source.asterisms[i], target.asterisms[j]], axis=-1)
+               for i, target_matches in enumerate(matches_list) for j in target_matches]
+    if len(matches) == 0:
+        raise aa.MaxIterError("No matching triangles found")
+    matches = np.array(matches)
+
+    inv_model = MatchTransform(source.points, target.points)
+    min_matches = max(1, min(10, int(len(matches) * min_matches_fraction)))
+    if (len(source.points) == 3 or len(target.points) == 3) and len(matches) == 1:
+        best_t = inv_model.fit(matches)
+        inliers = np.arange(len(matches))
+    else:
+        best_t, inliers = _ransac(matches, inv_model, pixel_tolerance, min_matches)
+
+    # Keep the pair of control points with the lowest error for each source point:
+    pairs = np.unique(matches[inliers].reshape(-1, 2), axis=0)
+    errors = np.linalg.norm(best_t(source.points[pairs[:, 0]]) - target.points[pairs[:, 1]], axis=1)
+    best_pair = dict()
+    for (s_i, t_i), error in zip(pairs, errors):
+        if s_i not in best_pair or error < best_pair[s_i][1]:
+            best_pair[s_i] = (t_i, error)
+    s = np.array(list(best_pair.keys()))
+    d = np.array([t_i for t_i, _ in best_pair.values()])
+    return best_t, (source.points[s], target.points[d])
+
+
+def warp_frame(transform, images, output_shape, fill_value=0):
+    """
+    Resample the `images` of a frame (e.g., data, error and mask) onto the reference frame
+    using the same interpolation as `astroalign.apply_transform`. The footprint of the
+    transformation is only calculated once for all the images.
+
+    Returns
+    =======
+    registered : list(np.array)
+        The registered images. Pixels outside the footprint are set to `fill_value`.
+
+    footprint : np.array(bool)
+        True for the pixels without data from the input frame
+    """
+    footprint = warp(np.zeros(images[0].shape, dtype='float32'), inverse_map=transform.inverse,
+                     output_shape=output_shape, cval=1.0)
+    footprint = footprint > 0.4
+    registered = list()
+    for img in images:
+        aligned = warp(img, inverse_map=transform.inverse, output_shape=output_shape,
+                       order=3, mode='constant', cval=np.median(img), clip=True, preserve_range=True)
+        if fill_value is not None:
+            aligned[footprint] = fill_value
+        registered.append(aligned)
+    return registered, footprint
@@ -8,17 +8,17 @@ Write calibration reports for:
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends import backend_pdf
-from astropy.io import fits
 import os
 
 from pynot import instrument
+from pynot.fitsio import read_image_data
 
 report_dir = 'reports'
 
 plt.rcParams['font.family'] = 'Arial'
 
 def check_bias(bias_images, bias_fnames, mbias_fname, report_fname=''):
-    mbias = fits.getdata(mbias_fname)
+    mbias, _ = read_image_data(mbias_fname)
 
     plt.close('all')
     fig, axes = plt.subplots(2, 2, figsize=(9, 9))
@@ -105,8 +105,7 @@ def check_arcs(arc_fnames, report_fname):
     pdf = backend_pdf.PdfPages(report_fname)
     for fname in arc_fnames:
         fig, axes = plt.subplots(3, 1, figsize=(5.6, 8))
-        img = fits.getdata(fname)
-        hdr = fits.getheader(fname)
+        img, hdr = read_image_data(fname)
         x0 = img.shape[1]//2
         y0 = img.shape[0]//2
 
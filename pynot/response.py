@@ -24,11 +24,14 @@ import glob
 
 from pynot import instrument
 from pynot.data import organizer
+from pynot.data.calibplan import plan_calibrations
 from pynot.extraction import auto_extract
 from pynot import extract_gui
+from pynot.fitsio import read_image_data
 from pynot.functions import get_version_number, my_formatter, mad
 from pynot import response_gui
 from pynot.logging import Report
+from pynot.product import load_product, get_product_name, as_data_type
 from pynot.scired import auto_fit_background, raw_correction
 from pynot.scombine import combine_2d
 from pynot.wavecal import rectify
@@ -79,14 +82,19 @@ def load_spectrum1d(fname):
     return wl, flux
 
 
-def flux_calibrate(input_fname, *, output, response_fname):
-    """Apply response function to flux calibrate the input spectrum"""
+def flux_calibrate(img, *, output, response_fname):
+    """
+    Apply response function to flux calibrate the input spectrum `img`
+    (filename or :class:`pynot.product.ImageProduct`). The flux calibrated product is returned
+    together with the log, and is saved if an `output` filename is given.
+    """
     msg = list()
     # Load input data:
-    hdr = fits.getheader(input_fname)
-    img2D = fits.getdata(input_fname)
-    err2D = fits.getdata(input_fname, 'ERR')
-    msg.append("          - Loaded image: %s" % input_fname)
+    product = load_product(img)
+    hdr = product.header
+    img2D = np.asarray(product.data, dtype=np.float64)
+    err2D = np.asarray(product['ERR'].data, dtype=np.float64)
+    msg.append("          - Loaded image: %s" % get_product_name(img))
     cdelt = hdr['CDELT1']
     crval = hdr['CRVAL1']
     crpix = hdr['CRPIX1']
@@ -107,7 +115,7 @@ def flux_calibrate(input_fname, *, output, response_fname):
         msg.append(" [ERROR]  - Grisms of input spectrum and response function do not match!")
         msg.append("")
         output_msg = "\n".join(msg)
-        return output_msg
+        return None, output_msg
 
     resp_int = np.interp(wl, resp_tab['WAVE'], resp_tab['RESPONSE'])
     # Truncate values less than 20:
@@ -123,7 +131,7 @@ def flux_calibrate(input_fname, *, output, response_fname):
             msg.append(" [ERROR]  - Invalid airmass!")
             msg.append(" [ERROR]  - " + str(e))
             msg.append("")
-            return "\n".join(msg)
+            return None, "\n".join(msg)
 
     t = instrument.get_exptime(hdr)
     if t is None:
@@ -133,7 +141,7 @@ def flux_calibrate(input_fname, *, output, response_fname):
         except ValueError:
             msg.append(" [ERROR]  - Invalid exposure time: %r" % user_input)
             msg.append("")
-            return "\n".join(msg)
+            return None, "\n".join(msg)
 
     msg.append("          - exposure time: %.1f" % t)
     msg.append("          - airmass: %.3f" % airmass)
@@ -144,19 +152,19 @@ def flux_calibrate(input_fname, *, output, response_fname):
     flux2D = img2D / (t * cdelt) * flux_calib2D
     err2D = err2D / (t * cdelt) * flux_calib2D
 
-    with fits.open(input_fname) as hdu:
-        hdu[0].data = flux2D
-        hdu[0].header['BUNIT'] = 'erg/s/cm2/A'
-        hdu[0].header['RESPONSE'] = response_fname
+    product.data = as_data_type(flux2D)
+    product.header['BUNIT'] = 'erg/s/cm2/A'
+    product.header['RESPONSE'] = response_fname
 
-        hdu['ERR'].data = err2D
-        hdu['ERR'].header['BUNIT'] = 'erg/s/cm2/A'
+    product['ERR'].data = as_data_type(err2D)
+    product['ERR'].header['BUNIT'] = 'erg/s/cm2/A'
 
-        hdu.writeto(output, overwrite=True)
-    msg.append(" [OUTPUT] - Saving flux calibrated 2D image: %s" % output)
+    product.save(output)
+    if output:
+        msg.append(" [OUTPUT] - Saving flux calibrated 2D image: %s" % output)
     msg.append("")
     output_msg = "\n".join(msg)
-    return output_msg
+    return product, output_msg
 
 
 def flux_calibrate_1d(input_fname, *, output, response_fname):
@@ -313,7 +321,7 @@ def calculate_response(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat
         rectify_options = rectify_options.copy()
 
     hdr = instrument.get_header(raw_fname)
-    raw2D = fits.getdata(raw_fname)
+    raw2D, _ = read_image_data(raw_fname)
     msg.append("          - Loaded flux standard image: %s" % raw_fname)
 
     # Setup the filenames:
@@ -340,8 +348,8 @@ def calculate_response(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat
         extract_pdf_fname = os.path.join(output_dir, extract_pdf_fname)
 
     try:
-        output_msg = raw_correction(raw2D, hdr, bias_fname, flat_fname,
-                                    output=std_tmp_fname, overwrite=True)
+        _, output_msg = raw_correction(raw2D, hdr, bias_fname, flat_fname,
+                                       output=std_tmp_fname, overwrite=True)
         msg.append(output_msg)
     except:
         msg.append("Unexpected error in raw correction: %r" % sys.exc_info()[0])
@@ -351,8 +359,8 @@ def calculate_response(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat
     # Rectify 2D image and wavelength calibrate:
     try:
         rectify_options['plot'] = False
-        rect_msg = rectify(std_tmp_fname, arc_fname, pixtable_fname, output=rect2d_fname,
-                           dispaxis=dispaxis, **rectify_options)
+        _, rect_msg = rectify(std_tmp_fname, arc_fname, pixtable_fname, output=rect2d_fname,
+                              dispaxis=dispaxis, **rectify_options)
         msg.append(rect_msg)
     except:
         msg.append("Unexpected error in rectify: %r" % sys.exc_info()[0])
@@ -363,8 +371,8 @@ def calculate_response(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat
 
     # Subtract background:
     try:
-        bg_msg = auto_fit_background(rect2d_fname, bgsub2d_fname, dispaxis=1, order_bg=order_bg, plot_fname='',
-                                     kappa=100, fwhm_scale=5)
+        _, bg_msg = auto_fit_background(rect2d_fname, bgsub2d_fname, dispaxis=1, order_bg=order_bg, plot_fname='',
+                                        kappa=100, fwhm_scale=5)
         msg.append(bg_msg)
     except:
         msg.append("Unexpected error in auto sky sub: %r" % sys.exc_info()[0])
@@ -613,7 +621,7 @@ def process_std_flux(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat_f
         rectify_options = rectify_options.copy()
 
     hdr = instrument.get_header(raw_fname)
-    raw2D = fits.getdata(raw_fname)
+    raw2D, _ = read_image_data(raw_fname)
     log.write("Loaded flux standard image: %s" % raw_fname)
 
     ob_id = instrument.get_date(hdr).split('.')[0]
@@ -622,8 +630,8 @@ def process_std_flux(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat_f
     bgsub2d_fname = os.path.join(output_dir, 'std_bgsub2D_%s.fits' % ob_id)
 
     try:
-        output_msg = raw_correction(raw2D, hdr, bias_fname, flat_fname,
-                                    output=corr2d_fname, overwrite=True)
+        _, output_msg = raw_correction(raw2D, hdr, bias_fname, flat_fname,
+                                       output=corr2d_fname, overwrite=True)
         log.commit(output_msg)
         log.add_linebreak()
     except:
@@ -633,8 +641,8 @@ def process_std_flux(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat_f
     # Rectify 2D image and wavelength calibrate:
     try:
         rectify_options['plot'] = True
-        rect_msg = rectify(corr2d_fname, arc_fname, pixtable_fname, output=rect2d_fname,
-                           dispaxis=dispaxis, fig_dir=output_dir, **rectify_options)
+        _, rect_msg = rectify(corr2d_fname, arc_fname, pixtable_fname, output=rect2d_fname,
+                              dispaxis=dispaxis, fig_dir=output_dir, **rectify_options)
         log.commit(rect_msg)
         log.add_linebreak()
     except:
@@ -644,8 +652,8 @@ def process_std_flux(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat_f
 
     # Subtract background:
     try:
-        bg_msg = auto_fit_background(rect2d_fname, bgsub2d_fname, dispaxis=1, order_bg=order_bg, plot_fname='',
-                                     kappa=100, fwhm_scale=5)
+        _, bg_msg = auto_fit_background(rect2d_fname, bgsub2d_fname, dispaxis=1, order_bg=order_bg, plot_fname='',
+                                        kappa=100, fwhm_scale=5)
         log.commit(bg_msg)
         log.add_linebreak()
     except:
@@ -655,9 +663,11 @@ def process_std_flux(raw_fname, *, arc_fname, pixtable_fname, bias_fname, flat_f
     return bgsub2d_fname, log
 
 
-def task_response(options, database, status, log=None, verbose=True, app=None, output_dir='', **kwargs):
+def task_response(options, database, status, log=None, verbose=True, app=None, output_dir='', plan=None, **kwargs):
     """
-    Reduce the standard stars and determine the response function
+    Reduce the standard stars and determine the response function.
+    The calibrations of the standard stars are taken from the calibration `plan`
+    (:class:`pynot.data.calibplan.CalibrationPlan`), if not given they are matched from the `database`.
     """
     if log is None:
         log = Report(verbose)
@@ -694,12 +704,12 @@ def task_response(options, database, status, log=None, verbose=True, app=None, o
             if not os.path.exists(ob_dir):
                 os.makedirs(ob_dir)
 
-            master_bias = organizer.match_single_calib(raw_img, database, 'MBIAS', log, date=False)
-            norm_flat = organizer.match_single_calib(raw_img, database, 'NORM_SFLAT', log, date=False,
-                                                     grism=True, slit=True, filter=True)
-            arc_fname = organizer.match_single_calib(raw_img, database, 'ARC_CORR', log, date=False,
-                                                     grism=True, slit=False, filter=True,
-                                                     get_closest_time=True)
+            std_plan = plan
+            if std_plan is None or raw_img.filename not in std_plan:
+                std_plan = plan_calibrations([raw_img], database, 'SPEC_FLUX-STD')
+            master_bias = std_plan.get_calibration(raw_img, 'MBIAS', log)
+            norm_flat = std_plan.get_calibration(raw_img, 'NORM_SFLAT', log)
+            arc_fname = std_plan.get_calibration(raw_img, 'ARC_CORR', log)
             pixtab_fnames = status.find_pixtab(grism)
             pixtable = pixtab_fnames[0]
 
@@ -37,19 +37,24 @@ __author__ = 'Jens-Kristian Krogager'
 __email__ = "krogager@iap.fr"
 __credits__ = ["Jens-Kristian Krogager"]
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
-from scipy.ndimage import median_filter
 from scipy import signal
-from numpy.polynomial import Chebyshev
+from scipy.ndimage import minimum_filter
 import os
 import warnings
 
 from astroscrappy import detect_cosmics
+from astroscrappy.astroscrappy import update_mask
 
 from pynot import instrument
-from pynot.functions import mad, get_version_number
+from pynot.calibpool import get_calibration
+from pynot.fitsio import read_image_data
+from pynot.functions import mad, get_version_number, median_filter_rows, chebyshev_fit_rows
+from pynot.product import ImageProduct, load_product, get_product_name
+from pynot.product import as_data_type, as_mask_type, add_mask_bits
 
 
 __version__ = get_version_number()
@@ -98,7 +103,7 @@ def trim_overscan(img, hdr):
 def detect_filter_edge(fname):
     """Automatically detect edges in the normalized flat field"""
     # Get median profile along slit:
-    img = fits.getdata(fname)
+    img = np.array(get_calibration(fname))
 
     # Using the normalized flat field, the values are between 0 and 1.
     # Convert the image to a binary mask image:
@@ -130,42 +135,53 @@ def detect_filter_edge(fname):
     return (x1, x2, y1, y2)
 
 
-def trim_filter_edge(fname, x1, x2, y1, y2, output='', output_dir=''):
-    """Trim image edges"""
-    # Get median profile along slit:
+def trim_filter_edge(img, x1, x2, y1, y2, output='', output_dir=''):
+    """
+    Trim image edges of all extensions of the image `img` (filename or :class:`ImageProduct`).
+    If `img` is a product and no `output` is given, the trimmed product is not saved.
+
+    Returns
+    =======
+    product : :class:`pynot.product.ImageProduct`
+        The trimmed image
+
+    output_msg : string
+        Log of messages from the function call
+    """
     msg = list()
-    msg.append("          - Loaded file: %s" % fname)
+    product = load_product(img)
+    msg.append("          - Loaded file: %s" % get_product_name(img))
 
-    if output == '':
-        basename = os.path.basename(fname)
+    if output == '' and not isinstance(img, ImageProduct):
+        basename = os.path.basename(img)
         output = 'trim_' + basename
 
-    if output_dir != '':
+    if output_dir != '' and output != '':
         if not os.path.exists(output_dir):
             os.mkdir(output_dir)
         output = os.path.join(output_dir, output)
 
-    with fits.open(fname) as hdu_list:
-        for hdu in hdu_list:
-            if hdu.data is None:
-                continue
-
-            data = hdu.data
-            hdr = hdu.header
-            data_trim = data[y1:y2, x1:x2]
-            hdr['CRPIX1'] -= x1
-            hdr['NAXIS1'] = data_trim.shape[1]
-            hdr['CRPIX2'] -= y1
-            hdr['NAXIS2'] = data_trim.shape[0]
-            hdr.add_comment("Image trimmed by PyNOT")
-            hdu.data = data_trim
-            hdu.header = hdr
-        hdu_list.writeto(output, overwrite=True)
-    msg.append(" [OUTPUT] - Saving trimmed image: %s" % output)
+    for hdu in product:
+        if hdu.data is None:
+            continue
+
+        data = hdu.data
+        hdr = hdu.header
+        data_trim = data[y1:y2, x1:x2]
+        hdr['CRPIX1'] -= x1
+        hdr['NAXIS1'] = data_trim.shape[1]
+        hdr['CRPIX2'] -= y1
+        hdr['NAXIS2'] = data_trim.shape[0]
+        hdr.add_comment("Image trimmed by PyNOT")
+        hdu.data = data_trim
+        hdu.header = hdr
+    product.save(output)
+    if output:
+        msg.append(" [OUTPUT] - Saving trimmed image: %s" % output)
     msg.append("")
     output_msg = "\n".join(msg)
 
-    return output_msg
+    return product, output_msg
 
 
 def fit_background_image(data, order_bg=3, xmin=0, xmax=None, med_kernel=15, kappa=5, fwhm_scale=1, obj_kappa=20):
@@ -200,7 +216,9 @@ def fit_background_image(data, order_bg=3, xmin=0, xmax=None, med_kernel=15, kap
         xmax = len(x)
     if xmax < 0:
         xmax = len(x) + xmax
-    SPSF = np.nanmedian(data, 0)
+    # `nanmedian` along an axis is much slower than `median`, only use it if needed:
+    median = np.nanmedian if np.any(np.isnan(data)) else np.median
+    SPSF = median(data, 0)
     noise = 1.5*mad(SPSF)
     peaks, properties = signal.find_peaks(SPSF, prominence=obj_kappa*noise, width=3)
     mask = (x >= xmin) & (x <= xmax)
@@ -212,31 +230,33 @@ def fit_background_image(data, order_bg=3, xmin=0, xmax=None, med_kernel=15, kap
         mask &= ~obj
     N_masked_pixels = np.sum(~mask)
 
+    # Median filter the data along the rows to remove outliers:
+    med_data = median_filter_rows(data, med_kernel)
+    noise = mad(data, axis=1)*1.4826
+    row_mask = mask & (np.abs(data - med_data) < kappa*noise[:, np.newaxis])
+
+    # Fit all rows at once:
+    coeffs, vander = chebyshev_fit_rows(x, data, row_mask, order_bg, domain=[x.min(), x.max()])
+    good_rows = np.all(np.isfinite(coeffs), 1)
     bg2D = np.zeros_like(data)
-    for i, row in enumerate(data):
-        # Median filter the data to remove outliers:
-        med_row = median_filter(row, med_kernel)
-        noise = mad(row)*1.4826
-        this_mask = mask * (np.abs(row - med_row) < kappa*noise)
-        if np.sum(this_mask) > order_bg+1:
-            bg_model = Chebyshev.fit(x[this_mask], row[this_mask], order_bg, domain=[x.min(), x.max()])
-            bg2D[i] = bg_model(x)
+    bg2D[good_rows] = coeffs[good_rows] @ vander.T
 
     return bg2D, N_masked_pixels
 
 
-def auto_fit_background(data_fname, output_fname, dispaxis=2, order_bg=3, med_kernel=15, kappa=10, obj_kappa=20, fwhm_scale=3, xmin=0, xmax=None, plot_fname='', **kwargs):
+def auto_fit_background(img, output_fname, dispaxis=2, order_bg=3, med_kernel=15, kappa=10, obj_kappa=20, fwhm_scale=3, xmin=0, xmax=None, plot_fname='', **kwargs):
     """
     Fit background in 2D spectral data. The background is fitted along the spatial rows by a Chebyshev polynomium.
 
     Parameters
     ==========
-    data_fname : string
-        Filename of the FITS image to process
+    img : string or :class:`pynot.product.ImageProduct`
+        Filename of the FITS image to process, or the image product
 
     output_fname : string
         Filename of the output FITS image containing the background subtracted image
         as well as the background model in a separate extension.
+        If no filename is given, the output product is not saved.
 
     dispaxis : integer  [default=1]
         Dispersion axis, 1: horizontal spectra, 2: vertical spectra
@@ -270,15 +290,19 @@ def auto_fit_background(data_fname, output_fname, dispaxis=2, order_bg=3, med_ke
 
     Returns
     =======
-    output_fname : string
-        Background model of the 2D frame, same shape as input data.
+    product : :class:`pynot.product.ImageProduct`
+        The background subtracted image with the background model in the extension 'SKY'
 
     output_msg : string
         Log of messages from the function call
     """
     msg = list()
-    data = fits.getdata(data_fname)
-    hdr = instrument.get_header(data_fname)
+    product = load_product(img)
+    data = np.asarray(product.data, dtype=np.float64)
+    if isinstance(img, ImageProduct):
+        hdr = product.header
+    else:
+        hdr = instrument.get_header(img)
     if 'DISPAXIS' in hdr:
         dispaxis = hdr['DISPAXIS']
 
@@ -286,7 +310,7 @@ def auto_fit_background(data_fname, output_fname, dispaxis=2, order_bg=3, med_ke
         # transpose the horizontal spectra to make them vertical
         # since it's faster to fit rows than columns
         data = data.T
-    msg.append("          - Loaded input image: %s" % data_fname)
+    msg.append("          - Loaded input image: %s" % get_product_name(img))
 
     msg.append("          - Fitting background along the spatial axis with polynomium of order: %i" % order_bg)
     msg.append("          - Automatic masking of outlying pixels and object trace")
@@ -321,67 +345,205 @@ def auto_fit_background(data_fname, output_fname, dispaxis=2, order_bg=3, med_ke
         data = data.T
         bg2D = bg2D.T
 
-    with fits.open(data_fname) as hdu:
-        hdu[0].data = data
-        sky_hdr = fits.Header()
-        sky_hdr['BUNIT'] = 'count'
-        copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1']
-        copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CD1_1', 'CD2_2', 'CD1_2', 'CD2_1']
-        sky_hdr['CTYPE2'] = 'LINEAR'
-        sky_hdr['CUNIT2'] = 'Pixel'
-        for key in copy_keywords:
-            if key in hdr:
-                sky_hdr[key] = hdr[key]
-        sky_hdr['AUTHOR'] = 'PyNOT version %s' % __version__
-        sky_hdr['ORDER'] = (order_bg, "Polynomial order along spatial rows")
-        sky_ext = fits.ImageHDU(bg2D, header=sky_hdr, name='SKY')
-        hdu.append(sky_ext)
-        hdu.writeto(output_fname, overwrite=True)
-
-    msg.append(" [OUTPUT] - Saving background subtracted image: %s" % output_fname)
+    product.data = as_data_type(data)
+    sky_hdr = fits.Header()
+    sky_hdr['BUNIT'] = 'count'
+    copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1']
+    copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CD1_1', 'CD2_2', 'CD1_2', 'CD2_1']
+    sky_hdr['CTYPE2'] = 'LINEAR'
+    sky_hdr['CUNIT2'] = 'Pixel'
+    for key in copy_keywords:
+        if key in hdr:
+            sky_hdr[key] = hdr[key]
+    sky_hdr['AUTHOR'] = 'PyNOT version %s' % __version__
+    sky_hdr['ORDER'] = (order_bg, "Polynomial order along spatial rows")
+    sky_ext = fits.ImageHDU(as_data_type(bg2D), header=sky_hdr, name='SKY')
+    product.append(sky_ext)
+    product.save(output_fname)
+
+    if output_fname:
+        msg.append(" [OUTPUT] - Saving background subtracted image: %s" % output_fname)
     msg.append("")
     output_msg = "\n".join(msg)
-    return output_msg
+    return product, output_msg
 
 
-def correct_cosmics(input_fname, output_fname, niter=4, gain=None, readnoise=None,
-                    sigclip=4.5, sigfrac=0.3, objlim=5.0, satlevel=113500.0, cleantype='meanmask'):
+def get_cosmics_margin(niter):
+    """
+    Overlap in pixels between neighbouring tiles needed to reproduce the full-frame
+    result of `astroscrappy.detect_cosmics` after `niter` iterations.
+    """
+    # Each iteration reaches 12 pixels: Laplacian (1), noise model (7x7 median),
+    # fine structure image (5x5 and 9x9 medians), growing of the mask (two 3x3 dilations)
+    # and the 5x5 cleaning filter. The saturation mask is dilated by 4 pixels.
+    return 12*niter + 8
+
+
+def get_saturation_mask(data, kwargs):
+    """Pixels around saturated stars masked by `astroscrappy.detect_cosmics`"""
+    satmask = np.zeros(data.shape, dtype=np.uint8)
+    update_mask(np.ascontiguousarray(data, dtype=np.float32), satmask,
+                kwargs.get('satlevel', 50000.), kwargs.get('sepmed', True))
+    return satmask > 0
+
+
+def has_masked_window(masked):
+    """True if any 5x5 cleaning window of astroscrappy has no unmasked pixels"""
+    return np.any(minimum_filter(masked, size=5, mode='constant'))
+
+
+def _detect_cosmics_tile(data, kwargs):
+    crmask, cleanarr = detect_cosmics(data, **kwargs)
+    if kwargs.get('cleantype', 'meanmask') == 'median':
+        # The unmasked median filter does not use the background level
+        return crmask, cleanarr, False
+
+    no_good_pixels = has_masked_window(crmask | get_saturation_mask(data, kwargs))
+    return crmask, cleanarr, no_good_pixels
+
+
+def detect_cosmics_tiled(data, tile_size=1024, workers=1, **kwargs):
+    """
+    Run `astroscrappy.detect_cosmics` on overlapping tiles of the image `data`.
+    The tiles are processed in parallel using `workers` processes. The overlap between tiles
+    covers the filters of all iterations, such that the stitched result is identical to
+    running `detect_cosmics` on the full frame.
+
+    If a tile contains a 5x5 region where all pixels are rejected, the masked cleaning filters
+    of astroscrappy replace the pixel by the median background level of the input image. Since this value differs
+    between a tile and the full frame, the full frame is then processed in one go. Regions masked by saturation
+    are found before processing the tiles, and the remaining tiles are cancelled when one tile has such a region.
+
+    Parameters
+    ==========
+    data : np.array (M, N)
+        Input image in units of electrons
+
+    tile_size : int  [default=1024]
+        Size of the square tiles in pixels, not including the overlap
+
+    workers : int  [default=1]
+        Number of processes used to process the tiles
+
+    kwargs : dict
+        Keyword arguments passed to `astroscrappy.detect_cosmics`
+
+    Returns
+    =======
+    crmask : np.array (M, N)
+        Boolean mask of cosmic ray hits
+
+    cleanarr : np.array (M, N)
+        The cleaned image
+
+    tiled : bool
+        False if the full frame was processed in one go
+    """
+    ny, nx = data.shape
+    margin = get_cosmics_margin(kwargs.get('niter', 4))
+    tiles = list()
+    for y0 in range(0, ny, tile_size):
+        for x0 in range(0, nx, tile_size):
+            y1 = min(y0 + tile_size, ny)
+            x1 = min(x0 + tile_size, nx)
+            cut = (slice(max(y0 - margin, 0), min(y1 + margin, ny)),
+                   slice(max(x0 - margin, 0), min(x1 + margin, nx)))
+            keep = (slice(y0, y1), slice(x0, x1))
+            tiles.append((cut, keep))
+
+    masked_cleaning = kwargs.get('cleantype', 'meanmask') != 'median'
+    if len(tiles) == 1 or (masked_cleaning and has_masked_window(get_saturation_mask(data, kwargs))):
+        # Saturated regions already fill a cleaning window: the tiles would be discarded
+        crmask, cleanarr = detect_cosmics(data, **kwargs)
+        return crmask, cleanarr, False
+
+    # Stop as soon as one tile requires the full frame:
+    results = [None] * len(tiles)
+    no_good_pixels = False
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tiles))) as executor:
+            futures = {executor.submit(_detect_cosmics_tile, data[cut], kwargs): num
+                       for num, (cut, _) in enumerate(tiles)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if results[futures[future]][2]:
+                    no_good_pixels = True
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    break
+    else:
+        for num, (cut, _) in enumerate(tiles):
+            results[num] = _detect_cosmics_tile(data[cut], kwargs)
+            if results[num][2]:
+                no_good_pixels = True
+                break
+
+    if no_good_pixels:
+        crmask, cleanarr = detect_cosmics(data, **kwargs)
+        return crmask, cleanarr, False
+
+    crmask = np.zeros(data.shape, dtype=bool)
+    cleanarr = np.zeros(data.shape, dtype=np.float32)
+    for (cut, keep), (tile_mask, tile_clean, _) in zip(tiles, results):
+        inner = (slice(keep[0].start - cut[0].start, keep[0].stop - cut[0].start),
+                 slice(keep[1].start - cut[1].start, keep[1].stop - cut[1].start))
+        crmask[keep] = tile_mask[inner]
+        cleanarr[keep] = tile_clean[inner]
+    return crmask, cleanarr, True
+
+
+def correct_cosmics(img, output_fname, niter=4, gain=None, readnoise=None,
+                    sigclip=4.5, sigfrac=0.3, objlim=5.0, satlevel=113500.0, cleantype='meanmask',
+                    tile_size=0, workers=1):
     """
     Detect and Correct Cosmic Ray Hits based on the method by van Dokkum (2001)
     The corrected frame is saved to a FITS file.
 
     Parameters
     ----------
-    input_fname : string
-        Input filename of 2D image
+    img : string or :class:`pynot.product.ImageProduct`
+        Input filename of 2D image, or the image product
 
     output_fname : string
-        Filename of corrected 2D image
+        Filename of corrected 2D image. If no filename is given, the output product is not saved.
+
+    tile_size : int  [default=0]
+        Process the image in overlapping tiles of this size in pixels, see `detect_cosmics_tiled`.
+        The result is identical to processing the full frame. By default, the full frame is used.
+
+    workers : int  [default=1]
+        Number of processes used to process the tiles
 
     For details on other parameters, see `astroscrappy.detect_cosmics`
 
     Returns
     -------
+    product : :class:`pynot.product.ImageProduct`
+        The corrected 2D image. `None` if the gain or read noise is invalid.
+
     output_msg : string
         Log of messages from the function call
     """
     msg = list()
     msg.append("          - Cosmic Ray Rejection using Astroscrappy (based on van Dokkum 2001)")
-    sci = fits.getdata(input_fname)
-    hdr = fits.getheader(input_fname)
+    product = load_product(img)
+    if product.data is not None:
+        sci_hdu = product[0]
+    else:
+        sci_hdu = product[1]
+    sci = np.asarray(sci_hdu.data, dtype=np.float64)
+    hdr = product.header.copy()
     # hdr['EXTNAME'] = 'DATA'
-    msg.append("          - Loaded input image: %s" % input_fname)
-    with fits.open(input_fname) as hdu:
-        if 'SKY' in hdu:
-            sky_level = np.median(hdu['SKY'].data)
-            msg.append("          - Image has been sky subtracted. Median sky level: %.1f" % sky_level)
-        else:
-            sky_level = 0.
+    msg.append("          - Loaded input image: %s" % get_product_name(img))
+    if 'SKY' in product:
+        sky_level = np.median(np.asarray(product['SKY'].data, dtype=np.float64))
+        msg.append("          - Image has been sky subtracted. Median sky level: %.1f" % sky_level)
+    else:
+        sky_level = 0.
 
-        if 'MASK' in hdu:
-            mask = hdu['MASK'].data
-        else:
-            mask = np.zeros_like(sci, dtype=int)
+    if 'MASK' in product:
+        mask = as_mask_type(product.mask)
+    else:
+        mask = as_mask_type(np.zeros(sci.shape))
 
     if not gain:
         gain = instrument.get_gain(hdr)
@@ -394,7 +556,7 @@ def correct_cosmics(input_fname, output_fname, niter=4, gain=None, readnoise=Non
             except ValueError:
                 msg.append(" [ERROR]  - Invalid gain! Must be a number")
                 msg.append("")
-                return "\n".join(msg)
+                return None, "\n".join(msg)
 
     if not readnoise:
         readnoise = instrument.get_readnoise(hdr)
@@ -407,13 +569,21 @@ def correct_cosmics(input_fname, output_fname, niter=4, gain=None, readnoise=Non
             except ValueError:
                 msg.append(" [ERROR]  - Invalid read noise! Must be a number")
                 msg.append("")
-                return "\n".join(msg)
+                return None, "\n".join(msg)
 
     sci = (sci + sky_level) * gain
-    crr_mask, sci = detect_cosmics(sci, gain=gain, readnoise=readnoise, niter=niter,
-                                   sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
-                                   satlevel=instrument.get_saturation_level(),
-                                   cleantype=cleantype)
+    crr_options = dict(gain=gain, readnoise=readnoise, niter=niter,
+                       sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
+                       satlevel=instrument.get_saturation_level(),
+                       cleantype=cleantype)
+    if tile_size:
+        crr_mask, sci, tiled = detect_cosmics_tiled(sci, tile_size=tile_size, workers=workers, **crr_options)
+        if tiled:
+            msg.append("          - Processed image in tiles of %ix%i pixels" % (tile_size, tile_size))
+        elif max(sci.shape) > tile_size:
+            msg.append("          - Processed the full frame due to fully masked regions in the tiles")
+    else:
+        crr_mask, sci = detect_cosmics(sci, **crr_options)
     # Corrected image is in ELECTRONS! Convert back to ADUs:
     sci = sci/gain - sky_level
 
@@ -422,30 +592,27 @@ def correct_cosmics(input_fname, output_fname, niter=4, gain=None, readnoise=Non
     # expand mask to neighbouring pixels:
     msg.append("          - Number of cosmic ray hits identified: %i" % np.sum(mask > 0))
 
-    mask = mask + 1*(crr_mask > 0)
-    with fits.open(input_fname) as hdu:
-        if hdu[0].data is not None:
-            hdu[0].data = sci
-            hdu[0].header = hdr
-        else:
-            hdu[1].data = sci
-            hdu[1].header = hdr
+    mask = mask | (crr_mask > 0)
+    sci_hdu.data = as_data_type(sci)
+    sci_hdu.header = hdr
 
-        if 'MASK' in hdu:
-            hdu['MASK'].data = mask
-            hdu['MASK'].header.add_comment("Cosmic Ray Rejection using Astroscrappy (based on van Dokkum 2001)")
-        else:
-            mask_hdr = fits.Header()
-            mask_hdr.add_comment("0 = Good Pixels")
-            mask_hdr.add_comment("1 = Cosmic Ray Hits")
-            mask_hdr.add_comment("Cosmic Ray Rejection using Astroscrappy (based on van Dokkum 2001)")
-            mask_ext = fits.ImageHDU(mask, header=mask_hdr, name='MASK')
-            hdu.append(mask_ext)
-        hdu.writeto(output_fname, overwrite=True)
-    msg.append(" [OUTPUT] - Saving cosmic ray corrected image: %s" % output_fname)
+    if 'MASK' in product:
+        product['MASK'].data = mask
+        product['MASK'].header.add_comment("Cosmic Ray Rejection using Astroscrappy (based on van Dokkum 2001)")
+    else:
+        mask_hdr = fits.Header()
+        mask_hdr.add_comment("0 = Good Pixels")
+        mask_hdr.add_comment("1 = Cosmic Ray Hits")
+        mask_hdr.add_comment("Cosmic Ray Rejection using Astroscrappy (based on van Dokkum 2001)")
+        add_mask_bits(mask_hdr)
+        mask_ext = fits.ImageHDU(mask, header=mask_hdr, name='MASK')
+        product.append(mask_ext)
+    product.save(output_fname)
+    if output_fname:
+        msg.append(" [OUTPUT] - Saving cosmic ray corrected image: %s" % output_fname)
     msg.append("")
     output_msg = "\n".join(msg)
-    return output_msg
+    return product, output_msg
 
 
 def raw_correction(sci_raw, hdr, bias_fname, flat_fname='', output='', overwrite=True, mode='spec'):
@@ -468,19 +635,22 @@ def raw_correction(sci_raw, hdr, bias_fname, flat_fname='', output='', overwrite
         Filename of normalized flat field image. If none is given, no flat field correction will be applied
 
     output : string  [default='']
-        Output filename
+        Output filename. If no filename is given, the output product is not saved.
 
     overwrite : boolean  [default=True]
         Overwrite existing output file if True.
 
     Returns
     -------
+    product : :class:`pynot.product.ImageProduct`
+        The corrected image with extensions 'ERR' and 'MASK'
+
     output_msg : string
         Log of status messages
     """
     msg = list()
     if bias_fname:
-        mbias = fits.getdata(bias_fname)
+        mbias = get_calibration(bias_fname)
         # bias_hdr = instrument.get_header(bias_fname)
         msg.append("          - Loaded combined bias image: %s" % bias_fname)
     else:
@@ -488,8 +658,8 @@ def raw_correction(sci_raw, hdr, bias_fname, flat_fname='', output='', overwrite
         msg.append("          - No bias image. Using bias level = 0")
 
     if flat_fname:
-        mflat = fits.getdata(flat_fname)
-        mflat[mflat == 0] = 1
+        mflat = get_calibration(flat_fname)
+        mflat = np.where(mflat == 0, 1., mflat)
         msg.append("          - Loaded combined flat field image: %s" % flat_fname)
     else:
         mflat = 1.
@@ -529,6 +699,7 @@ def raw_correction(sci_raw, hdr, bias_fname, flat_fname='', output='', overwrite
     mask_hdr.add_comment("0 = Good Pixels")
     mask_hdr.add_comment("1 = Cosmic Ray Hits")
     mask_hdr.add_comment("4 = NaN error from base CDD processing")
+    add_mask_bits(mask_hdr)
     for key in ['CRPIX1', 'CRPIX2', 'CRVAL1', 'CRVAL2', 'CTYPE1', 'CTYPE2', 'CUNIT1', 'CUNIT2']:
         if key in hdr:
             mask_hdr[key] = hdr[key]
@@ -554,17 +725,18 @@ def raw_correction(sci_raw, hdr, bias_fname, flat_fname='', output='', overwrite
             mask_hdr['CDELT1'] = hdr['CDELT1']
             mask_hdr['CDELT2'] = hdr['CDELT2']
 
-    sci_ext = fits.PrimaryHDU(sci, header=hdr)
-    err_ext = fits.ImageHDU(err, header=hdr, name='ERR')
-    mask_ext = fits.ImageHDU(mask, header=mask_hdr, name='MASK')
-    output_HDU = fits.HDUList([sci_ext, err_ext, mask_ext])
-    output_HDU.writeto(output, overwrite=overwrite)
+    sci_ext = fits.PrimaryHDU(as_data_type(sci), header=hdr)
+    err_ext = fits.ImageHDU(as_data_type(err), header=hdr, name='ERR')
+    mask_ext = fits.ImageHDU(as_mask_type(mask), header=mask_hdr, name='MASK')
+    product = ImageProduct(fits.HDUList([sci_ext, err_ext, mask_ext]))
+    product.save(output, overwrite=overwrite)
     msg.append("          - Successfully corrected the image.")
-    msg.append(" [OUTPUT] - Saving output: %s" % output)
+    if output:
+        msg.append(" [OUTPUT] - Saving output: %s" % output)
     msg.append("")
     output_msg = "\n".join(msg)
 
-    return output_msg
+    return product, output_msg
 
 
 
@@ -578,11 +750,11 @@ def correct_raw_file(input_fname, *, output, bias_fname, flat_fname='', overwrit
         Log of status messages
     """
     hdr = instrument.get_header(input_fname)
-    sci_raw = fits.getdata(input_fname)
+    sci_raw, _ = read_image_data(input_fname)
     msg = "          - Loaded input image: %s" % input_fname
 
-    output_msg = raw_correction(sci_raw, hdr, bias_fname, flat_fname, output=output,
-                                overwrite=overwrite, mode=mode)
+    _, output_msg = raw_correction(sci_raw, hdr, bias_fname, flat_fname, output=output,
+                                   overwrite=overwrite, mode=mode)
     output_msg = msg + '\n' + output_msg
 
     return output_msg
@@ -5,7 +5,7 @@ from functools import reduce
 import warnings
 
 from pynot.functions import get_version_number
-from pynot.fitsio import load_fits_spectrum, save_fitstable_spectrum, save_fits_spectrum
+from pynot.fitsio import load_fits_spectrum, save_fitstable_spectrum, save_fits_spectrum, read_fits_image
 from pynot.txtio import load_ascii_spectrum
 
 
@@ -52,21 +52,21 @@ def combine_2d(files, output=None, method='mean', scale=False, extended=False, d
     # print("\n Spectral Combination 2D\n")
     for fnum, fname in enumerate(files):
         msg.append("          - Loading file: %s" % fname)
-        hdr = fits.getheader(fname)
-        data2D = fits.getdata(fname)
+        data2D, extensions, hdr = read_fits_image(fname)
+        data2D = data2D.astype(np.float64)
 
-        try:
-            err2D = fits.getdata(fname, 'ERR')
+        if 'ERR' in extensions:
+            err2D = extensions['ERR'].astype(np.float64)
             err2D[err2D <= 0.] = np.nanmedian(err2D)*100
             msg.append("          - Loaded error image")
-        except KeyError:
+        else:
             msg.append("[WARNING] - No ERR extension could be found in the FITS file!")
             err2D = np.ones_like(data2D)
 
-        try:
-            mask2D = fits.getdata(fname, 'MASK')
+        if 'MASK' in extensions:
+            mask2D = extensions['MASK']
             msg.append("          - Loaded mask image")
-        except KeyError:
+        else:
             msg.append("[WARNING] - No MASK extension could be found in the FITS file!")
             mask2D = np.zeros_like(data2D)
 
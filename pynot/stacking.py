@@ -0,0 +1,232 @@
+# -*- coding: UTF-8 -*-
+"""
+Out-of-core stacking of images.
+
+The individual frames are written one at a time to a memory-mapped scratch cube on disk.
+The combination is then performed on tiles of full rows, so that the memory usage is set
+by the memory budget `memory_limit` (in MB) and not by the number of frames.
+"""
+__author__ = 'Jens-Kristian Krogager'
+__email__ = "krogager@iap.fr"
+__credits__ = ["Jens-Kristian Krogager"]
+
+import numpy as np
+import os
+import tempfile
+import warnings
+
+
+# Default memory budget in MB:
+default_memory_limit = 1024
+
+
+class ScratchCube(object):
+    """
+    Disk-backed image cube of shape (N, M, K) holding N images of shape (M, K).
+
+    The cube is allocated when the first image is added and the temporary file
+    is removed when calling `close()` or when leaving the `with` statement.
+    """
+    def __init__(self, N, scratch_dir=None, dtype=np.float64):
+        self.N = N
+        self.scratch_dir = scratch_dir
+        self.dtype = dtype
+        self.data = None
+        self.fname = ''
+        self.count = 0
+
+    def append(self, img):
+        if self.data is None:
+            fd, self.fname = tempfile.mkstemp(prefix='pynot_stack_', suffix='.dat', dir=self.scratch_dir)
+            os.close(fd)
+            self.data = np.memmap(self.fname, dtype=self.dtype, mode='w+', shape=(self.N,)+img.shape)
+
+        if img.shape != self.shape:
+            raise ValueError("Images must have same shape! %r != %r" % (img.shape, self.shape))
+
+        if self.count >= self.N:
+            raise IndexError("The cube is full! Cannot add more than %i images" % self.N)
+
+        self.data[self.count] = img
+        self.count += 1
+
+    @property
+    def shape(self):
+        if self.data is None:
+            return None
+        return self.data.shape[1:]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.data[:self.count][index]
+
+    def __iter__(self):
+        for num in range(self.count):
+            yield self.data[num]
+
+    def close(self):
+        self.data = None
+        if self.fname and os.path.exists(self.fname):
+            os.remove(self.fname)
+        self.fname = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_tile_rows(N, ncols, memory_limit=default_memory_limit, itemsize=8):
+    """
+    Number of image rows per tile for a stack of `N` images with `ncols` columns,
+    such that the tile and its temporary copies fit within `memory_limit` (in MB).
+    """
+    # Each tile is held in memory as the data, the residuals and the rejection mask:
+    bytes_per_row = 3 * N * ncols * itemsize
+    nrows = int(memory_limit * 1024**2 // bytes_per_row)
+    return max(nrows, 1)
+
+
+def iter_tiles(nrows, tile_rows):
+    """Yield slices of `tile_rows` rows covering `nrows` rows"""
+    for row in range(0, nrows, tile_rows):
+        yield slice(row, min(row + tile_rows, nrows))
+
+
+def tiled_median(cube, memory_limit=default_memory_limit):
+    """Median of the `cube` along the first axis computed in tiles of rows"""
+    nrows, ncols = cube.shape
+    N = len(cube)
+    tile_rows = get_tile_rows(N, ncols, memory_limit)
+    median_img = np.zeros(cube.shape)
+    for tile in iter_tiles(nrows, tile_rows):
+        median_img[tile] = np.median(cube[:, tile], 0)
+    return median_img
+
+
+def clipped_combine(cube, reference, threshold, method='mean', memory_limit=default_memory_limit):
+    """
+    Combine the images in `cube` after rejecting pixels deviating from the `reference`
+    image by more than `threshold`. Rejected pixels are set to NaN and the combination
+    is performed tile by tile using `nanmean` or `nanmedian`.
+
+    Parameters
+    ==========
+    cube : ScratchCube
+        The cube of images to combine
+
+    reference : np.array (M, K)
+        Reference image used for the pixel rejection, e.g., the median image
+
+    threshold : float or np.array (M, K)
+        Maximal absolute deviation from the `reference` image
+
+    method : string  [default='mean']
+        Combination method: 'mean' or 'median'
+
+    memory_limit : float  [default=1024]
+        Memory budget of the tiles in MB
+
+    Returns
+    =======
+    combined : np.array (M, K)
+        The combined image. Pixels where all images are rejected are NaN.
+
+    N_rejected : np.array (M, K)
+        Number of rejected pixels along the stack for each pixel
+    """
+    if method.lower() == 'median':
+        combine_func = np.nanmedian
+    else:
+        combine_func = np.nanmean
+
+    nrows, ncols = cube.shape
+    N = len(cube)
+    tile_rows = get_tile_rows(N, ncols, memory_limit)
+    combined = np.zeros(cube.shape)
+    N_rejected = np.zeros(cube.shape, dtype=int)
+    for tile in iter_tiles(nrows, tile_rows):
+        data = np.array(cube[:, tile], dtype=np.float64)
+        rejected = np.abs(data - reference[tile]) > threshold
+        N_rejected[tile] = np.sum(rejected, 0)
+        data[rejected] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            combined[tile] = combine_func(data, 0)
+    return combined, N_rejected
+
+
+def combine_stack(images, variances, method='weighted', kappa=3., memory_limit=default_memory_limit):
+    """
+    Combine registered images and their variance maps tile by tile.
+
+    Parameters
+    ==========
+    images : ScratchCube
+        The cube of registered images
+
+    variances : ScratchCube
+        The cube of variance maps of the images
+
+    method : string  [default='weighted']
+        Combination method:
+            'weighted': inverse-variance weighted mean
+            'mean': mean (ignoring NaNs)
+            'median': median (ignoring NaNs)
+            'clipped': inverse-variance weighted mean after rejecting pixels deviating from
+                       the median by more than `kappa` times their uncertainty
+
+    kappa : float  [default=3.]
+        Rejection threshold in units of the pixel uncertainty for method 'clipped'
+
+    memory_limit : float  [default=1024]
+        Memory budget of the tiles in MB
+
+    Returns
+    =======
+    combined : np.array (M, K)
+        The combined image
+
+    error : np.array (M, K)
+        The uncertainty of the combined image. For mean and median combinations,
+        the square root of the mean variance.
+
+    N_rejected : np.array (M, K)
+        Number of rejected pixels along the stack for each pixel (only for method 'clipped')
+    """
+    method = method.lower()
+    if method not in ['weighted', 'mean', 'median', 'clipped']:
+        raise ValueError("Invalid combination method: %r" % method)
+
+    nrows, ncols = images.shape
+    N = len(images)
+    # The tiles of images and variances are held in memory at the same time:
+    tile_rows = get_tile_rows(2*N, ncols, memory_limit)
+    combined = np.zeros(images.shape)
+    error = np.zeros(images.shape)
+    N_rejected = np.zeros(images.shape, dtype=int)
+    for tile in iter_tiles(nrows, tile_rows):
+        data = np.array(images[:, tile], dtype=np.float64)
+        var = np.array(variances[:, tile], dtype=np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            if method == 'median':
+                combined[tile] = np.nanmedian(data, axis=0)
+                error[tile] = np.sqrt(np.nanmean(var, axis=0))
+            elif method == 'mean':
+                combined[tile] = np.nanmean(data, axis=0)
+                error[tile] = np.sqrt(np.nanmean(var, axis=0))
+            else:
+                w = 1./var
+                if method == 'clipped':
+                    median = np.nanmedian(data, axis=0)
+                    rejected = np.abs(data - median) > kappa*np.sqrt(var)
+                    N_rejected[tile] = np.sum(rejected, 0)
+                    w[rejected] = 0.
+                    data[rejected] = 0.
+                combined[tile] = np.nansum(w*data, axis=0) / np.sum(w, axis=0)
+                error[tile] = np.sqrt(1. / np.nansum(w, axis=0))
+    return combined, error, N_rejected
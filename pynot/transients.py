@@ -8,9 +8,12 @@ import matplotlib.pyplot as plt
 import os
 import warnings
 
-from pynot.wcs import get_gaia_catalog
+from pynot.crossmatch import find_unmatched
+from pynot.wcs import get_gaia_catalog, get_gaia_store_name
 from pynot.functions import decimal_to_string
+from pynot.fitsio import read_fits_image
 from pynot import instrument
+from pynot import refcat
 
 
 def mad(x):
@@ -18,17 +21,9 @@ def mad(x):
 
 
 def find_sources_without_gaia(sep_cat, gaia, limit=1.5):
-    no_match_list = list()
-    refs = np.array([gaia['ra'], gaia['dec']]).T
-    for row in sep_cat:
-        xy = np.array([row['ra'], row['dec']])
-        dist = np.sqrt(np.sum((refs - xy)**2, axis=1))
-        if np.min(dist) < limit/3600.:
-            pass
-        else:
-            no_match_list.append(np.array(row))
-    no_match_list = np.array(no_match_list)
-    return Table(no_match_list)
+    """Return the sources in `sep_cat` without a Gaia source within `limit` arcsec"""
+    no_match = find_unmatched(sep_cat['ra'], sep_cat['dec'], gaia['ra'], gaia['dec'], limit)
+    return Table(sep_cat[no_match])
 
 
 def find_new_sources(img_fname, sep_fname, loc_bat=(0., 0., 1.), loc_xrt=(0., 0., 1), mag_lim=20.1, zp=None):
@@ -65,8 +60,7 @@ def find_new_sources(img_fname, sep_fname, loc_bat=(0., 0., 1.), loc_xrt=(0., 0.
         Log of messages from the function call.
     """
     msg = list()
-    img = fits.getdata(img_fname)
-    hdr = fits.getheader(img_fname)
+    img, _, hdr = read_fits_image(img_fname)
 
     # Download Gaia positions:
     base, ext = os.path.splitext(os.path.basename(img_fname))
@@ -78,7 +72,10 @@ def find_new_sources(img_fname, sep_fname, loc_bat=(0., 0., 1.), loc_xrt=(0., 0.
     gaia_cat_name = 'gaia_source_%.2f%+.2f_%.1f.csv' % (hdr['CRVAL1'], hdr['CRVAL2'], radius)
     gaia_cat_name = os.path.join(dirname, gaia_cat_name)
     gaia_dr = 'edr3'
-    if os.path.exists(gaia_cat_name):
+    if refcat.store.is_covered(get_gaia_store_name(gaia_dr), hdr['CRVAL1'], hdr['CRVAL2'], radius):
+        msg.append("          - Loading Gaia source catalog from local store: %s" % refcat.store.root)
+        ref_cat = get_gaia_catalog(hdr['CRVAL1'], hdr['CRVAL2'], radius=radius, database=gaia_dr)
+    elif os.path.exists(gaia_cat_name):
         msg.append("          - Loading Gaia source catalog: %s" % gaia_cat_name)
         ref_cat = Table.read(gaia_cat_name)
     else:
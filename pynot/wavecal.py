@@ -5,10 +5,12 @@ Wavelength Calibration and 2D Transformation
 __author__ = "Jens-Kristian Krogager"
 
 import os
+import hashlib
 from astropy.io import fits
 import numpy as np
 from numpy.polynomial import Chebyshev
 import matplotlib.pyplot as plt
+from scipy import sparse
 from scipy.ndimage import median_filter
 from scipy.optimize import curve_fit
 from scipy.signal import find_peaks
@@ -17,7 +19,10 @@ import warnings
 import spectres
 
 from pynot import instrument
-from pynot.functions import get_version_number, NN_mod_gaussian, get_pixtab_parameters, mad
+from pynot.fitsio import read_image_data
+from pynot.functions import get_version_number, NN_mod_gaussian, NN_mod_gaussian_jac, get_pixtab_parameters, mad
+from pynot.product import ImageProduct, load_product, get_product_name
+from pynot.product import as_data_type, as_mask_type, add_mask_bits
 
 __version__ = get_version_number()
 
@@ -35,7 +40,7 @@ def verify_arc_frame(arc_fname, dispaxis=2):
 
     `dispaxis` = 2 for vertical spectra, 1 for horizontal spectra.
     """
-    arc2D = fits.getdata(arc_fname)
+    arc2D, _ = read_image_data(arc_fname)
     hdr = instrument.get_header(arc_fname)
     if 'DISPAXIS' in hdr:
         dispaxis = hdr['DISPAXIS']
@@ -95,6 +100,128 @@ def fit_lines(x, arc1D, ref_table, dx=20):
     return pixels
 
 
+def fit_lines_batch(x, arc2D, ref_table, dx=20, max_iter=200, tol=1.49012e-8):
+    """
+    Fit the centroids of all reference lines in all rows of `arc2D` at once.
+    The cutouts of every (row, line) pair are fitted together by a batched
+    Levenberg--Marquardt minimization of the `NN_mod_gaussian` profile using
+    the analytic Jacobian. The initial guess is the same as in `fit_gaussian_center`.
+
+    Parameters
+    ==========
+    x : np.array (N)
+        Pixel array along the dispersion axis
+
+    arc2D : np.array (M, N)
+        Background subtracted arc frame with dispersion along the x-axis
+
+    ref_table : np.array (L, 2)
+        Reference table of pixel positions and wavelengths of the arc lines
+
+    dx : float  [default=20]
+        Fitting window in pixels around each arc line
+
+    max_iter : integer  [default=200]
+        Maximum number of iterations. Fits that have not converged are NaN.
+
+    tol : float  [default=1.49012e-8]
+        Relative tolerance in the sum of squared residuals and in the parameters
+
+    Returns
+    =======
+    pixtab2d : np.array (M, L)
+        Fitted line centroids of each row. Failed fits are NaN.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    N_rows = arc2D.shape[0]
+    N_lines = len(ref_table)
+
+    # Indices of the fitting window of each line padded to the same length:
+    cutouts = [np.nonzero((x > pix - dx) & (x < pix + dx))[0] for pix in ref_table[:, 0]]
+    N_pix = max([len(cutout) for cutout in cutouts] + [1])
+    index = np.zeros((N_lines, N_pix), dtype=int)
+    valid = np.zeros((N_lines, N_pix), dtype=bool)
+    for num, cutout in enumerate(cutouts):
+        index[num, :len(cutout)] = cutout
+        valid[num, :len(cutout)] = True
+
+    # Arrays of all cutouts, shape: (N_rows * N_lines, N_pix)
+    x_cut = np.broadcast_to(x[index], (N_rows, N_lines, N_pix)).reshape(-1, N_pix)
+    y_cut = np.asarray(arc2D, dtype=np.float64)[:, index].reshape(-1, N_pix)
+    weight = np.broadcast_to(valid, (N_rows, N_lines, N_pix)).reshape(-1, N_pix).astype(np.float64)
+
+    # Initial guess:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        y_valid = np.where(weight > 0, y_cut, np.nan)
+        bg = np.nanmedian(y_valid, 1)
+        logamp = np.log10(np.nanmax(y_valid, 1) - bg)
+        max_index = np.argmax(np.where(weight > 0, y_cut, -np.inf), 1)
+    mu = x_cut[np.arange(len(x_cut)), max_index]
+    pars = np.column_stack([bg, mu, np.full_like(bg, 1.5), logamp])
+
+    def residuals(p, rows):
+        return weight[rows] * (y_cut[rows] - NN_mod_gaussian(x_cut[rows], *p.T[:, :, np.newaxis]))
+
+    def solve(A, b):
+        try:
+            return np.linalg.solve(A, b[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            x = np.full_like(b, np.nan)
+            for num in range(len(A)):
+                try:
+                    x[num] = np.linalg.solve(A[num], b[num])
+                except np.linalg.LinAlgError:
+                    pass
+            return x
+
+    N_pars = pars.shape[1]
+    active = np.all(np.isfinite(pars), 1) & (np.sum(weight, 1) >= N_pars)
+    converged = np.zeros(len(pars), dtype=bool)
+    lam = np.full(len(pars), 1.e-3)
+    cost = np.full(len(pars), np.inf)
+    resid = np.zeros_like(y_cut)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        resid[active] = residuals(pars[active], active)
+        cost[active] = np.sum(resid[active]**2, 1)
+        active &= np.isfinite(cost)
+        for _ in range(max_iter):
+            rows = np.nonzero(active)[0]
+            if len(rows) == 0:
+                break
+            p = pars[rows]
+            jac = NN_mod_gaussian_jac(x_cut[rows], *p.T[:, :, np.newaxis]) * weight[rows][:, :, np.newaxis]
+            JTJ = np.einsum('nki,nkj->nij', jac, jac)
+            grad = np.einsum('nki,nk->ni', jac, resid[rows])
+            diag = np.einsum('nii->ni', JTJ)
+            diag = np.maximum(diag, 1.e-12*diag.max(1, keepdims=True))
+            # Marquardt damping of the normal equations:
+            damped = JTJ + lam[rows, np.newaxis, np.newaxis] * (diag[:, :, np.newaxis] * np.eye(N_pars))
+            finite = np.all(np.isfinite(damped), (1, 2)) & np.all(np.isfinite(grad), 1)
+            step = np.full_like(p, np.nan)
+            step[finite] = solve(damped[finite], grad[finite])
+            finite &= np.all(np.isfinite(step), 1)
+            p_new = p + step
+            resid_new = residuals(p_new, rows)
+            cost_new = np.sum(resid_new**2, 1)
+
+            improved = finite & np.isfinite(cost_new) & (cost_new < cost[rows])
+            small_step = (np.linalg.norm(np.sqrt(diag)*step, axis=1)
+                          <= tol*np.linalg.norm(np.sqrt(diag)*p, axis=1))
+            small_gain = improved & (cost[rows] - cost_new <= tol*cost[rows])
+            pars[rows[improved]] = p_new[improved]
+            resid[rows[improved]] = resid_new[improved]
+            cost[rows[improved]] = cost_new[improved]
+            lam[rows] = np.where(improved, lam[rows]/10, lam[rows]*10)
+
+            done = finite & (small_step | small_gain | (cost[rows] == 0))
+            converged[rows[done]] = True
+            active[rows[done | ~finite]] = False
+
+    pixtab2d = np.where(converged, pars[:, 1], np.nan)
+    return pixtab2d.reshape(N_rows, N_lines)
+
+
 def median_filter_data(x, kappa=5., window=51):
     """
     Calculate rejection mask using median filtering
@@ -157,11 +284,20 @@ def detect_borders(arc2D, kappa=20.):
     return (row_min, row_max)
 
 
-def create_2d_pixtab(arc2D_sub, pix, ref_table, dx=20):
-    """Fit reference lines to each row to obtain 2D pixel table"""
+def create_2d_pixtab(arc2D_sub, pix, ref_table, dx=20, method='batch'):
+    """
+    Fit reference lines to each row to obtain 2D pixel table
+
+    The lines are fitted either all at once (method='batch'), see `fit_lines_batch`,
+    or one line and row at a time using `curve_fit` (method='single').
+    """
 
     # Image should already be oriented correctly, i.e., dispersion along x-axis
     # and have background subtracted for optimal results
+    if method == 'batch':
+        return fit_lines_batch(pix, arc2D_sub, ref_table, dx=dx)
+    elif method != 'single':
+        raise ValueError("Invalid method: %r. Must be 'batch' or 'single'" % method)
 
     pixtab2d = list()
     for row in arc2D_sub:
@@ -200,8 +336,110 @@ def fit_2dwave_solution(pixtab2d, deg=5):
     return fit_table2d.T
 
 
+class ResamplingOperator(object):
+    """
+    Sparse linear operator resampling a 2D spectrum with shape (M, N) onto a common
+    wavelength grid with shape (M, N_out). Each row of the output is the linear interpolation
+    of the corresponding input row onto the output grid, as done by `np.interp`.
+    Output pixels outside the wavelength range of a row receive no input pixels.
+
+    Parameters
+    ==========
+    matrix : scipy.sparse.csr_matrix, shape(M*N_out, M*N)
+        Interpolation weights from input pixels to output pixels
+
+    wl : array, shape(N_out)
+        The output wavelength grid
+
+    edge_index : array, shape(M*N_out)
+        Index of the nearest input pixel for output pixels outside the range of a row, otherwise -1.
+    """
+    def __init__(self, matrix, wl, edge_index):
+        self.matrix = matrix.tocsr()
+        self.wl = wl
+        self.edge_index = edge_index
+        self.outside = edge_index >= 0
+        self._matrix2 = None
+
+    @classmethod
+    def from_wavelengths(cls, wl2D, wl):
+        """
+        Create the operator from the wavelength solution of each input row, `wl2D`,
+        and the output wavelength grid `wl`. The rows of `wl2D` must be monotonic.
+        """
+        N_rows, N_pix = wl2D.shape
+        N_out = len(wl)
+        out_index = list()
+        in_index = list()
+        weights = list()
+        edge_index = np.full((N_rows, N_out), -1, dtype=np.int64)
+        for i, wl_row in enumerate(wl2D):
+            pix = np.arange(N_pix) + i*N_pix
+            if wl_row[0] > wl_row[-1]:
+                wl_row = wl_row[::-1]
+                pix = pix[::-1]
+            below = wl < wl_row[0]
+            above = wl > wl_row[-1]
+            edge_index[i, below] = pix[0]
+            edge_index[i, above] = pix[-1]
+            inside = np.nonzero(~below & ~above)[0]
+            lower = np.clip(np.searchsorted(wl_row, wl[inside], side='right') - 1, 0, N_pix-2)
+            frac = (wl[inside] - wl_row[lower]) / (wl_row[lower+1] - wl_row[lower])
+            out_index += [inside + i*N_out, inside + i*N_out]
+            in_index += [pix[lower], pix[lower+1]]
+            weights += [1. - frac, frac]
+        matrix = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(out_index), np.concatenate(in_index))),
+                                   shape=(N_rows*N_out, N_rows*N_pix))
+        return cls(matrix, wl, edge_index.ravel())
+
+    @property
+    def shape_out(self):
+        return (self.matrix.shape[0] // len(self.wl), len(self.wl))
+
+    def resample(self, img2D, fill=0.):
+        """Interpolate the image onto the output grid. Pixels outside the range of a row are set to `fill`"""
+        img2D_tr = self.matrix @ np.ravel(img2D).astype(np.float64)
+        img2D_tr[self.outside] = fill
+        return img2D_tr.reshape(self.shape_out)
+
+    def resample_error(self, err2D, fill=-1.):
+        """Propagate the uncertainties by the squared interpolation weights"""
+        if self._matrix2 is None:
+            self._matrix2 = self.matrix.power(2)
+        var2D_tr = self._matrix2 @ np.ravel(err2D).astype(np.float64)**2
+        err2D_tr = np.sqrt(var2D_tr)
+        err2D_tr[self.outside] = fill
+        return err2D_tr.reshape(self.shape_out)
+
+    def resample_mask(self, mask2D):
+        """
+        Interpolate the bitmask one bit at a time: an output pixel has a bit set if any of the input pixels
+        contributing to it has the bit set. Pixels outside the range of a row take the value of the nearest edge
+        """
+        mask2D = np.ravel(mask2D).astype(np.int64)
+        mask2D_tr = np.zeros(self.matrix.shape[0], dtype=np.int64)
+        all_bits = np.bitwise_or.reduce(mask2D)
+        bit = 1
+        while bit <= all_bits:
+            if all_bits & bit:
+                bit_tr = self.matrix @ (mask2D & bit > 0).astype(np.float64)
+                mask2D_tr[bit_tr > 0] |= bit
+            bit <<= 1
+        mask2D_tr[self.outside] = mask2D[self.edge_index[self.outside]]
+        return mask2D_tr.reshape(self.shape_out)
+
+
+def get_wavelength_grid(wl_central, N_out, log=False):
+    """Linear or logarithmic wavelength grid of `N_out` pixels covering the range of `wl_central`"""
+    if log:
+        return np.logspace(np.log10(wl_central.min()), np.log10(wl_central.max()), N_out)
+    else:
+        return np.linspace(wl_central.min(), wl_central.max(), N_out)
+
+
 def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None, header={},
-                    order_wl=4, ref_type='vacuum', log=False, N_out=None, interpolate=True):
+                    order_wl=4, ref_type='vacuum', log=False, N_out=None, interpolate=True, wl2D=None,
+                    operator=None):
     """
     Apply 2D wavelength transformation to the input image
 
@@ -240,6 +478,14 @@ def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None,
     interpolate : bool  [default=True]
         Interpolate the image onto new grid or use sub-pixel shifting
 
+    wl2D : array, shape(M, N)  [default=None]
+        Wavelength solution of each row evaluated at `pix`, see `get_wavelength_rows`.
+        If not given, the solution of each row is fitted from `fit_table2d`.
+
+    operator : ResamplingOperator  [default=None]
+        Precomputed resampling operator, e.g., from a cached arc solution.
+        If not given or if the wavelength grid differs, the operator is created from `wl2D`.
+
     Returns
     -------
     img2D_tr : array, shape(M, N_out)
@@ -268,19 +514,15 @@ def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None,
     ref_wl = ref_table[:, 1]
     central_solution = Chebyshev.fit(fit_table2d[cen], ref_wl, deg=order_wl, domain=[pix_in.min(), pix_in.max()])
     wl_central = central_solution(pix_in)
-    if all(np.diff(wl_central) < 0):
-        # Wavelengths are decreasing: Flip arrays
-        flip_array = True
-    elif all(np.diff(wl_central) > 0):
-        # Wavelength are increasing: Nothing to do
-        flip_array = False
-    elif all(np.diff(wl_central) == 0):
+    # Decreasing wavelengths are reversed by `ResamplingOperator.from_wavelengths`,
+    # only check that the wavelengths are monotonic:
+    if all(np.diff(wl_central) == 0):
         # Wavelengths do not increase: WHAT?!
         msg.append(" [ERROR]  - Wavelength array does not increase! Something went wrong.")
         msg.append("          - Check the parameters `fit_window` and `order_wl`.")
         exit_msg = "\n".join(msg)
         raise WavelengthError(exit_msg)
-    else:
+    elif not (all(np.diff(wl_central) < 0) or all(np.diff(wl_central) > 0)):
         msg.append(" [ERROR]  - Wavelength array is not monotonic.")
         msg.append("          - Check the parameters `fit_window` and `order_wl`.")
         exit_msg = "\n".join(msg)
@@ -298,8 +540,8 @@ def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None,
     else:
         ctype = 'WAVE'
 
+    wl = get_wavelength_grid(wl_central, N_out, log=log)
     if log:
-        wl = np.logspace(np.log10(wl_central.min()), np.log10(wl_central.max()), N_out)
         hdr_tr = header.copy()
         hdr_tr['CRPIX1'] = 1
         hdr_tr['CDELT1'] = np.diff(np.log10(wl))[0]
@@ -309,7 +551,6 @@ def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None,
         msg.append("          - Creating logarithmically sampled wavelength grid")
         msg.append("          - Sampling: %.3f  (logÅ/pix)" % np.diff(np.log10(wl))[0])
     else:
-        wl = np.linspace(wl_central.min(), wl_central.max(), N_out)
         hdr_tr = header.copy()
         hdr_tr['CRPIX1'] = 1
         hdr_tr['CDELT1'] = np.diff(wl)[0]
@@ -327,42 +568,22 @@ def apply_transform(img2D, pix, fit_table2d, ref_table, err2D=None, mask2D=None,
         msg.append("          - Maximum curvature less than 1/10 pixel. No need to interpolate the data")
 
     if interpolate:
-        img2D_tr = np.zeros((img2D.shape[0], N_out))
-        err2D_tr = np.zeros((img2D.shape[0], N_out))
-        mask2D_tr = np.zeros((img2D.shape[0], N_out))
         if err2D is None:
             msg.append("[WARNING] - Interpolating data without errors!")
         else:
             msg.append("          - Interpolating data with errors")
 
-        for i, row in enumerate(img2D):
-            # - fit the chebyshev polynomium
-            solution_row = Chebyshev.fit(fit_table2d[i], ref_wl, deg=order_wl, domain=[pix_in.min(), pix_in.max()])
-            wl_row = solution_row(pix_in)
-            if flip_array:
-                # Wavelengths are decreasing: Flip arrays
-                row = row[::-1]
-                wl_row = wl_row[::-1]
-
-            # -- interpolate the data onto the fixed wavelength grid
-            if err2D is not None:
-                err_row = err2D[i]
-                if flip_array:
-                    err_row = err_row[::-1]
-
-                # interp_row, interp_err = spectres.spectres(wl, wl_row, row, spec_errs=err_row, verbose=False, fill=0.)
-                interp_row = np.interp(wl, wl_row, row, left=0., right=0.)
-                interp_err = np.interp(wl, wl_row, err_row, left=-1, right=-1)
-                err2D_tr[i] = interp_err
-                img2D_tr[i] = interp_row
-            else:
-                # interp_row = spectres.spectres(wl, wl_row, row, verbose=False, fill=0.)
-                interp_row = np.interp(wl, wl_row, row, left=0., right=0.)
-                img2D_tr[i] = interp_row
+        if operator is None or not np.array_equal(operator.wl, wl) or operator.shape_out[0] != img2D.shape[0]:
+            if wl2D is None:
+                wl2D = get_wavelength_rows(fit_table2d, ref_wl, pix_in, order_wl=order_wl)
+            operator = ResamplingOperator.from_wavelengths(wl2D, wl)
 
-            mask_row = mask2D[i]
-            mask_int = np.interp(wl, wl_row, mask_row)
-            mask2D_tr[i] = np.ceil(mask_int).astype(int)
+        img2D_tr = operator.resample(img2D, fill=0.)
+        if err2D is not None:
+            err2D_tr = operator.resample_error(err2D, fill=-1.)
+        else:
+            err2D_tr = np.zeros_like(img2D_tr)
+        mask2D_tr = operator.resample_mask(mask2D)
 
     else:
         msg.append("          - No interpolation used!")
@@ -546,6 +767,122 @@ def format_table2D_residuals(pixtab2d, fit_table2d, ref_table):
         resid_log.append([wl, median_pix, line_resid, delta_col])
     return resid_log
 
+# ============== ARC SOLUTION CACHE =============================================
+
+class ArcSolution(object):
+    """
+    The 2D arc line solution of an arc frame: the arc line borders, the fitted 2D pixel table,
+    the wavelength solution of each row and the fit residuals.
+
+    The `operator` holds the sparse resampling onto the output wavelength grid, see `ResamplingOperator`.
+
+    The solution is saved as a sidecar file next to the arc frame and identified by a key,
+    see `get_arc_solution_key`. A sidecar with a different key is considered out of date.
+    """
+    def __init__(self, key, ilow, ihigh, arc2D_sub, pixtab2d, fit_table2d, wl2D, residuals, operator=None):
+        self.key = key
+        self.ilow = ilow
+        self.ihigh = ihigh
+        self.arc2D_sub = arc2D_sub
+        self.pixtab2d = pixtab2d
+        self.fit_table2d = fit_table2d
+        self.wl2D = wl2D
+        self.residuals = residuals
+        self.operator = operator
+
+    @classmethod
+    def load(cls, fname, key):
+        """Load the solution from the sidecar file `fname`. Returns None if the key does not match."""
+        if not os.path.exists(fname):
+            return None
+        try:
+            with fits.open(fname) as hdu:
+                if hdu[0].header.get('ARCKEY') != key:
+                    return None
+                ilow = hdu[0].header['ILOW']
+                ihigh = hdu[0].header['IHIGH']
+                arc2D_sub = hdu['ARC_SUB'].data.astype(np.float64)
+                pixtab2d = hdu['PIXTAB2D'].data.astype(np.float64)
+                fit_table2d = hdu['FITTAB2D'].data.astype(np.float64)
+                wl2D = hdu['WL2D'].data.astype(np.float64)
+                tab = hdu['RESIDUALS'].data
+                residuals = [list(row) for row in zip(tab['WAVE'], tab['POS'], tab['RESID'], tab['CURV'])]
+                if 'OP_WL' in hdu:
+                    wl = hdu['OP_WL'].data.astype(np.float64)
+                    shape = (wl2D.shape[0]*len(wl), wl2D.size)
+                    matrix = sparse.csr_matrix((hdu['OP_DATA'].data.astype(np.float64),
+                                                hdu['OP_INDICES'].data.astype(np.int64),
+                                                hdu['OP_INDPTR'].data.astype(np.int64)), shape=shape)
+                    operator = ResamplingOperator(matrix, wl, hdu['OP_EDGE'].data.astype(np.int64))
+                else:
+                    operator = None
+        except (OSError, KeyError, TypeError, ValueError):
+            return None
+        return cls(key, ilow, ihigh, arc2D_sub, pixtab2d, fit_table2d, wl2D, residuals, operator)
+
+    def save(self, fname, arc_fname=''):
+        """Save the solution to the sidecar file `fname`. The file is replaced atomically."""
+        hdr = fits.Header()
+        hdr['ARCKEY'] = self.key
+        hdr['ILOW'] = self.ilow
+        hdr['IHIGH'] = self.ihigh
+        hdr['ARCFILE'] = os.path.basename(arc_fname)
+        hdr['AUTHOR'] = 'PyNOT version %s' % __version__
+        hdr.add_comment("Cached 2D arc line solution")
+        residuals = np.array(self.residuals, dtype=np.float64).reshape(-1, 4)
+        columns = [fits.Column(name=name, format='D', array=residuals[:, num])
+                   for num, name in enumerate(['WAVE', 'POS', 'RESID', 'CURV'])]
+        hdu = fits.HDUList([fits.PrimaryHDU(header=hdr),
+                            fits.ImageHDU(self.arc2D_sub.astype(np.float32), name='ARC_SUB'),
+                            fits.ImageHDU(self.pixtab2d, name='PIXTAB2D'),
+                            fits.ImageHDU(self.fit_table2d, name='FITTAB2D'),
+                            fits.ImageHDU(self.wl2D, name='WL2D'),
+                            fits.BinTableHDU.from_columns(columns, name='RESIDUALS')])
+        if self.operator is not None:
+            hdu.append(fits.ImageHDU(self.operator.wl, name='OP_WL'))
+            hdu.append(fits.ImageHDU(self.operator.matrix.data, name='OP_DATA'))
+            hdu.append(fits.ImageHDU(self.operator.matrix.indices, name='OP_INDICES'))
+            hdu.append(fits.ImageHDU(self.operator.matrix.indptr, name='OP_INDPTR'))
+            hdu.append(fits.ImageHDU(self.operator.edge_index, name='OP_EDGE'))
+        tmp_fname = '%s.%i.tmp' % (fname, os.getpid())
+        try:
+            hdu.writeto(tmp_fname, overwrite=True)
+            os.replace(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+
+def get_arc_solution_fname(arc_fname):
+    """Filename of the cached arc solution next to the arc frame"""
+    base, ext = os.path.splitext(arc_fname)
+    return base + '.arcsol.fits'
+
+
+def get_arc_solution_key(arc_fname, pixtable_fname, pix, **options):
+    """
+    Hash of the content of the arc frame and the pixel table, the pixel array
+    and the options that determine the arc solution.
+    """
+    key = hashlib.sha1()
+    for fname in [arc_fname, pixtable_fname]:
+        with open(fname, 'rb') as data:
+            for chunk in iter(lambda: data.read(2**20), b''):
+                key.update(chunk)
+    key.update(np.asarray(pix, dtype=np.float64).tobytes())
+    key.update(repr(sorted(options.items())).encode())
+    return key.hexdigest()
+
+
+def get_wavelength_rows(fit_table2d, ref_wl, pix, order_wl=4):
+    """Evaluate the wavelength solution of each row of the fitted 2D pixel table on the pixel array `pix`"""
+    wl2D = np.zeros((fit_table2d.shape[0], len(pix)))
+    for i, line_pos in enumerate(fit_table2d):
+        solution_row = Chebyshev.fit(line_pos, ref_wl, deg=order_wl, domain=[pix.min(), pix.max()])
+        wl2D[i] = solution_row(pix)
+    return wl2D
+
+
 # ============== MAIN ===========================================================
 
 def swap_axes_in_header(hdr):
@@ -590,24 +927,41 @@ def swap_axes_in_header(hdr):
 
     return hdr
 
-def rectify(img_fname, arc_fname, pixtable_fname, output='', fig_dir='', order_bg=5, order_2d=5,
+def rectify(img, arc_fname, pixtable_fname, output='', fig_dir='', order_bg=5, order_2d=5,
             order_wl=4, log=False, N_out=None, interpolate=True, dispaxis=2, fit_window=20,
-            plot=True, overwrite=True, verbose=False, overscan=50, edge_kappa=10.):
+            plot=True, overwrite=True, verbose=False, overscan=50, edge_kappa=10., fit_method='batch',
+            cache=True):
+    """
+    Rectify the 2D image `img` (filename or :class:`pynot.product.ImageProduct`) onto
+    a linear wavelength grid using the arc line solution of `arc_fname`.
+    If no `output` is given, the rectified product of an input product is not saved.
 
+    Returns
+    =======
+    product : :class:`pynot.product.ImageProduct`
+        The rectified 2D image. `None` if the wavelength solution failed.
+
+    output_msg : string
+        Log of messages from the function call
+    """
     msg = list()
-    arc2D = fits.getdata(arc_fname)
-    img2D = fits.getdata(img_fname)
-    msg.append("          - Loaded image: %s" % img_fname)
+    arc2D, _ = read_image_data(arc_fname)
+    product = load_product(img)
+    img2D = product.data
+    msg.append("          - Loaded image: %s" % get_product_name(img))
     msg.append("          - Loaded reference arc image: %s" % arc_fname)
-    err2D = fits.getdata(img_fname, 'ERR')
+    err2D = product['ERR'].data
     msg.append("          - Loaded error image")
 
-    try:
-        mask2D = fits.getdata(img_fname, 'MASK')
+    if 'MASK' in product:
+        mask2D = product.mask
         msg.append("          - Loaded mask image")
-    except KeyError:
+    else:
         mask2D = np.zeros_like(img2D)
-    hdr = instrument.get_header(img_fname)
+    if isinstance(img, ImageProduct):
+        hdr = product.header.copy()
+    else:
+        hdr = instrument.get_header(img)
 
     ref_table = np.loadtxt(pixtable_fname)
     pixtab_pars, found_all = get_pixtab_parameters(pixtable_fname)
@@ -637,48 +991,86 @@ def rectify(img_fname, arc_fname, pixtable_fname, output='', fig_dir='', order_b
     else:
         pix_in = instrument.create_pixel_array(hdr, axis=1)
 
-    ilow, ihigh = detect_borders(arc2D, kappa=edge_kappa)
     msg.append("          - Image shape: (%i, %i)" % arc2D.shape)
-    msg.append("          - Detecting arc line borders: %i -- %i" % (ilow, ihigh))
+    solution_fname = get_arc_solution_fname(arc_fname)
+    solution_key = get_arc_solution_key(arc_fname, pixtable_fname, pix_in, dispaxis=dispaxis,
+                                        order_bg=order_bg, order_2d=order_2d, order_wl=order_wl,
+                                        fit_window=fit_window, edge_kappa=edge_kappa, fit_method=fit_method,
+                                        log=log, N_out=N_out)
+    solution = None
+    if cache:
+        solution = ArcSolution.load(solution_fname, solution_key)
+
+    if solution is None:
+        ilow, ihigh = detect_borders(arc2D, kappa=edge_kappa)
+        msg.append("          - Detecting arc line borders: %i -- %i" % (ilow, ihigh))
+        arc2D = arc2D[ilow:ihigh, :]
+
+        msg.append("          - Subtracting arc line continuum background")
+        msg.append("          - Polynomial order of 1D background: %i" % order_bg)
+        arc2D_sub, _ = subtract_arc_background(arc2D, deg=order_bg)
+
+        msg.append("          - Fitting arc line positions within %i pixels" % fit_window)
+        msg.append("          - Number of lines to fit: %i" % ref_table.shape[0])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pixtab2d = create_2d_pixtab(arc2D_sub, pix_in, ref_table, dx=fit_window, method=fit_method)
+
+        msg.append("          - Constructing 2D wavelength grid with polynomial order: %i" % order_2d)
+        fit_table2d = fit_2dwave_solution(pixtab2d, deg=order_2d)
+        fit_residuals = format_table2D_residuals(pixtab2d, fit_table2d, ref_table)
+        wl2D = get_wavelength_rows(fit_table2d, ref_table[:, 1], pix_in, order_wl=order_wl)
+        solution = ArcSolution(solution_key, ilow, ihigh, arc2D_sub, pixtab2d, fit_table2d, wl2D, fit_residuals)
+        update_cache = cache
+    else:
+        msg.append("          - Loaded cached arc solution: %s" % solution_fname)
+        msg.append("          - Arc line borders: %i -- %i" % (solution.ilow, solution.ihigh))
+        update_cache = False
+
+    if interpolate and solution.operator is None:
+        # Prepare the resampling onto the wavelength grid of the central row.
+        # Non-monotonic solutions are caught by `apply_transform`
+        wl2D = solution.wl2D
+        dwl = np.diff(wl2D, axis=1)
+        if np.all(dwl > 0) or np.all(dwl < 0):
+            N_wl = img2D.shape[1] if N_out is None else N_out
+            wl = get_wavelength_grid(wl2D[wl2D.shape[0]//2], N_wl, log=log)
+            solution.operator = ResamplingOperator.from_wavelengths(wl2D, wl)
+            update_cache = cache
+
+    if update_cache:
+        try:
+            solution.save(solution_fname, arc_fname)
+            msg.append(" [OUTPUT] - Saving arc solution: %s" % solution_fname)
+        except OSError:
+            msg.append("[WARNING] - Could not save the arc solution: %s" % solution_fname)
+
+    ilow, ihigh = solution.ilow, solution.ihigh
     hdr['CRPIX2'] += ilow
     # Trim images:
-    arc2D = arc2D[ilow:ihigh, :]
     img2D = img2D[ilow:ihigh, :]
     err2D = err2D[ilow:ihigh, :]
     mask2D = mask2D[ilow:ihigh, :]
 
-    msg.append("          - Subtracting arc line continuum background")
-    msg.append("          - Polynomial order of 1D background: %i" % order_bg)
-    arc2D_sub, _ = subtract_arc_background(arc2D, deg=order_bg)
-
-    msg.append("          - Fitting arc line positions within %i pixels" % fit_window)
-    msg.append("          - Number of lines to fit: %i" % ref_table.shape[0])
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        pixtab2d = create_2d_pixtab(arc2D_sub, pix_in, ref_table, dx=fit_window)
-
-    msg.append("          - Constructing 2D wavelength grid with polynomial order: %i" % order_2d)
-    fit_table2d = fit_2dwave_solution(pixtab2d, deg=order_2d)
-
     msg.append("          - Residuals of arc line positions relative to fitted 2D grid:")
-    fit_residuals = format_table2D_residuals(pixtab2d, fit_table2d, ref_table)
-
     msg.append("              Wavelength    Mean Position   Arc Residual   Max. Curvature")
-    for l0, med_line_pos, line_residual, line_minmax in fit_residuals:
+    for l0, med_line_pos, line_residual, line_minmax in solution.residuals:
         msg.append("              %10.2f    %-13.2f   %-12.3f   %-14.3f" % (l0, med_line_pos, line_residual, line_minmax))
 
     if plot:
         plot_fname = os.path.join(fig_dir, 'PixTable2D.pdf')
-        plot_2d_pixtable(arc2D_sub, pix_in, pixtab2d, fit_table2d, arc_fname, filename=plot_fname)
+        plot_2d_pixtable(solution.arc2D_sub, pix_in, solution.pixtab2d, solution.fit_table2d, arc_fname,
+                         filename=plot_fname)
         msg.append("          - Plotting fitted arc line positions in 2D frame")
         msg.append(" [OUTPUT] - Saving figure: %s" % plot_fname)
 
     msg.append("          - Interpolating input image onto rectified wavelength solution")
     try:
-        transform_output = apply_transform(img2D, pix_in, fit_table2d, ref_table,
+        transform_output = apply_transform(img2D, pix_in, solution.fit_table2d, ref_table,
                                            err2D=err2D, mask2D=mask2D, header=hdr,
                                            order_wl=order_wl, ref_type=ref_type,
-                                           log=log, N_out=N_out, interpolate=interpolate)
+                                           log=log, N_out=N_out, interpolate=interpolate,
+                                           wl2D=solution.wl2D, operator=solution.operator)
         img2D_corr, err2D_corr, mask2D, wl, hdr_corr, trans_msg = transform_output
         msg.append(trans_msg)
 
@@ -686,55 +1078,56 @@ def rectify(img_fname, arc_fname, pixtable_fname, output='', fig_dir='', order_b
         msg.append(error.message)
         output_str = "\n".join(msg)
         print(output_str)
-        return "FATAL ERROR"
+        return None, "FATAL ERROR"
 
     hdr.add_comment('PyNOT version %s' % __version__)
     if output:
         if output[-5:] != '.fits':
             output += '.fits'
-    else:
+    elif not isinstance(img, ImageProduct):
         object_name = instrument.get_object(hdr)
         output = 'RECT2D_%s.fits' % (object_name)
 
     hdr_corr['DISPAXIS'] = 1
     hdr_corr['EXTNAME'] = 'DATA'
-    with fits.open(img_fname) as hdu:
-        hdu[0].data = img2D_corr
-        hdu[0].header = hdr_corr
-        if err2D_corr is not None:
-            hdu['ERR'].data = err2D_corr
-            err_hdr = hdu['ERR'].header
-            copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
-            copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
-            for key in copy_keywords:
-                if key in hdr:
-                    err_hdr[key] = hdr[key]
-            hdu['ERR'].header = err_hdr
-        if 'MASK' in hdu:
-            hdu['MASK'].data = mask2D
-            mask_hdr = hdu['MASK'].header
-            copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
-            copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
-            for key in copy_keywords:
-                if key in hdr:
-                    mask_hdr[key] = hdr[key]
-            hdu['MASK'].header = mask_hdr
-        else:
-            mask_hdr = fits.Header()
-            mask_hdr.add_comment("2 = Good Pixels")
-            mask_hdr.add_comment("1 = Cosmic Ray Hits")
-            mask_hdr['AUTHOR'] = 'PyNOT version %s' % __version__
-            copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
-            copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
-            for key in copy_keywords:
-                if key in hdr:
-                    mask_hdr[key] = hdr[key]
-            mask_ext = fits.ImageHDU(mask2D, header=mask_hdr, name='MASK')
-            hdu.append(mask_ext)
-        hdu.writeto(output, overwrite=overwrite)
-    msg.append(" [OUTPUT] - Saving rectified 2D image: %s" % output)
+    product.data = as_data_type(img2D_corr)
+    product.header = hdr_corr
+    if err2D_corr is not None:
+        product['ERR'].data = as_data_type(err2D_corr)
+        err_hdr = product['ERR'].header
+        copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
+        copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
+        for key in copy_keywords:
+            if key in hdr:
+                err_hdr[key] = hdr[key]
+        product['ERR'].header = err_hdr
+    if 'MASK' in product:
+        product['MASK'].data = as_mask_type(mask2D)
+        mask_hdr = product['MASK'].header
+        copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
+        copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
+        for key in copy_keywords:
+            if key in hdr:
+                mask_hdr[key] = hdr[key]
+        product['MASK'].header = mask_hdr
+    else:
+        mask_hdr = fits.Header()
+        mask_hdr.add_comment("2 = Good Pixels")
+        mask_hdr.add_comment("1 = Cosmic Ray Hits")
+        mask_hdr['AUTHOR'] = 'PyNOT version %s' % __version__
+        add_mask_bits(mask_hdr)
+        copy_keywords = ['CRPIX1', 'CRVAL1', 'CDELT1', 'CTYPE1', 'CUNIT1', 'CD1_1']
+        copy_keywords += ['CRPIX2', 'CRVAL2', 'CDELT2', 'CTYPE2', 'CUNIT2', 'CD2_2']
+        for key in copy_keywords:
+            if key in hdr:
+                mask_hdr[key] = hdr[key]
+        mask_ext = fits.ImageHDU(as_mask_type(mask2D), header=mask_hdr, name='MASK')
+        product.append(mask_ext)
+    product.save(output, overwrite=overwrite)
+    if output:
+        msg.append(" [OUTPUT] - Saving rectified 2D image: %s" % output)
     msg.append("")
     output_str = "\n".join(msg)
     if verbose:
         print(output_str)
-    return output_str
+    return product, output_str
@@ -9,6 +9,10 @@ import matplotlib.pyplot as plt
 import warnings
 import os
 
+from pynot import refcat
+from pynot.crossmatch import match_nearest
+from pynot.fitsio import read_fits_image
+
 
 def update_WCS(coords, refs, crval, CD):
     # Solve equations:
@@ -68,16 +72,9 @@ def pixel_to_radec(coords_pix, header):
 
 
 def match_catalogs(coords, refs):
-    matched = list()
-    matches_in_coords = []
-    used_index = list()
-    for xy in coords:
-        index = np.argmin(np.sum((refs - xy)**2, axis=1))
-        # if index not in used_index:
-        matched.append(refs[index])
-        used_index.append(index)
-        matches_in_coords.append(xy)
-    return np.array(matches_in_coords), np.array(matched)
+    """Match each (ra, dec) position in `coords` to the nearest position in `refs` (in degrees)"""
+    index, ref_index, _ = match_nearest(coords[:, 0], coords[:, 1], refs[:, 0], refs[:, 1])
+    return coords[index], refs[ref_index]
 
 
 def get_gaia_catalog(ra, dec, radius=4., limit=2000, catalog_fname='', database='dr3'):
@@ -85,15 +82,36 @@ def get_gaia_catalog(ra, dec, radius=4., limit=2000, catalog_fname='', database=
     ra and dec: units of degrees
     radius: units of arcmin
     limit: max number of targets to retrieve
+
+    The sources are taken from the local reference catalog store if the field has
+    been downloaded before, otherwise the Gaia archive is queried (see `pynot.refcat`).
+    """
+    def remote_query():
+        return query_gaia_archive(ra, dec, radius=radius, limit=limit,
+                                  catalog_fname=catalog_fname, database=database)
+    result, _ = refcat.query_catalog(get_gaia_store_name(database), ra, dec, radius,
+                                     remote_query, limit=limit)
+    return result
+
+
+def get_gaia_store_name(database='dr3'):
+    """Name of the Gaia data release `database` in the reference catalog store"""
+    return 'gaia_%s' % database
+
+
+def query_gaia_archive(ra, dec, radius=4., limit=2000, catalog_fname='', database='dr3'):
+    """
+    Query the Gaia archive for sources within `radius` (arcmin) of `ra`, `dec` (degrees).
+    The result is saved to `catalog_fname` (.csv) if given.
     """
     from astroquery.gaia import Gaia
     query_args = {'limit': limit, 'ra': ra, 'dec': dec, 'radius': radius/60., 'dr': database}
     query = """SELECT TOP {limit} ra, dec, phot_g_mean_mag, bp_rp FROM gaia{dr}.gaia_source
     WHERE CONTAINS(POINT('ICRS', gaia{dr}.gaia_source.ra, gaia{dr}.gaia_source.dec),
                    CIRCLE('ICRS', {ra}, {dec}, {radius}))=1;""".format(**query_args)
-    job = Gaia.launch_job_async(query, dump_to_file=True,
+    job = Gaia.launch_job_async(query, dump_to_file=bool(catalog_fname),
                                 output_format='csv', verbose=False,
-                                output_file=catalog_fname)
+                                output_file=catalog_fname if catalog_fname else None)
     result = job.get_results()
     return result
 
@@ -149,8 +167,7 @@ def correct_wcs(img_fname, sep_fname, output='', fig_fname='', min_num=6, G_lim=
     """
     msg = list()
 
-    img = fits.getdata(img_fname)
-    hdr = fits.getheader(img_fname)
+    img, _, hdr = read_fits_image(img_fname)
     msg.append("          - Loaded image: %s" % img_fname)
 
     # Prepare output filenames:
@@ -168,7 +185,13 @@ def correct_wcs(img_fname, sep_fname, output='', fig_fname='', min_num=6, G_lim=
     gaia_cat_name = 'gaia_source_%.2f%+.2f_%.1f.csv' % (hdr['CRVAL1'], hdr['CRVAL2'], radius)
     gaia_cat_name = os.path.join(dirname, gaia_cat_name)
     gaia_dr = 'dr3'
-    if os.path.exists(gaia_cat_name):
+    if refcat.store.is_covered(get_gaia_store_name(gaia_dr), hdr['CRVAL1'], hdr['CRVAL2'], radius):
+        ref_cat = get_gaia_catalog(hdr['CRVAL1'], hdr['CRVAL2'], radius=radius, database=gaia_dr)
+        msg.append("          - Loading Gaia source catalog from local store: %s" % refcat.store.root)
+        msg.append("          - Position: (ra, dec) = (%.5f ; %+.5f)  within %.1f arcmin" % (hdr['CRVAL1'],
+                                                                                             hdr['CRVAL2'],
+                                                                                             radius))
+    elif os.path.exists(gaia_cat_name):
         ref_cat = Table.read(gaia_cat_name)
         msg.append("          - Loading Gaia source catalog: %s" % gaia_cat_name)
         msg.append("          - Position: (ra, dec) = (%.5f ; %+.5f)  within %.1f arcmin" % (hdr['CRVAL1'],
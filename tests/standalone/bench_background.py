@@ -0,0 +1,94 @@
+"""
+Benchmark of the 2D background fit: `pynot.scired.fit_background_image`
+
+Stand-alone script. The vectorized fit is compared to the original fit
+of one spatial row at a time on a synthetic 2D spectrum with a sloped
+background, a trace and cosmic ray hits.
+
+    python bench_background.py --size 2048 --repeat 3
+"""
+
+__author__ = "Jens-Kristian Krogager"
+__email__ = "krogager.jk@gmail.com"
+__credits__ = ["Jens-Kristian Krogager"]
+
+import argparse
+import time
+
+import numpy as np
+from numpy.polynomial import Chebyshev
+from scipy import signal
+from scipy.ndimage import median_filter
+
+from pynot.functions import mad
+from pynot.scired import fit_background_image
+
+
+def fit_background_rows(data, order_bg=3, xmin=0, xmax=None, med_kernel=15, kappa=5, fwhm_scale=1, obj_kappa=20):
+    """The original implementation of `fit_background_image` fitting one row at a time"""
+    x = np.arange(data.shape[1])
+    if xmax is None:
+        xmax = len(x)
+    if xmax < 0:
+        xmax = len(x) + xmax
+    SPSF = np.nanmedian(data, 0)
+    noise = 1.5*mad(SPSF)
+    peaks, properties = signal.find_peaks(SPSF, prominence=obj_kappa*noise, width=3)
+    mask = (x >= xmin) & (x <= xmax)
+    for num, center in enumerate(peaks):
+        width = properties['widths'][num]
+        x1 = center - width*fwhm_scale
+        x2 = center + width*fwhm_scale
+        obj = (x >= x1) * (x <= x2)
+        mask &= ~obj
+    N_masked_pixels = np.sum(~mask)
+
+    bg2D = np.zeros_like(data)
+    for i, row in enumerate(data):
+        med_row = median_filter(row, med_kernel)
+        noise = mad(row)*1.4826
+        this_mask = mask * (np.abs(row - med_row) < kappa*noise)
+        if np.sum(this_mask) > order_bg+1:
+            bg_model = Chebyshev.fit(x[this_mask], row[this_mask], order_bg, domain=[x.min(), x.max()])
+            bg2D[i] = bg_model(x)
+    return bg2D, N_masked_pixels
+
+
+def make_spectrum(size, seed=1):
+    rng = np.random.default_rng(seed)
+    x = np.arange(size)
+    data = 100 + 0.01*x[None, :] + 2e-6*(x[None, :] - size/2)**2 + rng.normal(0, 5, (size, size))
+    data += 500*np.exp(-0.5*((x[None, :] - size/2)/2.)**2)
+    data[rng.integers(0, size, 2000), rng.integers(0, size, 2000)] += 1000
+    return data
+
+
+def best_time(func, data, repeat, **kwargs):
+    times = list()
+    for _ in range(repeat):
+        t0 = time.time()
+        result = func(data, **kwargs)
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the 2D background fit")
+    parser.add_argument("--size", type=int, default=2048, help="Number of rows and columns of the image")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the best time is used")
+    args = parser.parse_args()
+
+    data = make_spectrum(args.size)
+    options = dict(order_bg=3, kappa=10, med_kernel=15)
+    t_rows, (bg_rows, N_rows) = best_time(fit_background_rows, data, args.repeat, **options)
+    t_vect, (bg_vect, N_vect) = best_time(fit_background_image, data, args.repeat, **options)
+    print("Image size: %ix%i" % data.shape)
+    print("Row by row : %.2f s" % t_rows)
+    print("Vectorized : %.2f s" % t_vect)
+    print("Speed-up   : %.1fx" % (t_rows / t_vect))
+    print("Max. abs. difference of the background models: %.2e" % np.max(np.abs(bg_rows - bg_vect)))
+    print("Masked pixels: %i / %i" % (N_rows, N_vect))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark of the file classification: `pynot.data.organizer.classify`
+
+Stand-alone script. A directory of synthetic FITS files with small images is
+created for the currently installed instrument, using the rules of either
+alfosc.rules (headers with an image extension) or efosc.rules (the headers of
+the EFOSC frames in tests/data). Select the instrument by `pynot use` first.
+
+    python bench_classify.py --number 5000 --workers 1 2
+"""
+
+__author__ = "Jens-Kristian Krogager"
+__email__ = "krogager.jk@gmail.com"
+__credits__ = ["Jens-Kristian Krogager"]
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from pynot import instrument
+from pynot.data import organizer
+
+code_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(code_dir, '..', 'data')
+
+# Header keywords of one file of each type in alfosc.rules:
+alfosc_types = [
+    dict(EXPTIME=0.0, SHSTAT='CLOSED', CLAMP1=0, CLAMP2=0, CLAMP3=0, CLAMP4=0, ALGRNM='Open',
+         ALAPRTNM='Open', ALFLTNM='Open', IMAGETYP='BIAS', OBS_MODE='IMAGING', OBJECT='bias'),
+    dict(EXPTIME=300., SHSTAT='OPEN', CLAMP1=1, CLAMP2=1, CLAMP3=0, CLAMP4=0, ALGRNM='Grism_#4',
+         ALAPRTNM='Slit_1.0', ALFLTNM='Open', IMAGETYP='WAVE,LAMP', OBS_MODE='SPECTROSCOPY', OBJECT='HeNe'),
+    dict(EXPTIME=10., SHSTAT='OPEN', CLAMP1=0, CLAMP2=0, CLAMP3=1, CLAMP4=0, ALGRNM='Grism_#4',
+         ALAPRTNM='Slit_1.0', ALFLTNM='Open', IMAGETYP='FLAT,LAMP', OBS_MODE='SPECTROSCOPY', OBJECT='flat'),
+    dict(EXPTIME=900., SHSTAT='OPEN', CLAMP1=0, CLAMP2=0, CLAMP3=0, CLAMP4=0, ALGRNM='Grism_#4',
+         ALAPRTNM='Slit_1.0', ALFLTNM='Open', IMAGETYP='OBJECT', OBS_MODE='SPECTROSCOPY', OBJECT='GRB220101A'),
+    dict(EXPTIME=60., SHSTAT='OPEN', CLAMP1=0, CLAMP2=0, CLAMP3=0, CLAMP4=0, ALGRNM='Open',
+         ALAPRTNM='Open', ALFLTNM='r_Gun 618_148', IMAGETYP='OBJECT', OBS_MODE='IMAGING', OBJECT='GRB220101A'),
+    dict(EXPTIME=5., SHSTAT='OPEN', CLAMP1=0, CLAMP2=0, CLAMP3=0, CLAMP4=0, ALGRNM='Open',
+         ALAPRTNM='Open', ALFLTNM='r_Gun 618_148', IMAGETYP='FLAT,SKY', OBS_MODE='IMAGING', OBJECT='SkyFlat'),
+]
+
+
+def make_alfosc_files(output_dir, number):
+    img = np.zeros((8, 8), dtype=np.int16)
+    base = fits.Header()
+    base['INSTRUME'] = 'ALFOSC_FASU'
+    base['DATE-OBS'] = '2021-03-04T22:10:11.5'
+    base['FAFLTNM'] = 'Open'
+    base['FBFLTNM'] = 'Open'
+    base['FPIX'] = 200
+    # Typical length of an ALFOSC primary header:
+    for num in range(150):
+        base['FILL%03i' % num] = (num * 1.5, 'filler keyword')
+    ext_hdr = fits.Header()
+    for key in ['DETXBIN', 'DETYBIN', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2']:
+        ext_hdr[key] = 1
+    for num in range(number):
+        hdr = base.copy()
+        hdr.update(alfosc_types[num % len(alfosc_types)])
+        hdr['TCSTGT'] = hdr['OBJECT']
+        hdu = fits.HDUList([fits.PrimaryHDU(header=hdr), fits.ImageHDU(data=img, header=ext_hdr)])
+        hdu.writeto(os.path.join(output_dir, 'f%05i.fits' % num))
+
+
+def make_efosc_files(output_dir, number):
+    img = np.zeros((8, 8), dtype=np.int16)
+    headers = [fits.getheader(fname) for fname in sorted(glob.glob(os.path.join(data_dir, 'EFOSC*.fits')))]
+    for num in range(number):
+        fits.PrimaryHDU(data=img, header=headers[num % len(headers)]).writeto(os.path.join(output_dir, 'f%05i.fits' % num))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the classification of synthetic files")
+    parser.add_argument("--number", type=int, default=5000, help="Number of files")
+    parser.add_argument("--workers", type=int, nargs='+', default=[1], help="Number of processes to test")
+    args = parser.parse_args()
+
+    rule_name = os.path.basename(instrument.rulefile)
+    with tempfile.TemporaryDirectory() as output_dir:
+        t0 = time.time()
+        if rule_name == 'alfosc.rules':
+            make_alfosc_files(output_dir, args.number)
+        elif rule_name == 'efosc.rules':
+            make_efosc_files(output_dir, args.number)
+        else:
+            raise ValueError("No synthetic files for the rules: %s" % rule_name)
+        print("Created %i files for %s in %.1f s" % (args.number, rule_name, time.time() - t0))
+
+        for workers in args.workers:
+            t0 = time.time()
+            database, _ = organizer.classify(output_dir, progress=False, workers=workers)
+            counts = ", ".join(["%s: %i" % (ftype, len(files)) for ftype, files in database.items()])
+            print("classify  workers=%i : %.2f s  (%s)" % (workers, time.time() - t0, counts))
+
+        # Evaluation of the compiled rules on headers in memory:
+        files = sorted(glob.glob(os.path.join(output_dir, '*.fits')))[:1000]
+        headers = [fits.getheader(fname) for fname in files]
+        with open(instrument.rulefile) as rules:
+            rulebook = organizer.compile_rules(rules.readlines())
+        t0 = time.time()
+        for fname, hdr in zip(files, headers):
+            organizer.classify_header(hdr, rulebook, fname)
+        print("rules on %i headers : %.3f s" % (len(headers), time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
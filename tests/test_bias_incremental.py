@@ -0,0 +1,61 @@
+"""
+Incremental bias combination: `pynot.calibs.combine_bias_incremental`
+using the EFOSC dark frames in tests/data as bias frames.
+
+Run from the repository root:  python -m pytest tests/test_bias_incremental.py
+"""
+import glob
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pynot import calibs, efosc, scired
+from pynot.calibs import BiasAccumulator, combine_bias_frames
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture
+def bias_frames(monkeypatch):
+    # The frames are EFOSC data regardless of the installed instrument:
+    monkeypatch.setattr(calibs, 'instrument', efosc)
+    monkeypatch.setattr(scired, 'instrument', efosc)
+    frames = list()
+    for fname in sorted(glob.glob(os.path.join(data_dir, 'EFOSC*.fits'))):
+        if fits.getheader(fname).get('ESO DPR TYPE') == 'DARK':
+            frames.append(fname)
+    return frames
+
+
+def test_empty_input(bias_frames):
+    output, msg = combine_bias_frames([], incremental=True)
+    assert output == ''
+    assert 'ERROR' in msg
+
+
+def test_accumulate_and_skip_duplicates(bias_frames, tmp_path):
+    output = str(tmp_path / 'MASTER_BIAS.fits')
+    combine_bias_frames(bias_frames[:3], output=output, incremental=True)
+    _, msg = combine_bias_frames(bias_frames, output=output, incremental=True)
+    assert msg.count('already in accumulator') == 3
+
+    accum_fname, = glob.glob(str(tmp_path / 'BIAS_ACCUM_*.fits'))
+    accumulator = BiasAccumulator(accum_fname)
+    assert len(accumulator.files) == len(bias_frames)
+    assert np.max(accumulator.count) == len(bias_frames)
+
+
+def test_last_frame_duplicate_keeps_trimmed_header(bias_frames, tmp_path):
+    output = str(tmp_path / 'MASTER_BIAS.fits')
+    combine_bias_frames(bias_frames[:1], output=output, incremental=True)
+    # The last input frame is already in the accumulator:
+    combine_bias_frames(bias_frames[1:3] + bias_frames[:1], output=output, incremental=True)
+
+    master, hdr = fits.getdata(output, header=True)
+    assert hdr['OVERSCAN'] == 'TRIMMED'
+    assert (hdr['NAXIS2'], hdr['NAXIS1']) == master.shape
+    assert master.shape[0] + hdr['OVERSCAN_Y'] == fits.getheader(bias_frames[0])['NAXIS2']
+    accum_fname, = glob.glob(str(tmp_path / 'BIAS_ACCUM_*.fits'))
+    assert fits.getheader(accum_fname)['OVERSCAN'] == 'TRIMMED'
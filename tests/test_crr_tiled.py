@@ -0,0 +1,87 @@
+"""
+Tiled cosmic ray rejection must reproduce the full-frame result of `astroscrappy.detect_cosmics`
+on the EFOSC frames in tests/data.
+
+Run from the repository root:  python -m pytest tests/test_crr_tiled.py
+"""
+import glob
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astroscrappy import detect_cosmics
+
+from pynot import efosc
+from pynot.scired import detect_cosmics_tiled
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+science_types = ['OBJECT', 'STD']
+# Frames with a fully rejected 5x5 cleaning window in one tile, processed as the full frame:
+untiled_frames = ['EFOSC.2022-01-28T08:37:47.742.fits', 'EFOSC.2022-01-28T08:40:27.113.fits',
+                  'EFOSC.2022-01-28T08:43:07.204.fits']
+
+
+def get_science_frames():
+    frames = list()
+    for fname in sorted(glob.glob(os.path.join(data_dir, 'EFOSC*.fits'))):
+        hdr = fits.getheader(fname)
+        if hdr.get('ESO DPR TYPE') in science_types:
+            frames.append(fname)
+    return frames
+
+
+def load_frame(fname):
+    """Return the frame in electrons and the options of `detect_cosmics` as in `correct_cosmics`"""
+    data = fits.getdata(fname).astype(np.float32)
+    hdr = fits.getheader(fname)
+    gain = efosc.get_gain(hdr)
+    options = dict(gain=gain, readnoise=efosc.get_readnoise(hdr),
+                   satlevel=efosc.get_saturation_level(), sigclip=4.5, sigfrac=0.3, objlim=5.0)
+    return data * gain, options
+
+
+@pytest.mark.parametrize('fname', get_science_frames(), ids=os.path.basename)
+def test_tiled_matches_full_frame(fname):
+    data, options = load_frame(fname)
+    ref_mask, ref_clean = detect_cosmics(data, niter=2, **options)
+    crmask, cleanarr, tiled = detect_cosmics_tiled(data, tile_size=300, workers=1, niter=2, **options)
+    assert tiled == (os.path.basename(fname) not in untiled_frames)
+    assert np.array_equal(crmask, ref_mask)
+    assert np.array_equal(cleanarr, ref_clean)
+
+
+def test_tiled_parallel_matches_full_frame():
+    fname = os.path.join(data_dir, 'EFOSC.2022-01-28T04:54:24.341.fits')
+    data, options = load_frame(fname)
+    ref_mask, ref_clean = detect_cosmics(data, niter=4, **options)
+    crmask, cleanarr, tiled = detect_cosmics_tiled(data, tile_size=300, workers=2, niter=4, **options)
+    assert tiled
+    assert np.array_equal(crmask, ref_mask)
+    assert np.array_equal(cleanarr, ref_clean)
+
+
+@pytest.mark.parametrize('cleantype', ['median', 'medmask', 'meanmask', 'idw'])
+def test_tiled_cleantypes(cleantype):
+    fname = os.path.join(data_dir, 'EFOSC.2022-01-27T02:31:32.701.fits')
+    data, options = load_frame(fname)
+    data = data[:700, :900]
+    ref_mask, ref_clean = detect_cosmics(data, niter=2, cleantype=cleantype, **options)
+    crmask, cleanarr, tiled = detect_cosmics_tiled(data, tile_size=256, niter=2, cleantype=cleantype, **options)
+    assert tiled
+    assert np.array_equal(crmask, ref_mask)
+    assert np.array_equal(cleanarr, ref_clean)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_saturated_window_falls_back_to_full_frame(workers):
+    fname = os.path.join(data_dir, 'EFOSC.2022-01-27T02:31:32.701.fits')
+    data, options = load_frame(fname)
+    data = data[:700, :900].copy()
+    # A saturated star fills the 5x5 cleaning windows around it:
+    data[340:350, 440:450] = 2 * options['satlevel']
+    ref_mask, ref_clean = detect_cosmics(data, niter=2, **options)
+    crmask, cleanarr, tiled = detect_cosmics_tiled(data, tile_size=256, workers=workers, niter=2, **options)
+    assert not tiled
+    assert np.array_equal(crmask, ref_mask)
+    assert np.array_equal(cleanarr, ref_clean)
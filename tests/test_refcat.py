@@ -0,0 +1,139 @@
+"""
+Local reference catalog store: `pynot.refcat`
+
+The remote queries are replaced by local stand-ins, so the tests run offline.
+
+Run from the repository root:  python -m pytest tests/test_refcat.py
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from pynot import refcat
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    root = refcat.store.root
+    refcat.set_store_dir(str(tmp_path))
+    yield tmp_path
+    refcat.set_store_dir(root)
+
+
+def make_sources(ra, dec, radius, number=200, seed=1):
+    """Random sources within `radius` (arcmin) of `ra`, `dec` with a magnitude column"""
+    rng = np.random.default_rng(seed)
+    r = np.radians(0.99 * radius / 60.) * np.sqrt(rng.uniform(0, 1, number))
+    phi = rng.uniform(0, 2*np.pi, number)
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    dec_src = np.arcsin(np.sin(dec0)*np.cos(r) + np.cos(dec0)*np.sin(r)*np.cos(phi))
+    ra_src = ra0 + np.arctan2(np.sin(phi)*np.sin(r)*np.cos(dec0), np.cos(r) - np.sin(dec0)*np.sin(dec_src))
+    return Table({'ra': np.degrees(ra_src) % 360., 'dec': np.degrees(dec_src),
+                  'phot_g_mean_mag': rng.uniform(12, 20, number)})
+
+
+class RemoteQuery(object):
+    """Stand-in for the remote query, counting the number of calls"""
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.table
+
+
+def test_query_miss_then_hit(store_dir):
+    sources = make_sources(150.1, 2.2, 5.)
+    remote = RemoteQuery(sources)
+    result, cached = refcat.query_catalog('gaia_dr3', 150.1, 2.2, 5., remote)
+    assert not cached
+    assert remote.calls == 1
+    assert len(result) == len(sources)
+
+    # A smaller cone inside the downloaded cone is answered by the store:
+    result, cached = refcat.query_catalog('gaia_dr3', 150.1, 2.2, 3., remote)
+    assert cached
+    assert remote.calls == 1
+    dist = refcat.angular_distance(150.1, 2.2, sources['ra'], sources['dec']) * 60.
+    assert len(result) == np.sum(dist <= 3.)
+    assert np.allclose(np.sort(result['phot_g_mean_mag']), np.sort(sources['phot_g_mean_mag'][dist <= 3.]))
+
+    # A cone extending outside the coverage calls the remote query again:
+    refcat.query_catalog('gaia_dr3', 150.1, 2.2, 8., RemoteQuery(sources))
+    assert refcat.store.is_covered('gaia_dr3', 150.1, 2.2, 8.)
+
+
+def test_truncated_query_not_covered(store_dir):
+    sources = make_sources(30., -10., 5., number=50)
+    refcat.query_catalog('sdss', 30., -10., 5., RemoteQuery(sources), limit=50)
+    assert not refcat.store.is_covered('sdss', 30., -10., 5.)
+    assert refcat.store.cone_search('sdss', 30., -10., 5.) is None
+
+
+def test_empty_cone_has_columns(store_dir):
+    # Register a cone without sources after the columns of the catalog are known:
+    refcat.query_catalog('gaia_dr3', 80., 40., 3., RemoteQuery(make_sources(80., 40., 3.)))
+    empty = make_sources(200., -60., 3.)[:0]
+    result, cached = refcat.query_catalog('gaia_dr3', 200., -60., 3., RemoteQuery(empty))
+    assert not cached
+    result, cached = refcat.query_catalog('gaia_dr3', 200., -60., 3., RemoteQuery(None))
+    assert cached
+    assert len(result) == 0
+    assert result.colnames == ['ra', 'dec', 'phot_g_mean_mag']
+
+
+@pytest.mark.parametrize('ra, dec', [(0.02, 5.), (359.98, -5.), (45., 0.), (10., 89.8)],
+                         ids=['wrap_east', 'wrap_west', 'zone_edge', 'pole'])
+def test_cone_across_tiles(store_dir, ra, dec):
+    sources = make_sources(ra, dec, 10., number=500)
+    zones, index = refcat.get_tiles(sources['ra'], sources['dec'])
+    assert len(set(zip(zones, index))) > 1
+    refcat.query_catalog('gaia_dr3', ra, dec, 10., RemoteQuery(sources))
+
+    result, cached = refcat.query_catalog('gaia_dr3', ra, dec, 10., RemoteQuery(None))
+    assert cached
+    assert len(result) == len(sources)
+    assert np.allclose(np.sort(result['ra']), np.sort(sources['ra']))
+
+
+def test_ingest_csv_dump_pattern(store_dir, tmp_path):
+    sources = make_sources(150.12, 2.21, 4.)
+    fname = os.path.join(str(tmp_path), 'gaia_source_150.12+2.21_4.0.csv')
+    sources.write(fname, format='ascii.csv')
+    N_new, cone = refcat.store.ingest_csv('gaia_dr3', fname)
+    assert N_new == len(sources)
+    assert cone == (150.12, 2.21, 4. - refcat.dump_precision)
+    assert refcat.store.is_covered('gaia_dr3', 150.12, 2.21, 3.)
+
+    # The same dump is not added twice:
+    N_new, _ = refcat.store.ingest_csv('gaia_dr3', fname)
+    assert N_new == 0
+
+    # Without the pattern, the sources are added but the cone is not registered:
+    other = os.path.join(str(tmp_path), 'sources.csv')
+    make_sources(20., 20., 4.).write(other, format='ascii.csv')
+    N_new, cone = refcat.store.ingest_csv('gaia_dr3', other)
+    assert N_new > 0
+    assert cone is None
+    assert not refcat.store.is_covered('gaia_dr3', 20., 20., 1.)
+
+
+def ingest_field(root, seed):
+    store = refcat.ReferenceStore(root)
+    ra = 100. + 0.05 * seed
+    return store.ingest('gaia_dr3', make_sources(ra, 0.3, 3., seed=seed), ra, 0.3, 3.)
+
+
+def test_parallel_ingest(store_dir):
+    seeds = list(range(16))
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        N_added = list(executor.map(ingest_field, [str(store_dir)]*len(seeds), seeds))
+    # All sources and cones of the processes are kept:
+    assert len(refcat.store.get_coverage('gaia_dr3')) == len(seeds)
+    tiles = [np.load(os.path.join(str(store_dir), 'gaia_dr3', fname))
+             for fname in os.listdir(os.path.join(str(store_dir), 'gaia_dr3')) if fname.startswith('tile_')]
+    assert sum(len(tile) for tile in tiles) == sum(N_added) == 200 * len(seeds)